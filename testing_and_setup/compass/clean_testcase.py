@@ -14,10 +14,10 @@ import sys
 import os
 import shutil
 import fnmatch
-import re
 import argparse
 import subprocess
-import xml.etree.ElementTree as ET
+from xml_cache import parse_xml
+from list_testcases import get_test_cases
 
 if __name__ == "__main__":
     # Define and process input arguments
@@ -71,27 +71,18 @@ if __name__ == "__main__":
     if not args.clean_all:
         if args.case_num:
             use_case_list = True
-            case_list = args.case_num.split(',')
+            all_test_cases = get_test_cases(
+                os.path.dirname(os.path.realpath(__file__)))
+            case_list = [all_test_cases[int(case_num) - 1]
+                         for case_num in args.case_num.split(',')]
         else:
             use_case_list = False
             case_list = list()
             case_list.append(0)
     else:
         use_case_list = True
-        valid_case = 1
-        case_num = 1
-        case_list = list()
-
-        regex = re.compile('(\d):')
-        core_configuration = subprocess.check_output(['./list_testcases.py'])
-        for line in core_configuration.decode('utf-8').split('\n'):
-            if regex.search(line) is not None:
-                conf_arr = line.replace(":", " ").split()
-                case_num = int(conf_arr[0])
-                del conf_arr
-                case_list.append(case_num)
-        del core_configuration
-        del regex
+        case_list = get_test_cases(
+            os.path.dirname(os.path.realpath(__file__)))
 
     if not args.work_dir:
         args.work_dir = os.getcwd()
@@ -112,18 +103,12 @@ if __name__ == "__main__":
 
     # Iterate over all cases in the case_list.
     # There is only one if the (-o, -c, -r) options were used in place of (-n)
-    for case_num in case_list:
+    for test_case in case_list:
         # If we're using a case_list, determine the core, configuration, and
         # resolution for the current test case.
         if use_case_list:
-            core_configuration = subprocess.check_output(
-                    ['./list_testcases.py', '-n',
-                     '{:d}'.format(int(case_num))])
-            config_options = core_configuration.decode('utf-8').strip('\n').split(' ')
-            args.core = config_options[1]
-            args.configuration = config_options[3]
-            args.resolution = config_options[5]
-            args.test = config_options[7]
+            args.core, args.configuration, args.resolution, args.test = \
+                test_case
 
         # Setup each xml file in the configuration directory:
         test_path = '{}/{}/{}/{}'.format(args.core, args.configuration,
@@ -140,8 +125,7 @@ if __name__ == "__main__":
                 config_file = '{}/{}'.format(test_path, file)
 
                 # Parse file
-                config_tree = ET.parse(config_file)
-                config_root = config_tree.getroot()
+                config_root = parse_xml(config_file)
 
                 # Process <config> files
                 if config_root.tag == 'config':
@@ -171,7 +155,6 @@ if __name__ == "__main__":
                         print(' -- Removed driver script '
                               '{}/{}'.format(work_dir, script_name))
 
-                del config_tree
                 del config_root
 
     # Write the history of this command to the command_history file, for
@@ -190,18 +173,13 @@ if __name__ == "__main__":
         history_file.write('command: {}\n'.format(calling_command))
         history_file.write('setup the following cases:\n')
         if use_case_list:
-            for case_num in case_list:
-                core_configuration = subprocess.check_output(
-                        ['./list_testcases.py', '-n',
-                         '{:d}'.format(int(case_num))])
-                config_options = core_configuration.decode('utf-8').strip('\n').split(' ')
+            for core, configuration, resolution, test in case_list:
                 history_file.write('\n')
-                history_file.write('    core: {}\n'.format(config_options[1]))
+                history_file.write('    core: {}\n'.format(core))
                 history_file.write('    configuration: {}\n'.format(
-                        config_options[3]))
-                history_file.write('    resolution: {}\n'.format(
-                        config_options[5]))
-                history_file.write('    test: {}\n'.format(config_options[7]))
+                        configuration))
+                history_file.write('    resolution: {}\n'.format(resolution))
+                history_file.write('    test: {}\n'.format(test))
         else:
             history_file.write('core: {}\n'.format(args.core))
             history_file.write('configuration: {}\n'.format(
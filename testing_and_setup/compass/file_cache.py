@@ -0,0 +1,501 @@
+"""
+Acquisition of the files required by test cases (<get_file> tags), with an
+optional content-addressed cache that can be shared across work directories
+and users.
+
+Files are downloaded from all of their mirrors at once: if the mirrors support
+HTTP range requests, each one downloads a separate part of the file, and
+otherwise the first mirror that responds is used. A lock file makes sure only
+one process downloads a given file at a time. Partial downloads into the cache
+are kept, so a download that is interrupted resumes where it stopped.
+
+If a cache directory is given, a file is stored once as
+    <cache_dir>/objects/<sha256[0:2]>/<sha256>
+and files/<file_name>[.<hash>] records the content hash of each requested
+file. Requested files are hard links to the stored objects (or symbolic links
+if the cache is on a different file system). The cache directories and files
+are made group-writable (and the directories setgid), so users of a common
+group can share the cache. If the cache can't be used, files are downloaded
+directly instead.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import os
+import glob
+import errno
+import fcntl
+import shutil
+import hashlib
+import threading
+import netCDF4
+from six.moves import http_client
+from six.moves.urllib.request import Request, urlopen
+
+# The size of the blocks read and written while downloading and hashing
+block_size = 1024*1024
+
+# Seconds to wait for a mirror before giving up on it
+timeout = 60
+
+# Permissions of the cache directories (group-writable, with the setgid bit so
+# their contents keep the cache's group) and of the files other users may
+# need to replace
+shared_dir_mode = 0o2775
+shared_file_mode = 0o664
+
+# Errors from a failed or dropped transfer
+download_errors = (IOError, OSError, http_client.HTTPException)
+
+
+def get_file(file_name, dest_path, urls, cache_dir=None, file_hash=None,
+             download=True):  # {{{
+    """
+    Make file_name available in dest_path, from the cache or by downloading it
+    from urls (the mirror urls to which file_name is appended). If file_hash
+    is given, it must match the file_id attribute of the (netCDF) file.
+    Returns True if the file is available.
+    """
+    dest_file = '{}/{}'.format(dest_path, file_name)
+    if os.path.exists(dest_file):
+        return True
+
+    make_dirs(dest_path)
+
+    if cache_dir is not None:
+        try:
+            object_file = fetch_into_cache(file_name, urls, cache_dir,
+                                           file_hash, download)
+            if object_file is None:
+                return False
+            link_file(object_file, dest_file)
+            return True
+        except (IOError, OSError) as e:
+            print(" Can't use the file cache '{}' ({}); getting '{}' "
+                  "without it.".format(cache_dir, e, file_name))
+
+    if not download:
+        return False
+
+    # Only one process downloads a given file into dest_path at a time; the
+    # others wait and then find the file there.
+    lock_fd = open_shared_file('{}/.{}.lock'.format(dest_path, file_name),
+                               os.O_RDWR)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        if os.path.exists(dest_file):
+            return True
+
+        # Download next to the file, so it can be renamed into place, under
+        # a name of this process's own. Files left by processes that were
+        # interrupted are removed, since no other process is downloading.
+        temp_prefix = '{}/.{}.'.format(dest_path, file_name)
+        for left_over in glob.glob('{}[0-9]*'.format(temp_prefix)):
+            os.remove(left_over)
+        temp_file = '{}{}'.format(temp_prefix, os.getpid())
+        if not download_and_check(file_name, urls, temp_file, file_hash):
+            return False
+        os.rename(temp_file, dest_file)
+    finally:
+        os.close(lock_fd)
+    return True
+# }}}
+
+
+def fetch_into_cache(file_name, urls, cache_dir, file_hash=None,
+                     download=True):  # {{{
+    """
+    Return the path of the cached object for file_name, downloading it into
+    the cache first if needed. Returns None if the file can't be acquired,
+    and raises OSError (or IOError) if the cache can't be written.
+    """
+    key = get_cache_key(file_name, file_hash)
+    object_file = get_cached_object(cache_dir, key)
+    if object_file is not None or not download:
+        return object_file
+
+    temp_dir = '{}/tmp'.format(cache_dir)
+    make_shared_dirs(temp_dir)
+
+    # Only one process downloads a given file at a time; the others wait and
+    # then find it in the cache. The lock file is opened read-write without
+    # truncating it, so any user of the group can lock it.
+    lock_fd = open_shared_file('{}/{}.lock'.format(temp_dir, key), os.O_RDWR)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        object_file = get_cached_object(cache_dir, key)
+        if object_file is None:
+            temp_file = '{}/{}'.format(temp_dir, key)
+            if download_and_check(file_name, urls, temp_file, file_hash):
+                object_file = add_to_cache(cache_dir, key, temp_file)
+    finally:
+        os.close(lock_fd)
+
+    return object_file
+# }}}
+
+
+def get_cache_key(file_name, file_hash=None):  # {{{
+    # Files with an expected hash (file_id) are told apart by it, since the
+    # same name may be requested with different hashes.
+    if file_hash is None:
+        return file_name
+    return '{}.{}'.format(file_name, file_hash.strip())
+# }}}
+
+
+def get_cached_object(cache_dir, key):  # {{{
+    # The path of the object recorded for key, or None if there is none.
+    name_file = '{}/files/{}'.format(cache_dir, key)
+    if not os.path.exists(name_file):
+        return None
+    with open(name_file, 'r') as f:
+        content_hash = f.read().strip()
+    object_file = get_object_path(cache_dir, content_hash)
+    if not os.path.exists(object_file):
+        return None
+    return object_file
+# }}}
+
+
+def get_object_path(cache_dir, content_hash):  # {{{
+    return '{}/objects/{}/{}'.format(cache_dir, content_hash[0:2],
+                                     content_hash)
+# }}}
+
+
+def add_to_cache(cache_dir, key, temp_file):  # {{{
+    """
+    Move a downloaded file into the cache as an object named by its content
+    hash, record the hash for key, and return the object's path.
+    """
+    content_hash = compute_content_hash(temp_file)
+    object_file = get_object_path(cache_dir, content_hash)
+    make_shared_dirs(os.path.dirname(object_file))
+
+    if os.path.exists(object_file):
+        # The same content is already stored under another name
+        os.remove(temp_file)
+    else:
+        # Objects are shared through links, so they are made read-only
+        os.chmod(temp_file, 0o444)
+        os.rename(temp_file, object_file)
+
+    names_dir = '{}/files'.format(cache_dir)
+    make_shared_dirs(names_dir)
+    temp_name_file = '{}/.{}.{}'.format(names_dir, key, os.getpid())
+    fd = open_shared_file(temp_name_file, os.O_WRONLY | os.O_TRUNC)
+    with os.fdopen(fd, 'w') as f:
+        f.write('{}\n'.format(content_hash))
+    os.rename(temp_name_file, '{}/{}'.format(names_dir, key))
+
+    return object_file
+# }}}
+
+
+def compute_content_hash(path):  # {{{
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+# }}}
+
+
+def link_file(source, dest):  # {{{
+    # Hard link source to dest, or make a symbolic link if they are on
+    # different file systems (or hard links aren't allowed).
+    try:
+        os.link(source, dest)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return
+        os.symlink(os.path.abspath(source), dest)
+# }}}
+
+
+def make_dirs(path):  # {{{
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+# }}}
+
+
+def make_shared_dirs(path):  # {{{
+    # Make path and any missing parents with shared_dir_mode. The mode is set
+    # explicitly, since os.mkdir applies the umask.
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        return
+    make_shared_dirs(os.path.dirname(path))
+    try:
+        os.mkdir(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        return
+    os.chmod(path, shared_dir_mode)
+# }}}
+
+
+def open_shared_file(path, flags):  # {{{
+    # Open (creating if needed) path with os.open and the given flags, and
+    # return the file descriptor. A new file gets shared_file_mode whatever
+    # the umask.
+    try:
+        fd = os.open(path, flags | os.O_CREAT | os.O_EXCL, shared_file_mode)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        # The file's owner set its mode when creating it
+        return os.open(path, flags)
+    os.fchmod(fd, shared_file_mode)
+    return fd
+# }}}
+
+
+def download_and_check(file_name, urls, target, file_hash=None):  # {{{
+    """
+    Download file_name from the mirrors to target and, if file_hash is given,
+    check it against the file's file_id attribute. Returns True on success;
+    on failure, target is removed.
+    """
+    file_urls = ['{}/{}'.format(url, file_name) for url in urls]
+    if not download_file(file_urls, target):
+        print(" Failed to download '{}' from any mirror.".format(file_name))
+        return False
+
+    if file_hash is not None:
+        error = check_file_id(target, file_hash)
+        if error is not None:
+            print(error)
+            print(" Deleting file...")
+            os.remove(target)
+            return False
+
+    return True
+# }}}
+
+
+def check_file_id(path, file_hash):  # {{{
+    # Return an error message if the file_id of the netCDF file doesn't match
+    # file_hash, or None if it does.
+    nc = netCDF4.Dataset(path, 'r')
+    try:
+        file_id = nc.file_id
+    except AttributeError:
+        return " Downloaded file '{}' does not have a 'file_id' " \
+            "attribute.".format(os.path.basename(path))
+    finally:
+        nc.close()
+
+    if file_id.strip() != file_hash.strip():
+        return "*** ERROR: Base mesh has hash of '{}' which does not match " \
+            "expected hash of '{}'.".format(file_id, file_hash)
+    return None
+# }}}
+
+
+def download_file(urls, target):  # {{{
+    """
+    Download the file at any of the urls to target, splitting it among the
+    mirrors that support range requests. Returns True on success.
+    """
+    probes = [None]*len(urls)
+
+    def probe_mirror(index):
+        probes[index] = probe_url(urls[index])
+
+    run_threads(probe_mirror, range(len(urls)))
+
+    available = [(url, probe) for url, probe in zip(urls, probes)
+                 if probe is not None]
+    if len(available) == 0:
+        return False
+
+    # A target left over from an earlier attempt (maybe by another user) is
+    # replaced
+    if os.path.exists(target):
+        os.remove(target)
+
+    size = available[0][1][0]
+    ranged = [(url, validator) for url, (url_size, ranges, validator)
+              in available if ranges and url_size == size]
+
+    if size is not None and size > 0 and len(ranged) > 0:
+        success = download_ranges([url for url, _ in ranged], target, size,
+                                  [validator for _, validator in ranged])
+    else:
+        success = download_whole([(url, url_size) for url, (url_size, _, _)
+                                  in available], target)
+
+    return success
+# }}}
+
+
+def probe_url(url):  # {{{
+    # Return the size of the file at url (or None if unknown), whether the
+    # mirror supports range requests and the file's validator (its ETag and
+    # Last-Modified headers), or None if the mirror can't be reached.
+    try:
+        response = urlopen(Request(url, headers={'Range': 'bytes=0-0'}),
+                           timeout=timeout)
+    except download_errors:
+        return None
+
+    try:
+        code = response.getcode()
+        headers = response.info()
+        validator = '{} {}'.format(headers.get('ETag', ''),
+                                   headers.get('Last-Modified', ''))
+        if code == 206:
+            content_range = headers.get('Content-Range', '')
+            total = content_range.split('/')[-1]
+            if total.isdigit():
+                return int(total), True, validator
+            return None, False, validator
+        length = headers.get('Content-Length')
+        if length is not None and length.isdigit():
+            return int(length), False, validator
+        return None, False, validator
+    finally:
+        response.close()
+# }}}
+
+
+def download_ranges(urls, target, size, validators):  # {{{
+    # Download one part of the file from each mirror at once, then join the
+    # parts. The parts are named by the file's size and validators (so parts
+    # of a file that has since changed on the mirrors are never reused) and
+    # by their byte range, so an interrupted download resumes if it is
+    # retried with the same mirrors.
+    version = hashlib.sha1('{} {}'.format(size, ' '.join(validators)).encode(
+        'utf-8')).hexdigest()[0:12]
+    count = len(urls)
+    bounds = [size*index//count for index in range(count + 1)]
+    parts = ['{}.{}.{}-{}.part'.format(target, version, bounds[index],
+                                       bounds[index + 1] - 1)
+             for index in range(count)]
+    results = [False]*count
+
+    # Remove parts of other versions of the file or other mirror layouts
+    for part in glob.glob('{}.*.part'.format(target)):
+        if part not in parts:
+            os.remove(part)
+
+    def fetch_part(index):
+        # Start with this part's own mirror, and fall back on the others
+        mirrors = urls[index:] + urls[:index]
+        results[index] = download_range(mirrors, parts[index], bounds[index],
+                                        bounds[index + 1] - 1)
+
+    run_threads(fetch_part, range(count))
+
+    if not all(results):
+        return False
+
+    with open(target, 'wb') as out_file:
+        for part in parts:
+            with open(part, 'rb') as in_file:
+                shutil.copyfileobj(in_file, out_file, block_size)
+
+    for part in parts:
+        os.remove(part)
+
+    if os.path.getsize(target) != size:
+        os.remove(target)
+        return False
+    return True
+# }}}
+
+
+def download_range(urls, part, start, end):  # {{{
+    # Download bytes start to end (inclusive) into part, resuming from what
+    # part already holds, trying each of the mirrors in turn.
+    length = end - start + 1
+    for url in urls:
+        done = 0
+        if os.path.exists(part):
+            done = os.path.getsize(part)
+            # A part that is too long, or that another user left without
+            # group write permission, is started over
+            if done > length or (done < length and
+                                 not os.access(part, os.W_OK)):
+                os.remove(part)
+                done = 0
+        if done == length:
+            return True
+
+        request = Request(url, headers={'Range': 'bytes={}-{}'.format(
+            start + done, end)})
+        try:
+            response = urlopen(request, timeout=timeout)
+            try:
+                if response.getcode() != 206:
+                    continue
+                fd = open_shared_file(part, os.O_WRONLY | os.O_APPEND)
+                with os.fdopen(fd, 'ab') as part_file:
+                    copy_response(response, part_file)
+            finally:
+                response.close()
+        except download_errors:
+            continue
+
+        if os.path.getsize(part) == length:
+            return True
+
+    return False
+# }}}
+
+
+def download_whole(urls, target):  # {{{
+    # Download the whole file from the first mirror that works. urls is a
+    # list of (url, size) pairs, where size is the probed size of the file
+    # (or None if unknown); a download of any other size is discarded.
+    for url, size in urls:
+        try:
+            response = urlopen(url, timeout=timeout)
+            try:
+                length = response.info().get('Content-Length')
+                if size is None and length is not None and length.isdigit():
+                    size = int(length)
+                with open(target, 'wb') as out_file:
+                    copy_response(response, out_file)
+            finally:
+                response.close()
+            if size is None or os.path.getsize(target) == size:
+                return True
+            print(" Download of '{}' is incomplete ({} of {} bytes).".format(
+                url, os.path.getsize(target), size))
+        except download_errors:
+            pass
+        if os.path.exists(target):
+            os.remove(target)
+    return False
+# }}}
+
+
+def copy_response(response, out_file):  # {{{
+    while True:
+        block = response.read(block_size)
+        if not block:
+            break
+        out_file.write(block)
+# }}}
+
+
+def run_threads(function, args):  # {{{
+    threads = [threading.Thread(target=function, args=(arg,)) for arg in args]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+# }}}
+
+# vim: foldmethod=marker ai ts=4 sts=4 et sw=4 ft=python
@@ -3,7 +3,6 @@
 # Matt Hoffman, LANL, December 2014
 
 import sys, os
-import datetime
 try:
     import netCDF4
 except ImportError:
@@ -13,6 +12,7 @@ from optparse import OptionParser
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.mlab import griddata
+import mpas_xtime
 
 # Parse options
 from optparse import OptionParser
@@ -34,33 +34,6 @@ else:
 
 
 ################### DEFINE FUNCTIONS ######################
-def xtime2numtime(xtime):
-  """Define a function to convert xtime character array to numeric time values using datetime objects"""
-  # First parse the xtime character array into a string
-  xtimestr = netCDF4.chartostring(xtime) # convert from the character array to an array of strings using the netCDF4 module's function
-
-  dt = []
-  for stritem in xtimestr:
-      itemarray = stritem.strip().replace('_', '-').replace(':', '-').split('-')  # Get an array of strings that are Y,M,D,h,m,s
-      results = [int(i) for i in itemarray]
-      if (results[0] < 1900):  # datetime has a bug where years less than 1900 are invalid on some systems
-         results[0] += 1900
-      dt.append( datetime.datetime(*results) ) # * notation passes in the array as arguments
-
-  numtime = netCDF4.date2num(dt, units='seconds since '+str(dt[0]))   # use the netCDF4 module's function for converting a datetime to a time number
-  return numtime
-
-def xtimeGetYear(xtime):
-  """Get an array of years from an xtime array, ignoring any partial year information"""
-  # First parse the xtime character array into a string
-  xtimestr = netCDF4.chartostring(xtime) # convert from the character array to an array of strings using the netCDF4 module's function
-  years = np.zeros( (len(xtimestr),) )
-  for i in range(len(xtimestr)):
-      years[i] = ( int(xtimestr[i].split('-')[0]) ) # Get the year part and make it an integer
-  return years
-
-
-
 def contourMPAS(field, contour_levs=None):
   """Contours irregular MPAS data on cells"""
   #-- Now let's grid your data.
@@ -95,8 +68,8 @@ yCell = filein.variables['yCell'][:]/1000.0
 xtime = filein.variables['xtime'][:]
 nCells = len(filein.dimensions['nCells'])
 nVertLevels = len(filein.dimensions['nVertLevels'])
-#numtime = xtime2numtime(xtime)
-years = xtimeGetYear(xtime)
+#numtime = mpas_xtime.xtime_seconds(mpas_xtime.read_xtime(filename))
+years = mpas_xtime.read_xtime(filename)['year']
 
 thickness = filein.variables['thickness']
 temperature = filein.variables['temperature']
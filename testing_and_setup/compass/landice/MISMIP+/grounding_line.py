@@ -0,0 +1,215 @@
+"""
+Grounding-line and integrated-diagnostics extraction from MPAS Landice output,
+shared by the MISMIP+ and MISMIP3D scripts.
+
+Everything is computed with array operations over blocks of time slices, so a
+long run with frequent output is read (and, for MISMIP+, written) in a single
+pass with bounded memory: no field is ever held for more than chunkSize time
+slices at once.
+
+Grounding-line points are the edges with the grounding-line bit set in
+edgeMask and xEdge > 0 (the east side of the domain).  Cell quantities are
+averaged to those edges from the two cells on either side.
+"""
+
+import numpy as np
+import netCDF4
+
+GLbit = 256
+Icebit = 32
+Floatbit = 4
+secInYr = 3600.0 * 24.0 * 365.0  # Note: this may be slightly wrong for some calendar types!
+rhoi = 918.
+rhow = 1028.
+
+# Default number of time slices read at once
+defaultChunkSize = 50
+
+
+def time_chunks(nTime, chunkSize=defaultChunkSize):
+    """
+    Yield (start, stop) bounds of consecutive blocks of at most chunkSize
+    time slices.
+    """
+    chunkSize = max(1, int(chunkSize))
+    for start in range(0, nTime, chunkSize):
+        yield start, min(start + chunkSize, nTime)
+
+
+def gl_edge_mask(edgeMask, xEdge):
+    """
+    Boolean array (same shape as edgeMask) that is True for grounding-line
+    edges on the east side of the domain.
+    """
+    return np.logical_and((edgeMask & GLbit) == GLbit, xEdge > 0.0)
+
+
+def gl_edge_mask_chunks(ncfile, chunkSize=defaultChunkSize):
+    """
+    Yield (start, stop, glMask) for blocks of time slices of ncfile, where
+    glMask is gl_edge_mask() of edgeMask over those time slices.
+    """
+    xEdge = ncfile.variables['xEdge'][:]
+    edgeMask = ncfile.variables['edgeMask']
+    nTime = len(ncfile.dimensions['Time'])
+    for start, stop in time_chunks(nTime, chunkSize):
+        yield start, stop, gl_edge_mask(edgeMask[start:stop, :], xEdge)
+
+
+def gl_position_stats(ncfile, chunkSize=defaultChunkSize):
+    """
+    Return arrays of the minimum, mean and maximum x-position (m) of the
+    grounding line at each time of ncfile.  Times without any grounding-line
+    edge get 0.
+    """
+    xEdge = np.asarray(ncfile.variables['xEdge'][:], dtype=np.float64)
+    nTime = len(ncfile.dimensions['Time'])
+    GLmin = np.zeros((nTime,))
+    GLmean = np.zeros((nTime,))
+    GLmax = np.zeros((nTime,))
+    for start, stop, glMask in gl_edge_mask_chunks(ncfile, chunkSize):
+        count = glMask.sum(axis=1)
+        found = count > 0
+        xGL = np.where(glMask, xEdge, np.inf)
+        GLmin[start:stop] = np.where(found, xGL.min(axis=1), 0.0)
+        xGL = np.where(glMask, xEdge, -np.inf)
+        GLmax[start:stop] = np.where(found, xGL.max(axis=1), 0.0)
+        GLmean[start:stop] = np.where(
+            found, np.dot(glMask, xEdge) / np.maximum(count, 1), 0.0)
+    return GLmin, GLmean, GLmax
+
+
+def integrated_diagnostics(areaCell, thickness, bedTopography, cellMask):
+    """
+    Return the ice volume (m^3), volume above flotation (m^3) and grounded
+    area (m^2) for each time of the (nTime, nCells) cell fields.
+    Thickness above flotation = H - Hf, where Hf = max( (-rhow/rhoi)*topg, 0.)
+    """
+    notFloating = (cellMask & Floatbit) != Floatbit
+    grounded = np.logical_and((cellMask & Icebit) != 0, notFloating)
+    thicknessAF = np.where(bedTopography < 0.,
+                           thickness + (rhow/rhoi)*bedTopography, thickness)
+
+    iceVolume = np.dot(thickness, areaCell)
+    iceVAF = np.dot(np.where(notFloating, thicknessAF, 0.), areaCell)
+    groundedArea = np.dot(grounded, areaCell)
+    return iceVolume, iceVAF, groundedArea
+
+
+def vertical_mean(u, layerThicknessFractions):
+    """
+    Thickness-weighted vertical mean over layers of a field u of shape
+    (nTime, nCells, nVertInterfaces).
+    """
+    return 0.5 * np.dot(u[:, :, :-1] + u[:, :, 1:], layerThicknessFractions)
+
+
+def gl_point_indices(glMask):
+    """
+    Return the time, edge and point (rank of the edge among the grounding-line
+    edges at that time) indices of all grounding-line edges in glMask.
+    """
+    timeIndices, edgeIndices = np.nonzero(glMask)
+    pointIndices = np.cumsum(glMask, axis=1)[timeIndices, edgeIndices] - 1
+    return timeIndices, edgeIndices, pointIndices
+
+
+def write_gl_file(inFileName, outFileName, chunkSize=defaultChunkSize,
+                  times=None):
+    """
+    Read the MPAS Landice output file inFileName and write a grounding-line
+    file following the MISMIP+ protocol (Asay-Davis et al., 2016) to
+    outFileName, in a single pass over blocks of chunkSize time slices.
+    times gives the value of the time variable for each time slice (by
+    default, the time slice index).
+
+    Returns the ice volume, volume above flotation and grounded area at each
+    time.
+    """
+    inFile = netCDF4.Dataset(inFileName, 'r')
+
+    nTime = len(inFile.dimensions['Time'])
+    if times is None:
+        times = np.arange(nTime)
+
+    # Get mesh fields
+    layerThicknessFractions = inFile.variables['layerThicknessFractions'][:]
+    areaCell = np.asarray(inFile.variables['areaCell'][:], dtype=np.float64)
+    xEdge = inFile.variables['xEdge'][:]
+    yEdge = inFile.variables['yEdge'][:]
+    # subtract 1 from cellsOnEdge because indexing of cell-centered fields starts at 0
+    cellsOnEdge = inFile.variables['cellsOnEdge'][:, :] - 1
+
+    outFile = netCDF4.Dataset(outFileName, 'w')
+
+    outFile.createDimension('nPointGL', size=None)
+    outFile.createDimension('nTime', size=nTime)
+
+    glVarNames = ['xGL', 'yGL', 'iceThicknessGL', 'uSurfaceGL', 'vSurfaceGL',
+                  'uBaseGL', 'vBaseGL', 'uMeanGL', 'vMeanGL']
+    for varName in glVarNames:
+        outFile.createVariable(varName, 'f4', ('nPointGL', 'nTime'))
+    for varName in ['time', 'iceVolume', 'iceVAF', 'groundedArea']:
+        outFile.createVariable(varName, 'f4', ('nTime'))
+
+    outFile.variables['time'][:] = times
+
+    iceVolume = np.zeros((nTime,))
+    iceVAF = np.zeros((nTime,))
+    groundedArea = np.zeros((nTime,))
+
+    for start, stop in time_chunks(nTime, chunkSize):
+        thickness = inFile.variables['thickness'][start:stop, :]
+        uZonal = inFile.variables['uReconstructZonal'][start:stop, :, :]
+        uMeridional = inFile.variables['uReconstructMeridional'][start:stop, :, :]
+
+        glMask = gl_edge_mask(inFile.variables['edgeMask'][start:stop, :], xEdge)
+        timeIndices, edgeIndices, pointIndices = gl_point_indices(glMask)
+        iCell1 = cellsOnEdge[edgeIndices, 0]
+        iCell2 = cellsOnEdge[edgeIndices, 1]
+
+        def edge_average(field, level=None):
+            # average a cell field to the grounding-line edges
+            if level is None:
+                return 0.5 * (field[timeIndices, iCell1] +
+                              field[timeIndices, iCell2])
+            return 0.5 * (field[timeIndices, iCell1, level] +
+                          field[timeIndices, iCell2, level])
+
+        # convert velocity units to m/yr
+        glFields = {
+            'xGL': xEdge[edgeIndices],
+            'yGL': yEdge[edgeIndices],
+            'iceThicknessGL': edge_average(thickness),
+            'uSurfaceGL': edge_average(uZonal, 0) * secInYr,
+            'vSurfaceGL': edge_average(uMeridional, 0) * secInYr,
+            'uBaseGL': edge_average(uZonal, -1) * secInYr,
+            'vBaseGL': edge_average(uMeridional, -1) * secInYr,
+            'uMeanGL': edge_average(vertical_mean(
+                uZonal, layerThicknessFractions)) * secInYr,
+            'vMeanGL': edge_average(vertical_mean(
+                uMeridional, layerThicknessFractions)) * secInYr}
+
+        # Scatter the points into a (nPointGL, nTime) block; entries beyond
+        # the number of points at a given time are left masked (fill values)
+        nPoints = glMask.sum(axis=1).max() if glMask.size > 0 else 0
+        if nPoints > 0:
+            for varName in glVarNames:
+                block = np.ma.masked_all((nPoints, stop - start), dtype='f4')
+                block[pointIndices, timeIndices] = glFields[varName]
+                outFile.variables[varName][0:nPoints, start:stop] = block
+
+        # compute ice volume, ice volume-above-flotation, and grounded area
+        iceVolume[start:stop], iceVAF[start:stop], groundedArea[start:stop] = \
+            integrated_diagnostics(areaCell, thickness,
+                                   inFile.variables['bedTopography'][start:stop, :],
+                                   inFile.variables['cellMask'][start:stop, :])
+
+    outFile.variables['iceVolume'][:] = iceVolume
+    outFile.variables['iceVAF'][:] = iceVAF
+    outFile.variables['groundedArea'][:] = groundedArea
+
+    outFile.close()
+    inFile.close()
+
+    return iceVolume, iceVAF, groundedArea
@@ -34,22 +34,18 @@ Authors William Lipscomb and Matthew Hoffman
 import os, sys
 import numpy as np
 import netCDF4
-import datetime
 from optparse import OptionParser
 import matplotlib.pyplot as plt
+import grounding_line
+import mpas_xtime
 
 model = "_MPASLI"
-GLbit = 256
-Icebit = 32
-Floatbit = 4
-secInYr = 3600.0 * 24.0 * 365.0  # Note: this may be slightly wrong for some calendar types!
-rhoi = 918.
-rhow = 1028.
 
 parser = OptionParser()
 
 parser.add_option("-f", "--file", dest="filename", type='string', default='output_00000.nc', help="output file to analyze", metavar="FILE")
 parser.add_option("-x", "--expt", dest="experiment", type='string', default = 'all', help="MISMIP+ experiment(s) to set up", metavar="EXPT")
+parser.add_option("-c", "--chunk", dest="chunkSize", type='int', default=grounding_line.defaultChunkSize, help="number of time slices to process at once", metavar="N")
 
 for option in parser.option_list:
     if option.default != ("NO", "DEFAULT"):
@@ -68,34 +64,6 @@ else:
 
 ################### DEFINE FUNCTIONS ######################
 
-def xtime2numtime(xtime):
-    """Define a function to convert xtime character array to numeric time values using datetime objects"""
-    # First parse the xtime character array into a string 
-    xtimestr = netCDF4.chartostring(xtime) # convert from the character array to an array of strings using the netCDF4 module's function
-
-    dt = []
-    for stritem in xtimestr:
-        itemarray = stritem.strip().replace('_', '-').replace(':', '-').split('-')  # Get an array of strings that are Y,M,D,h,m,s
-	results = [int(i) for i in itemarray]
-	if (results[0] < 1900):  # datetime has a bug where years less than 1900 are invalid on some systems
-            results[0] += 1900
-	    dt.append( datetime.datetime(*results) ) # * notation passes in the array as arguments
-
-	    # use the netCDF4 module's function for converting a datetime to a time number
-            numtime = netCDF4.date2num(dt, units='seconds since '+str(dt[0]))   
-	    numtime /= (3600.0 * 24.0 * 365.0)
-	    numtime -= numtime[0]  # return years from start
-    return numtime
-
-def xtimeGetYear(xtime):
-    """Get an array of years from an xtime array, ignoring any partial year information"""
-    # First parse the xtime character array into a string 
-    xtimestr = netCDF4.chartostring(xtime) # convert from the character array to an array of strings using the netCDF4 module's function
-    years = np.zeros( (len(xtimestr),) )
-    for i in range(len(xtimestr)):
-        years[i] = ( int(xtimestr[i].split('-')[0]) ) # Get the year part and make it an integer
-    return years
-
 def glplot(ncfile, times, colora, label):
     """
     add a plot of grounding line points to current axes.
@@ -137,148 +105,26 @@ for expt in experiments:
         ncfile = netCDF4.Dataset(outputFile, 'r')
     except:
         print 'Could not find the output file in this directory. Skipping.'
+        os.chdir('..')
         continue
 
-    # Get dimensions
-    nTime = len(ncfile.dimensions['Time'])
-    nCells = len(ncfile.dimensions['nCells'])
-    nEdges = len(ncfile.dimensions['nEdges'])
-    nVertLevels = len(ncfile.dimensions['nVertLevels'])
-    nVertInterfaces = nVertLevels + 1
-
-    xtime = ncfile.variables['xtime'][:]
-    years = xtimeGetYear(xtime)
-
-    # Get mesh fields
-    layerThicknessFractions = ncfile.variables['layerThicknessFractions'][:]
-    areaCell = ncfile.variables['areaCell'][:]
-    xEdge = ncfile.variables['xEdge'][:]
-    yEdge = ncfile.variables['yEdge'][:]
-    cellsOnEdge = ncfile.variables['cellsOnEdge'][:,:]
-
-    # Get prognostic fields on cells
-    cellMask = ncfile.variables['cellMask'][:,:]
-    thickness = ncfile.variables['thickness'][:,:]
-    bedTopography = ncfile.variables['bedTopography'][:,:]
-    uReconstructZonal = ncfile.variables['uReconstructZonal'][:,:,:]
-    uReconstructMeridional = ncfile.variables['uReconstructMeridional'][:,:,:]
-    
-    # Get prognostic fields on edges
-    edgeMask = ncfile.variables['edgeMask'][:,:]
-
-    # Compute vertical mean velocity
-    uMeanZonal = np.zeros((nTime,nCells))
-    uMeanMeridional = np.zeros((nTime,nCells))
-
-    for k in range(nVertLevels):
-        uMeanZonal[:,:] += layerThicknessFractions[k] * 0.5 * (uReconstructZonal[:,:,k] + uReconstructZonal[:,:,k+1])
-        uMeanMeridional[:,:] += layerThicknessFractions[k] * 0.5 * (uReconstructMeridional[:,:,k] + uReconstructMeridional[:,:,k+1])
-
-    # Create GL file 
+    ncfile.close()
+    years = mpas_xtime.read_xtime(outputFile)['year']
+
+    # Create GL file in a single pass over blocks of time slices
     GLfile = expt + model + '.nc'
-    ncfile = netCDF4.Dataset(GLfile, 'w')
 
     print 'Creating output GL file', GLfile
 
-    # Set dimensions                                                                                  
-    glptdim = ncfile.createDimension('nPointGL', size = None)
-    timedim = ncfile.createDimension('nTime', size = nTime)
-
-    # Create variables
-    xGL = ncfile.createVariable('xGL', 'f4', ('nPointGL', 'nTime'))
-    yGL = ncfile.createVariable('yGL', 'f4', ('nPointGL', 'nTime'))
-    time = ncfile.createVariable('time', 'f4', ('nTime'))
-
-    iceThicknessGL = ncfile.createVariable('iceThicknessGL', 'f4', ('nPointGL', 'nTime'))
-    uSurfaceGL = ncfile.createVariable('uSurfaceGL', 'f4', ('nPointGL', 'nTime'))
-    vSurfaceGL = ncfile.createVariable('vSurfaceGL', 'f4', ('nPointGL', 'nTime'))
-    uBaseGL = ncfile.createVariable('uBaseGL', 'f4', ('nPointGL', 'nTime'))
-    vBaseGL = ncfile.createVariable('vBaseGL', 'f4', ('nPointGL', 'nTime'))
-    uMeanGL = ncfile.createVariable('uMeanGL', 'f4', ('nPointGL', 'nTime'))
-    vMeanGL = ncfile.createVariable('vMeanGL', 'f4', ('nPointGL', 'nTime'))
-
-    iceVolume = ncfile.createVariable('iceVolume', 'f4', ('nTime'))
-    iceVAF = ncfile.createVariable('iceVAF', 'f4', ('nTime'))
-    groundedArea = ncfile.createVariable('groundedArea', 'f4', ('nTime'))
-
-    iceVolume = np.zeros((nTime,)) 
-    iceVAF = np.zeros((nTime,)) 
-    groundedArea = np.zeros((nTime,)) 
-
-    print 'Created output variables'
-
-    # Loop over time slices
-    for iTime in range(nTime):
-
-        time[iTime] = years[iTime]
-        print 'iTime, time =', iTime, time[iTime] 
-
-        # Loop over edges to gather GL info
-        nGL = 0
-
-        for iEdge in range(nEdges):
-
-            # Identify grounding-line edges
-            #WHL - The following commented line is from the MISMIP3d script, but seems too inclusive.
-#            if np.nonzero( np.logical_and( ( (edgeMask[iTime,iEdge] & GLbit) / GLbit == 1), (xEdge[iEdge] > 0.0) ) ):
-            #WHL - This logic seems to work.
-            if np.logical_and( ( (edgeMask[iTime,iEdge] & GLbit) == GLbit), (xEdge[iEdge] > 0.0) ):
-
-                nGL += 1
-                m = nGL - 1   # so indexing starts at 0
-
-                # find indices of adjacent cells
-                # subtract 1 from cellsOnEdge because indexing of cell-centered fields starts at 0
-                iCell1 = cellsOnEdge[iEdge,0] - 1  
-                iCell2 = cellsOnEdge[iEdge,1] - 1
-
-                xGL[m,iTime] = xEdge[iEdge]
-                yGL[m,iTime] = yEdge[iEdge]
-
-                # average quantities from neighboring cell centers to the edge
-                # convert velocity units to m/yr
-
-                iceThicknessGL[m,iTime] = 0.5 * (thickness[iTime,iCell1] + thickness[iTime,iCell2])
-
-                iLev = 0    # subtract 1 from level 1 for 0-based indexing
-                uSurfaceGL[m,iTime] = 0.5 * (uReconstructZonal[iTime,iCell1,iLev] + uReconstructZonal[iTime,iCell2,iLev]) * secInYr
-                vSurfaceGL[m,iTime] = 0.5 * (uReconstructMeridional[iTime,iCell1,1] + uReconstructMeridional[iTime,iCell2,1]) * secInYr
-
-                iLev = nVertInterfaces - 1   # subtract 1 for 0-based indexing
-                uBaseGL[m,iTime] = 0.5 * (uReconstructZonal[iTime,iCell1,iLev] + uReconstructZonal[iTime,iCell2,iLev]) * secInYr
-                vBaseGL[m,iTime] = 0.5 * (uReconstructMeridional[iTime,iCell1,iLev] + uReconstructMeridional[iTime,iCell2,iLev]) * secInYr
-
-                uMeanGL[m,iTime] = 0.5 * (uMeanZonal[iTime,iCell1] + uMeanZonal[iTime,iCell2]) * secInYr
-                vMeanGL[m,iTime] = 0.5 * (uMeanMeridional[iTime,iCell1] + uMeanMeridional[iTime,iCell2]) * secInYr
-
-        # compute ice volume, ice volume-above-flotation, and grounded area
-        # Note: thickness above flotation = H - Hf, where Hf = max( (-rhow/rhoi)*topg, 0.)
-
-        for iCell in range(nCells):
-
-            iceVolume[iTime] += areaCell[iCell] * thickness[iTime,iCell]
-
-            if (cellMask[iTime,iCell] & Floatbit) != Floatbit:    # not floating
-                if bedTopography[iTime,iCell] < 0.:
-                    iceVAF[iTime] += areaCell[iCell] * (thickness[iTime,iCell] + (rhow/rhoi)*bedTopography[iTime,iCell])
-                else:
-                    iceVAF[iTime] += areaCell[iCell] * thickness[iTime,iCell]
-
-            if np.logical_and( (cellMask[iTime,iCell] & Icebit), 
-                               ( (cellMask[iTime,iCell] & Floatbit) != Floatbit) ):   # ice is present and not floating
-                groundedArea[iTime] += areaCell[iCell]
+    iceVolume, iceVAF, groundedArea = grounding_line.write_gl_file(
+        outputFile, GLfile, chunkSize=options.chunkSize, times=years)
 
+    for iTime in range(len(years)):
+        print 'iTime, time =', iTime, years[iTime]
         print 'ice volume (m^3) =', iceVolume[iTime]
         print 'ice VAF (m^3) =', iceVAF[iTime]
         print 'grounded area (m^2) =', groundedArea[iTime]
 
-        ncfile.variables['iceVolume'][:] = iceVolume[:]
-        ncfile.variables['iceVAF'][:] = iceVAF[:]
-        ncfile.variables['groundedArea'][:] = groundedArea[:]
-
-    # Close file for this experiment
-    ncfile.close()
-
     # Make sure the grounded area is reasonable
     ncfile = netCDF4.Dataset(GLfile, 'r')
     groundedArea = ncfile.variables['groundedArea'][:]
@@ -0,0 +1 @@
+../MISMIP+/grounding_line.py
\ No newline at end of file
@@ -0,0 +1 @@
+../mpas_xtime.py
\ No newline at end of file
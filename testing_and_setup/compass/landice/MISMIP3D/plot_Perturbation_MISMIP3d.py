@@ -9,8 +9,7 @@ import netCDF4
 from optparse import OptionParser
 import matplotlib.pyplot as plt
 from collections import OrderedDict
-
-GLbit = 256
+import grounding_line
 
 
 from optparse import OptionParser
@@ -51,9 +50,7 @@ for run in results:
 
   print "For run ", run, " using file ", results[run]['fname'], " and time=", "".join(xtime[t,:])
 
-  GLindEast = np.nonzero( np.logical_and(
-                 (edgeMask[:] & GLbit) / GLbit == 1,
-                 xEdge > 0.0 ) )[0]
+  GLindEast = np.nonzero(grounding_line.gl_edge_mask(edgeMask, xEdge))[0]
   #plt.plot(xEdge[GLindEast] / 1000.0, yEdge[GLindEast] / 1000.0, '*', color=color)  # to just plot the edge locations
   for i in range(len(GLindEast)):
      vind = vOnE[GLindEast[i], :] - 1  # switch to 0-based
@@ -111,13 +108,10 @@ for run in results:
   print "For run ", run, " using file ", results[run]['fname'], " and yEdge value ", yValue
 
   GLx = np.zeros( (nt,) )
-  for t in range(nt):
-     edgeMask = f.variables['edgeMask'][t,:]
-     GLindEast = np.nonzero( np.logical_and( np.logical_and(
-                 (edgeMask[:] & GLbit) / GLbit == 1,
-                 xEdge > 0.0 ),
-                 yEdge == yValue) )[0]  # should only be 1 index
-     GLx[t] = xEdge[GLindEast]
+  onRow = np.nonzero(yEdge == yValue)[0]
+  for t0, t1, glMask in grounding_line.gl_edge_mask_chunks(f):
+     # there should only be 1 GL edge along the row at each time
+     GLx[t0:t1] = np.where(glMask[:, onRow], xEdge[onRow], -np.inf).max(axis=1)
 
   plt.plot(year, GLx / 1000.0, '.', color=color)
 
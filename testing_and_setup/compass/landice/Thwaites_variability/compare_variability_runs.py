@@ -6,13 +6,23 @@ Script to compare some scalar values from different runs of Thwaites melt variab
 import sys
 import os
 import netCDF4
-import datetime
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.signal
 from matplotlib import cm
+from optparse import OptionParser
+import multiprocessing
+import mpas_xtime
+
+parser = OptionParser()
+parser.add_option("-j", "--jobs", dest="jobs", type='int', default=multiprocessing.cpu_count(), help="number of runs to read at once", metavar="N")
+parser.add_option("-r", "--reload", action="store_true", dest="reload", help="include this flag to read every run again, ignoring the saved run summaries")
+options, args = parser.parse_args()
 
 outfname = 'globalStats.nc'
+# Each run's analyzed time series are saved in this file in the run directory,
+# and reused as long as outfname and the parameters below don't change
+summaryfname = '.' + outfname + '.summary.npz'
 runs=[ adir for adir in sorted(os.listdir('.')) if (os.path.isdir(adir) and os.path.isfile(os.path.join(adir, outfname)))]
 print "Original run list:", runs
 
@@ -38,50 +48,90 @@ print "Will process the following directories: ", runs
 # --- Define some needed parameters
 rhoi = 910.0  # ice density
 windowLength = 7      # window length for smoothing some time series
+resampEndtime = 300.0  # end of the resampled time array
 # ----------------
 
 # ------ Needed functions ------
 
-def xtime2numtime(xtime):
-  """Define a function to convert xtime character array to numeric time values using datetime objects"""
-  # First parse the xtime character array into a string
-  xtimestr = netCDF4.chartostring(xtime) # convert from the character array to an array of strings using the netCDF4 module's function
-
-  dt = []
-  for stritem in xtimestr:
-      itemarray = stritem.strip().replace('_', '-').replace(':', '-').split('-')  # Get an array of strings that are Y,M,D,h,m,s
-      results = [int(i) for i in itemarray]
-      if (results[0] < 1900):  # datetime has a bug where years less than 1900 are invalid on some systems
-         results[0] += 1900
-      dt.append( datetime.datetime(*results) ) # * notation passes in the array as arguments
-
-  numtime = netCDF4.date2num(dt, units='seconds since '+str(dt[0]))   # use the netCDF4 module's function for converting a datetime to a time number
-  return numtime / (3600.0*24.0*365.0) # in years
-
-def xtime2numtimeMy(xtime):
-  """Define a function to convert xtime character array to numeric time values using local arithmetic"""
-  # First parse the xtime character array into a string
-  xtimestr = netCDF4.chartostring(xtime) # convert from the character array to an array of strings using the netCDF4 module's function
-
-  numtime = np.zeros( (len(xtimestr),) )
-  ii = 0
-  dayOfMonthStart = [1, 32, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335]
-  for stritem in xtimestr:
-      itemarray = stritem.strip().replace('_', '-').replace(':', '-').split('-')  # Get an array of strings that are Y,M,D,h,m,s
-      results = [int(i) for i in itemarray]
-      numtime[ii] = results[0] + (dayOfMonthStart[results[1]-1]-1 + results[2]) / 365.0  # decimal year
-      ii += 1
-  return numtime
-
+# the time series of a run that are saved in its summary
+summaryFields = ['yrs', 'dyrs', 'resampYrs', 'dresampYrs', 'melt', 'resampMelt', 'totalmelt', 'cumumelt',
+                 'VAF', 'resampVAF', 'VAFsmooth', 'VAFsmoothrate', 'GA', 'resampGA', 'GAsmooth', 'GArate']
+
+def analyze_run(run):
+   '''
+   Read the output of a model run and return a dictionary of the time series in summaryFields.
+   '''
+   summary = {}
+   f = netCDF4.Dataset(run + '/' + outfname, 'r')
+   #yrs = f.variables['daysSinceStart'][:] / 365.0
+   yrs = mpas_xtime.xtime_years(mpas_xtime.read_xtime(run + '/' + outfname))
+   summary['yrs'] = yrs
+   summary['dyrs'] = yrs[1:] - yrs[0:-1]
+
+   # resampled version of time array - needed for filtering.
+   # (Filtering needed b/c the occasional tiny time step that the model is exhibiting leads to inaccurate (noisy) derivatives)
+   resampYrs = np.linspace(0.0, resampEndtime, num=int(resampEndtime*12*2))
+   summary['resampYrs'] = resampYrs
+   summary['dresampYrs'] = resampYrs[1:] - resampYrs[0:-1]
+
+   summary['melt'] = np.asarray(f.variables['avgSubshelfMelt'][:])
+   summary['resampMelt'] = np.interp(resampYrs, yrs, summary['melt']) # generate y values for each x
+   summary['totalmelt'] = np.asarray(f.variables['totalFloatingBasalMassBal'][:]) / 1.0e12
+   summary['cumumelt'] = np.concatenate(([0.0], np.cumsum(summary['totalmelt'][0:-1] * summary['dyrs'])))
+
+   summary['VAF'] = np.asarray(f.variables['volumeAboveFloatation'][:]) / 1.0e12 * rhoi
+   summary['resampVAF'] = np.interp(resampYrs, yrs, summary['VAF']) # generate y values for each x
+   summary['VAFsmooth'] = scipy.signal.savgol_filter(summary['resampVAF'], window_length=windowLength, polyorder=1)
+   #VAFrate = (VAF[1:]-VAF[0:-1] ) / dyrs
+   summary['VAFsmoothrate'] = (summary['VAFsmooth'][1:] - summary['VAFsmooth'][0:-1] ) / summary['dresampYrs']
+
+   summary['GA'] = np.asarray(f.variables['groundedIceArea'][:]) / 1.0e3**2
+   summary['resampGA'] = np.interp(resampYrs, yrs, summary['GA']) # generate y values for each x
+   summary['GAsmooth'] = scipy.signal.savgol_filter(summary['resampGA'], window_length=windowLength, polyorder=1)
+   summary['GArate'] = (summary['GAsmooth'][1:] - summary['GAsmooth'][0:-1]) / summary['dresampYrs']
+
+   f.close()
+   return summary
+
+def load_run(run):
+   '''
+   Return the summary of a run and whether it had to be read again.  The saved summary is used if it was
+   made from the current output file (same modification time and size) with the current parameters.
+   '''
+   status = os.stat(run + '/' + outfname)
+   key = np.array([status.st_mtime, status.st_size, rhoi, windowLength, resampEndtime])
+   summaryPath = run + '/' + summaryfname
+
+   if not options.reload and os.path.exists(summaryPath):
+      try:
+         saved = np.load(summaryPath)
+         if np.array_equal(saved['key'], key):
+            summary = dict([(name, saved[name]) for name in summaryFields])
+            saved.close()
+            return run, summary, False
+         saved.close()
+      except (IOError, OSError, ValueError, KeyError):
+         pass  # a corrupt summary is made again
+
+   summary = analyze_run(run)
+   # Write to a temporary file first, so a concurrent script never reads a partial summary
+   tempPath = '{}.{}.npz'.format(summaryPath[:-4], os.getpid())
+   try:
+      np.savez(tempPath, key=key, **summary)
+      os.rename(tempPath, summaryPath)
+   except (IOError, OSError):
+      pass  # the summary is optional, so a read-only run directory is fine
+   return run, summary, True
 
 # --- Define data structures ---
 
 class modelRun:
-   def __init__(self, run):
+   def __init__(self, run, summary):
       '''
-      This reads results from a model run and saves and analyzes the needed results.
+      This holds the analyzed results of a model run.
 
       run = name of subdir in which the run was performed
+      summary = dictionary of the run's time series, from load_run
       '''
 
       # some metadata about run
@@ -96,56 +146,32 @@ class modelRun:
 
       #print self.amp, self.per, self.pha
 
-      f = netCDF4.Dataset(run + '/' + outfname, 'r')
-      self.nt = len(f.dimensions['Time'])
-      self.yrs = np.zeros((self.nt,))
-      #yrs = f.variables['daysSinceStart'][:] / 365.0
-      self.xtimes = f.variables['xtime'][:]
-   
-   
-      self.yrs = xtime2numtimeMy(self.xtimes)
-      self.dyrs = self.yrs[1:] - self.yrs[0:-1]
-   
-
-      # resampled version of time array - needed for filtering.
-      # (Filtering needed b/c the occasional tiny time step that the model is exhibiting leads to inaccurate (noisy) derivatives)
-      resampEndtime = self.yrs.max()
-      resampEndtime = 300.0
-      self.resampYrs = np.linspace(0.0, resampEndtime, num=resampEndtime*12*2)
-      self.dresampYrs = self.resampYrs[1:] - self.resampYrs[0:-1]
-   
-      self.melt = f.variables['avgSubshelfMelt'][:]
-      self.resampMelt = np.interp(self.resampYrs, self.yrs, self.melt) # generate y values for each x
-      self.totalmelt = f.variables['totalFloatingBasalMassBal'][:] / 1.0e12
-      self.cumumelt = self.totalmelt*0.0
-      for t in np.arange(self.nt-1)+1:
-         self.cumumelt[t] = self.cumumelt[t-1] + self.totalmelt[t-1] * self.dyrs[t-1]
-   
-      self.VAF = f.variables['volumeAboveFloatation'][:] / 1.0e12 * rhoi
-      self.resampVAF = np.interp(self.resampYrs, self.yrs, self.VAF) # generate y values for each x
-      self.VAFsmooth = scipy.signal.savgol_filter(self.resampVAF, window_length=windowLength, polyorder=1)
-      #VAFrate = (VAF[1:]-VAF[0:-1] ) / dyrs
-      self.VAFsmoothrate = (self.VAFsmooth[1:] - self.VAFsmooth[0:-1] ) / self.dresampYrs
-   
-      self.GA = f.variables['groundedIceArea'][:] / 1.0e3**2
-      self.resampGA = np.interp(self.resampYrs, self.yrs, self.GA) # generate y values for each x
-      self.GAsmooth = scipy.signal.savgol_filter(self.resampGA, window_length=windowLength, polyorder=1)
-      self.GArate = (self.GAsmooth[1:] - self.GAsmooth[0:-1]) / self.dresampYrs
-
-
-      f.close()
+      for name in summaryFields:
+         setattr(self, name, summary[name])
+      self.nt = len(self.yrs)
 
 
 # ================
 # Loop over runs and collect needed data
 # ================
+# Runs are read on a pool of processes, and only the runs without an up-to-date summary are read again
+if options.jobs > 1 and len(runs) > 1:
+   pool = multiprocessing.Pool(processes=min(options.jobs, len(runs)))
+   loaded = pool.imap(load_run, runs)
+else:
+   pool = None
+   loaded = (load_run(run) for run in runs)
+
 runData = {}  # init empty dictionary
 groups = {} # groups are a dictionary of dictionaries.  May want to changes this to a dictionary of custom objects that can include metadata about the group alongside the group's data children.  KISS for now.
-for run in runs:
-   print "Processing run: " + run
+for run, summary, reloaded in loaded:
+   if reloaded:
+      print "Processed run: " + run
+   else:
+      print "Using saved summary for run: " + run
 
    # Build a list that contains all run data objects
-   runData[run] = modelRun(run)
+   runData[run] = modelRun(run, summary)
 
    # Populate each run into its group for ensemble runs (not for controls)
    if 'amp' in run:
@@ -157,6 +183,10 @@ for run in runs:
          groups[groupName] = {} # init an empty dict to add group members
       groups[groupName][phase] = runData[run]  # stick the run object into this group
 
+if pool is not None:
+   pool.close()
+   pool.join()
+
 print "Processing complete.\n"
 
 #print groups
@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 # A script to compare MPAS model output to the Halfar analytic solution of the dome test case.
 # Matt Hoffman, LANL, September 2013
+#
+# The analytic solution and the error statistics are computed for all output times at once.
+# Error statistics for every time (including RMS errors in rings around the dome center) are
+# written to <file>.halfar_errors.txt.  If more than one output file is given (e.g., runs at
+# different resolutions), a convergence table is also written to halfar_convergence.txt.
 
 import sys
-import datetime
 try:
     import netCDF4
 except ImportError:
@@ -12,10 +16,12 @@ except ImportError:
 from optparse import OptionParser
 import numpy as np
 import matplotlib.pyplot as plt
+import mpas_xtime
 
-parser = OptionParser()
+parser = OptionParser(usage="usage: %prog [options] [more files to compare, e.g., at other resolutions]")
 parser.add_option("-f", "--file", dest="filename", help="file to test", metavar="FILE")
 parser.add_option("-t", "--time", dest="t", help="which time level to use", metavar="T")
+parser.add_option("-r", "--ring", dest="ringWidth", type='float', default=5.0, help="width (km) of the rings around the dome center in which errors are computed [default: %default]", metavar="KM")
 parser.add_option("-s", "--save", action="store_true", dest="saveimage", help="include this flag to save plot")
 parser.add_option("-n", "--nodisp", action="store_true", dest="hidefigs", help="include this flag to not display plot")
 
@@ -29,117 +35,190 @@ else:
    timelev = -1
    print 'No time level specified.  Attempting to use final time.'
 
+# Runs in the convergence table are compared at the same model time, to within this many years
+timeTolerance = 1.0 / 365.0
+
 ################### DEFINE FUNCTIONS ######################
 # Define the function to calculate the Halfar thickness
 def halfar(t,x,y, A, n, rho):
-  # A   # s^{-1} Pa^{-3}
+  # t   # time(s) since the start of the run (s), a scalar or an array of times
+  # A   # s^{-1} Pa^{-n}
   # n   # Glen flow law exponent
   # rho # ice density kg m^{-3}
+  # Returns the thickness at each (x,y) point for each time, with shape t.shape + x.shape.
+  # This is the similarity solution of Halfar (1983) generalized to any n by Bueler et al. (2005),
+  # without accumulation.
 
   # These constants should come from setup_dome_initial_conditions.py.
   # For now they are being hardcoded.
   R0 = 60000.0 * np.sqrt(0.125)   # initial dome radius
   H0 = 2000.0 * np.sqrt(0.125)    # initial dome thickness at center
   g = 9.80616  # gravity m/s/s -- value used by mpas_constants
-  alpha = 1.0/9.0
-  beta = 1.0/18.0
-  secpera = 3600.0*24.0*365.0  # value for gregorian_noleap calendar
+  alpha = 2.0/(5.0*n+3.0)  # 1/9 for n=3
+  beta = 1.0/(5.0*n+3.0)   # 1/18 for n=3
   Gamma = 2.0 / (n+2.0) * A * (rho * g)**n
 
   x0 = 0.0; y0 = 0.0   # The IC file puts the center of the dome and the domain at (0,0)
 
-  t0 = (beta/Gamma) * (7.0/4.0)**3 * (R0**4/H0**7)  # NOTE: These constants assume n=3 - they need to be generalized to allow other n's 
-  t=t+t0
-  t=t/t0
+  t0 = (beta/Gamma) * ((2.0*n+1.0)/(n+1.0))**n * (R0**(n+1.0)/H0**(2.0*n+1.0))
+  t = (np.asarray(t, dtype=float) + t0) / t0
+  t = t[..., np.newaxis]  # broadcast times against points
 
-  H=np.zeros(len(x))
-  for i in range(len(x)):
-      r = np.sqrt( (x[i] - x0)**2 + (y[i] - y0)**2)
-      r=r/R0
-      inside = max(0.0, 1.0 - (r / t**beta)**((n+1.0) / n))
+  r = np.sqrt( (np.asarray(x) - x0)**2 + (np.asarray(y) - y0)**2) / R0
+  inside = np.maximum(0.0, 1.0 - (r / t**beta)**((n+1.0) / n))
 
-      H[i] = H0 * inside**(n / (2.0*n+1.0)) / t**alpha
-  #print "max r=", x[H>0.0].max(), y[H>0.0].max()
+  H = H0 * inside**(n / (2.0*n+1.0)) / t**alpha
   return H
 
-# Define a function to convert xtime character array to numeric time values using datetime objects
-def xtime2numtime(xtime):
-  # First parse the xtime character array into a string 
-  xtimestr = netCDF4.chartostring(xtime) # convert from the character array to an array of strings using the netCDF4 module's function
-
-  dt = []
-  for stritem in xtimestr:
-      itemarray = stritem.strip().replace('_', '-').replace(':', '-').split('-')  # Get an array of strings that are Y,M,D,h,m,s
-      results = [int(i) for i in itemarray]
-      if (results[0] < 1900):  # datetime has a bug where years less than 1900 are invalid on some systems
-         results[0] += 1900
-      dt.append( datetime.datetime(*results) ) # * notation passes in the array as arguments
-
-  numtime = netCDF4.date2num(dt, units='seconds since '+str(dt[0]))   # use the netCDF4 module's function for converting a datetime to a time number
-  return numtime
+def errorStats(thk, thkHalfar, areaCell, ringIndex, nRings):
+  # Error statistics for cells modeled to have ice, for all times at once.
+  # thk and thkHalfar have shape (nTime, nCells).  Returns a dictionary of arrays with one value
+  # per time (nan if there is no ice), and the RMS error in each ring, with shape (nTime, nRings).
+  nTime = thk.shape[0]
+  ice = thk > 0.0
+  thkDiff = thk - thkHalfar
+  thkDiffIce = np.where(ice, thkDiff, np.nan)
+  count = ice.sum(axis=1)
+  stats = {}
+  with np.errstate(invalid='ignore', divide='ignore'):
+    stats['count'] = count
+    stats['RMS'] = np.sqrt( np.where(ice, thkDiff**2, 0.0).sum(axis=1) / count )
+    stats['RMSwtd'] = np.sqrt( np.where(ice, thkDiff**2 * areaCell, 0.0).sum(axis=1) / np.where(ice, areaCell, 0.0).sum(axis=1) )
+    stats['min'] = np.where(count > 0, np.where(ice, thkDiff, np.inf).min(axis=1), np.nan)
+    stats['max'] = np.where(count > 0, np.where(ice, thkDiff, -np.inf).max(axis=1), np.nan)
+    stats['mean'] = np.where(ice, thkDiff, 0.0).sum(axis=1) / count
+    stats['MAE'] = np.where(ice, np.absolute(thkDiff), 0.0).sum(axis=1) / count
+  if count.min() > 0:
+    stats['median'] = np.nanmedian(thkDiffIce, axis=1)
+    stats['medianAbs'] = np.nanmedian(np.absolute(thkDiffIce), axis=1)
+  else:
+    stats['median'] = np.array([np.median(d[i]) if c > 0 else np.nan for d, i, c in zip(thkDiff, ice, count)])
+    stats['medianAbs'] = np.array([np.median(np.absolute(d[i])) if c > 0 else np.nan for d, i, c in zip(thkDiff, ice, count)])
+
+  # Sum the squared errors of ice cells by (time, ring) in one bincount
+  timeRing = (np.arange(nTime)[:, np.newaxis] * nRings + ringIndex[np.newaxis, :])[ice]
+  ringSum = np.bincount(timeRing, weights=thkDiff[ice]**2, minlength=nTime*nRings).reshape((nTime, nRings))
+  ringCount = np.bincount(timeRing, minlength=nTime*nRings).reshape((nTime, nRings))
+  with np.errstate(invalid='ignore', divide='ignore'):
+    ringRMS = np.sqrt(ringSum / ringCount)
+  return stats, ringRMS
+
+def checkFile(filename, keepFields=True):
+  # Compare one output file to the Halfar solution at all times, write its error table, and
+  # return what is needed for plotting and the convergence table.  The (nTime, nCells) modeled
+  # and analytic thickness fields are only returned if keepFields is True.
+  filein = netCDF4.Dataset(filename,'r')
+  run = {'filename': filename}
+  run['xCell'] = xCell = filein.variables['xCell'][:]
+  run['yCell'] = yCell = filein.variables['yCell'][:]
+  run['xtime'] = filein.variables['xtime'][:]
+  areaCell = filein.variables['areaCell'][:]
+  if 'dcEdge' in filein.variables:
+    run['resolution'] = filein.variables['dcEdge'][:].mean()
+  else:
+    run['resolution'] = np.sqrt(areaCell.mean())
+
+  run['thk'] = thk = filein.variables['thickness'][:]
+
+  # Find out what the ice density and flowA values for this run were.
+  print '\nCollecting parameter values from ' + filename + '.'
+
+  flowA = filein.config_default_flowParamA
+  print 'Using a flowParamA value of: ' + str(flowA)
+  flow_n = filein.config_flowLawExponent
+  print 'Using a flowLawExponent value of: ' + str(flow_n)
+  rhoi = filein.config_ice_density
+  print 'Using an ice density value of: ' + str(rhoi)
+
+  dynamicThickness = filein.config_dynamic_thickness
+  print '\nDynamic thickness for this run = ' + str(dynamicThickness)
+
+  calendar = filein.config_calendar_type
+  print 'Using calendar type: ' + calendar
+  numtime = mpas_xtime.xtime_seconds(mpas_xtime.read_xtime(filename), calendar)
+  run['years'] = (numtime - numtime[0]) / mpas_xtime.secInYr
+  filein.close()
+
+  # Call the halfar function for all times
+  run['thkHalfar'] = thkHalfar = halfar(numtime-numtime[0], xCell, yCell, flowA, flow_n, rhoi)
+
+  ringWidth = options.ringWidth * 1000.0
+  ringIndex = (np.sqrt(xCell**2 + yCell**2) // ringWidth).astype(int)
+  nRings = ringIndex.max() + 1
+  run['stats'], run['ringRMS'] = stats, ringRMS = errorStats(thk, thkHalfar, areaCell, ringIndex, nRings)
+
+  # Write the error statistics for every time
+  tablename = filename.rsplit('.nc', 1)[0] + '.halfar_errors.txt'
+  columns = ['years', 'count', 'RMS', 'RMSwtd', 'min', 'max', 'mean', 'median', 'MAE', 'medianAbs']
+  header = ' '.join(columns) + ' ' + ' '.join(['RMS_ring_{:g}-{:g}km'.format(i*options.ringWidth, (i+1)*options.ringWidth) for i in range(nRings)])
+  table = np.column_stack([run['years']] + [stats[c] for c in columns[1:]] + [ringRMS])
+  np.savetxt(tablename, table, fmt='%.6g', header=header)
+  print 'Wrote error statistics for all times to ' + tablename
+  if not keepFields:
+    del run['thk'], run['thkHalfar']
+  return run
 
 ################### END OF FUNCTIONS ######################
 
 
-# open supplied MPAS output file and get thickness slice needed
-filein = netCDF4.Dataset(options.filename,'r')
-xCell = filein.variables['xCell'][:]
-yCell = filein.variables['yCell'][:]
-xtime = filein.variables['xtime'][:]
-areaCell = filein.variables['areaCell'][:]
-
-thk = filein.variables['thickness'][:]
-xtime = filein.variables['xtime'][:] 
-numtime = xtime2numtime(xtime)
-
-# Find out what the ice density and flowA values for this run were.
-print '\nCollecting parameter values from the output file.'
-
-flowA = filein.config_default_flowParamA
-print 'Using a flowParamA value of: ' + str(flowA)
-flow_n = filein.config_flowLawExponent
-print 'Using a flowLawExponent value of: ' + str(flow_n)
-if flow_n != 3:
-        print 'Error: The Halfar script currently only supports a flow law exponent of 3.'
-        sys.exit
-rhoi = filein.config_ice_density
-print 'Using an ice density value of: ' + str(rhoi)
-
-dynamicThickness = filein.config_dynamic_thickness
-print '\nDynamic thickness for this run = ' + str(dynamicThickness)
+filenames = [options.filename] + args
+# Only the first file is plotted, so only its full thickness fields are kept
+runs = [checkFile(filename, keepFields=(i == 0)) for i, filename in enumerate(filenames)]
 
-print 'Using model time of ' + xtime[timelev,:].tostring().strip() + '\n'
+# Print some stats about the error for the first file at the requested time
+run = runs[0]
+xCell = run['xCell']; yCell = run['yCell']; xtime = run['xtime']; thk = run['thk']
+thkHalfar = run['thkHalfar'][timelev, :]
+stats = run['stats']
+thkDiff = (thk[timelev, :] - thkHalfar)
 
-if filein.config_calendar_type != "gregorian_noleap":
-        print 'Error: The Halfar script currently assumes a gregorian_noleap calendar.  Modify it to proceed with your calendar type of: ', filein.config_calendar_type
-        sys.exit
-
-
-# Call the halfar function
-thkHalfar = halfar(numtime[timelev]-numtime[0], xCell, yCell, flowA, flow_n, rhoi)
-
-iceCells = np.where( thk[timelev,:] > 0.0)
-print "# ice cells=", len(iceCells[0])
-thkDiff = (thk[timelev, :] - thkHalfar) 
-thkDiffIce = thkDiff[iceCells]  # Restrict to cells modeled to have ice
-RMS = ( (thkDiffIce**2).sum() / float(len(thkDiffIce)) )**0.5
-#RMSwtd = ( ((thkDiffIce * areaCell[iceCells] / areaCell[iceCells].sum())**2).sum() / float(len(thkDiffIce)) )**0.5
-#RMSwtd = ( ((thkDiffIce * areaCell[iceCells])**2 ).sum() / areaCell[iceCells]**0.5.sum()
-RMSwtd = ( (thkDiffIce**2 * areaCell[iceCells] / (areaCell[iceCells]).sum() ).sum() )**0.5
-
-
-# Print some stats about the error
+print '\nUsing model time of ' + netCDF4.chartostring(xtime)[timelev].strip() + ' from ' + run['filename'] + '\n'
+print "# ice cells=", stats['count'][timelev]
 print 'Error statistics for cells modeled to have ice:'
-print '* RMS error = ' + str( RMS )
-print '* RMS error (area weighted) = ' + str( RMSwtd )
-print '* Minimum error = ' + str( thkDiffIce.min() )
-print '* Maximum error = ' + str( thkDiffIce.max() )
-print '* Mean error = ' + str( thkDiffIce.mean() )
-print '* Median error = ' + str( np.median(thkDiffIce) )
-print '* Mean absolute error = ' + str( np.absolute(thkDiffIce).mean() )
-print '* Median absolute error = ' + str( np.median(np.absolute(thkDiffIce)) )
+print '* RMS error = ' + str( stats['RMS'][timelev] )
+print '* RMS error (area weighted) = ' + str( stats['RMSwtd'][timelev] )
+print '* Minimum error = ' + str( stats['min'][timelev] )
+print '* Maximum error = ' + str( stats['max'][timelev] )
+print '* Mean error = ' + str( stats['mean'][timelev] )
+print '* Median error = ' + str( stats['median'][timelev] )
+print '* Mean absolute error = ' + str( stats['MAE'][timelev] )
+print '* Median absolute error = ' + str( stats['medianAbs'][timelev] )
+print '* RMS error by ring (every ' + str(options.ringWidth) + ' km from the center) = ' + str( run['ringRMS'][timelev] )
 print ''
 
+# Convergence table across the files, from the coarsest to the finest resolution
+if len(runs) > 1:
+  # Compare all files at the model time of the requested time level of the first file
+  compareYears = runs[0]['years'][timelev]
+  runs.sort(key=lambda r: -r['resolution'])
+  tablename = 'halfar_convergence.txt'
+  tablefile = open(tablename, 'w')
+  line = '{:>14} {:>12} {:>12} {:>8} {:>12} {:>8} {:>12} {:>8}  {}'.format('resolution(m)', 'time(yr)', 'RMS', 'order', 'RMSwtd', 'order', 'maxRMS', 'order', 'file')
+  print line
+  tablefile.write('# ' + line + '\n')
+  previous = None
+  for run in runs:
+    index = np.argmin(np.absolute(run['years'] - compareYears))
+    if np.absolute(run['years'][index] - compareYears) > timeTolerance:
+      line = 'skipping ' + run['filename'] + ', which has no output within ' + str(timeTolerance) + ' years of ' + str(compareYears) + ' years.'
+      print 'Warning: ' + line
+      tablefile.write('# ' + line + '\n')
+      continue
+    errors = [run['stats']['RMS'][index], run['stats']['RMSwtd'][index], np.nanmax(run['stats']['RMS'])]
+    if previous is None:
+      orders = [np.nan]*3
+    else:
+      # Observed order of convergence between successive resolutions
+      orders = [np.log(e0/e1) / np.log(previous['resolution']/run['resolution']) for e0, e1 in zip(previous['errors'], errors)]
+    run['errors'] = errors
+    line = '{:14.6g} {:12.6g} {:12.6g} {:8.3f} {:12.6g} {:8.3f} {:12.6g} {:8.3f}  {}'.format(run['resolution'], run['years'][index],
+            errors[0], orders[0], errors[1], orders[1], errors[2], orders[2], run['filename'])
+    print line
+    tablefile.write('  ' + line + '\n')
+    previous = run
+  tablefile.close()
+  print 'Wrote convergence table to ' + tablename + ' (maxRMS is the largest RMS error over all times)\n'
+
 # Plot the results
 fig = plt.figure(1, figsize=(16, 4.5), facecolor='w', dpi=100)
 markersize = 35.0
@@ -151,7 +230,7 @@ plt.scatter(xCell/1000.0,yCell/1000.0,markersize,gray, marker='.', edgecolors='n
 plt.scatter(xCell[maskindices]/1000.0,yCell[maskindices]/1000.0,markersize,thk[timelev,maskindices], marker='h', edgecolors='none')
 plt.colorbar()
 plt.axis('equal')
-plt.title('Modeled thickness (m) \n at time ' + netCDF4.chartostring(xtime)[timelev].strip() ) 
+plt.title('Modeled thickness (m) \n at time ' + netCDF4.chartostring(xtime)[timelev].strip() )
 plt.xlabel('x (km)'); plt.ylabel('y (km)')
 
 fig.add_subplot(1,3,2)
@@ -160,7 +239,7 @@ plt.scatter(xCell/1000.0,yCell/1000.0,markersize,gray, marker='.', edgecolors='n
 plt.scatter(xCell[halmaskindices]/1000.0,yCell[halmaskindices]/1000.0,markersize,thkHalfar[halmaskindices], marker='h', edgecolors='none')
 plt.colorbar()
 plt.axis('equal')
-plt.title('Analytic thickness (m) \n at time ' + netCDF4.chartostring(xtime)[timelev].strip() ) 
+plt.title('Analytic thickness (m) \n at time ' + netCDF4.chartostring(xtime)[timelev].strip() )
 plt.xlabel('x (km)'); plt.ylabel('y (km)')
 
 fig.add_subplot(1,3,3)
@@ -169,7 +248,7 @@ plt.scatter(xCell/1000.0,yCell/1000.0,markersize,thkDiff, marker='h', edgecolors
 plt.colorbar()
 plt.clim([-1.0*np.absolute(thkDiff).max(), np.absolute(thkDiff).max()])
 plt.axis('equal')
-plt.title('Modeled thickness - Analytic thickness (m) \n at time ' + netCDF4.chartostring(xtime)[timelev].strip() ) 
+plt.title('Modeled thickness - Analytic thickness (m) \n at time ' + netCDF4.chartostring(xtime)[timelev].strip() )
 plt.xlabel('x (km)'); plt.ylabel('y (km)')
 
 plt.draw()
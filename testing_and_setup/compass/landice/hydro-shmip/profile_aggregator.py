@@ -0,0 +1,110 @@
+"""
+Group-by statistics (mean, min, max, sum, percentiles) of MPAS fields over
+groups of cells or edges, shared by the hydro-SHMIP visualization scripts.
+
+A ProfileGrouping is built once from the key of each element (e.g. xCell for
+profiles along x) and then reduces any number of fields, each of shape
+(nElements,) or (nTime, nElements), to one value per group (and time).  The
+elements are gathered in group order once, so each statistic is a single
+reduceat over the sorted elements instead of a boolean mask per group.
+"""
+
+import numpy as np
+
+
+class ProfileGrouping(object):
+
+    def __init__(self, keys, include=None):
+        '''
+        keys = group key (e.g. x-position) of each element
+        include = optional boolean array, False for elements left out of all
+                  groups
+        '''
+        keys = np.asarray(keys)
+        self.nElements = len(keys)
+        elements = np.arange(self.nElements)
+        if include is not None:
+            elements = elements[np.asarray(include, dtype=bool)]
+
+        # values are the unique keys (sorted), and groupIndex the group of
+        # each included element
+        self.values, groupIndex = np.unique(keys[elements],
+                                            return_inverse=True)
+        groupIndex = groupIndex.ravel()
+        self.nGroups = len(self.values)
+        self.counts = np.bincount(groupIndex, minlength=self.nGroups)
+
+        # included elements in group order, and where each group starts
+        order = np.argsort(groupIndex, kind='mergesort')
+        self.elements = elements[order]
+        self.groupIndex = groupIndex[order]
+        self.starts = np.concatenate(([0], np.cumsum(self.counts)[:-1]))
+
+    def gather(self, field):
+        '''
+        Return the included elements of field (last axis) in group order.
+        '''
+        field = np.asarray(np.ma.filled(field, np.nan), dtype=np.float64)
+        if field.shape[-1] != self.nElements:
+            raise ValueError('Field has {} elements along its last axis, '
+                             'expected {}'.format(field.shape[-1],
+                                                  self.nElements))
+        return field[..., self.elements]
+
+    def _reduce(self, ufunc, field):
+        # reduceat gives wrong results for empty groups, but np.unique only
+        # makes groups that have elements
+        return ufunc.reduceat(self.gather(field), self.starts, axis=-1)
+
+    def sum(self, field):
+        return self._reduce(np.add, field)
+
+    def mean(self, field):
+        return self.sum(field) / self.counts
+
+    def min(self, field):
+        return self._reduce(np.minimum, field)
+
+    def max(self, field):
+        return self._reduce(np.maximum, field)
+
+    def percentile(self, field, q):
+        '''
+        Return the q-th percentile(s) of each group, with linear
+        interpolation as in np.percentile.  If q is a sequence, the
+        percentiles are along a new first axis.
+        '''
+        values = self.gather(field)
+        groupIndex = np.broadcast_to(self.groupIndex, values.shape)
+        # sort values within each group (groups stay in place)
+        order = np.lexsort((values, groupIndex), axis=-1)
+        values = np.take_along_axis(values, order, axis=-1)
+
+        q = np.asarray(q, dtype=np.float64)
+        position = (q[..., np.newaxis] / 100.0) * (self.counts - 1)
+        below = np.floor(position).astype(int)
+        above = np.minimum(below + 1, self.counts - 1)
+        weight = position - below
+        lower = values[..., self.starts + below]
+        upper = values[..., self.starts + above]
+        result = lower + weight * (upper - lower)
+        if q.ndim > 0 and values.ndim > 1:
+            # put the percentiles before the time axis
+            result = np.moveaxis(result, -2, 0)
+        return result
+
+    def stats(self, field, percentiles=()):
+        '''
+        Return a dictionary with the mean, min and max (and the percentiles
+        given, with keys like 'p25') of each group.
+        '''
+        values = self.gather(field)
+        result = {'mean': np.add.reduceat(values, self.starts, axis=-1) /
+                  self.counts,
+                  'min': np.minimum.reduceat(values, self.starts, axis=-1),
+                  'max': np.maximum.reduceat(values, self.starts, axis=-1)}
+        if len(percentiles) > 0:
+            values = self.percentile(field, percentiles)
+            for i in range(len(percentiles)):
+                result['p{:g}'.format(percentiles[i])] = values[i]
+        return result
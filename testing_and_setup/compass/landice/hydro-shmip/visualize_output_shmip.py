@@ -14,6 +14,7 @@ from matplotlib import cm
 # from matplotlib.contour import QuadContourSet
 # import time
 import random
+from profile_aggregator import ProfileGrouping
 
 secInYr = 3600.0 * 24.0 * 365.0  # Note: this may be slightly wrong for some calendar types!
 
@@ -78,24 +79,22 @@ ind = np.nonzero(yCell[:] == centerY)
 x = xCell[ind]/1000.0
 
 # calculate mean,min,max for all x values for needed variables
-allx=np.unique(xCell[:])  # list of all unique x values
+# Note: the q grouping excludes the north and south rows.
+# They have unrealistic values after interpolation to cell centers
+# because of the no flow lateral b.c.
 middley = np.unique(yCell[:])[1:-1]  # list of all unique y values, excluding the values on the north and south edges
-N_mean = np.zeros(allx.shape)
-N_min = np.zeros(allx.shape)
-N_max = np.zeros(allx.shape)
-q_mean = np.zeros(allx.shape)
-q_min = np.zeros(allx.shape)
-q_max = np.zeros(allx.shape)
-for i in range(len(allx)):
-    N_mean[i] = N[ xCell == allx[i] ].mean()
-    N_min[i] = N[ xCell == allx[i] ].min()
-    N_max[i] = N[ xCell == allx[i] ].max()
-    # Note: the second logical condition excludes the north and south rows.
-    # They have unrealistic values after interpolation to cell centers
-    # because of the no flow lateral b.c.
-    q_mean[i] = q[ np.logical_and(xCell == allx[i], np.in1d(yCell, middley) ) ].mean()
-    q_min[i] = q[ np.logical_and(xCell == allx[i], np.in1d(yCell, middley) ) ].min()
-    q_max[i] = q[ np.logical_and(xCell == allx[i], np.in1d(yCell, middley) ) ].max()
+xGroups = ProfileGrouping(xCell)
+xGroupsMiddle = ProfileGrouping(xCell, include=np.in1d(yCell, middley))
+allx = xGroups.values  # list of all unique x values
+allxMiddle = xGroupsMiddle.values
+N_stats = xGroups.stats(N)
+N_mean = N_stats['mean']
+N_min = N_stats['min']
+N_max = N_stats['max']
+q_stats = xGroupsMiddle.stats(q)
+q_mean = q_stats['mean']
+q_min = q_stats['min']
+q_max = q_stats['max']
 
 print "start plotting."
 
@@ -234,9 +233,9 @@ plt.legend(loc='best')
 # panel 2: sheet flux
 plt.sca(ax2)
 #plt.plot(x, np.absolute(h[ind] * u[ind]), '.-g') # this plots centerline profile
-plt.plot(allx/1000.0, np.absolute(q_mean), '-b', label='MPAS mean/range')
-plt.plot(allx/1000.0, np.absolute(q_min), '--b')
-plt.plot(allx/1000.0, np.absolute(q_max), '--b')
+plt.plot(allxMiddle/1000.0, np.absolute(q_mean), '-b', label='MPAS mean/range')
+plt.plot(allxMiddle/1000.0, np.absolute(q_min), '--b')
+plt.plot(allxMiddle/1000.0, np.absolute(q_max), '--b')
 
 plt.xlabel('X-position (km)')
 plt.ylabel('sheet water flux (m^2/s)')
@@ -247,13 +246,10 @@ plt.legend(loc='best')
 plt.sca(ax3)
 try:
    channelDischarge = f.variables['channelDischarge'][time_slice,:]
-   allxEdge=np.unique(xEdge[:])
-   allxEdge2=100000.0 - (allxEdge - 100000.0)
-   Q_max = np.zeros(allxEdge.shape)
-   Q_sum = np.zeros(allxEdge.shape)
-   for i in range(len(allxEdge)):
-     Q_max[i] = np.absolute(channelDischarge[ xEdge == allxEdge[i] ]).max()
-     Q_sum[i] = np.absolute(channelDischarge[ xEdge == allxEdge[i] ]).sum()
+   xEdgeGroups = ProfileGrouping(xEdge)
+   allxEdge = xEdgeGroups.values
+   Q_max = xEdgeGroups.max(np.absolute(channelDischarge))
+   Q_sum = xEdgeGroups.sum(np.absolute(channelDischarge))
 
    plt.plot(allxEdge/1000.0, np.absolute(Q_max), 'bo', label='MPAS max')
    plt.plot(allxEdge/1000.0, np.absolute(Q_sum), 'bx', label='MPAS sum')
@@ -17,6 +17,7 @@ import matplotlib.pyplot as plt
 #from matplotlib import cm
 # import time
 import random
+from profile_aggregator import ProfileGrouping
 
 
 parser = OptionParser()
@@ -60,7 +61,8 @@ class DailyData:
         N = f.variables['effectivePressure']
         Q = f.variables['channelDischarge']
 
-        indIce = np.where(h[0,:]>0.0)
+        # a single group with all ice-covered cells
+        iceGroup = ProfileGrouping(np.zeros((nCells,)), include=h[0,:]>0.0)
 
         # identify needed days/indices
         lastFullDay = np.floor(days).max() - 1
@@ -87,22 +89,24 @@ class DailyData:
                print "Error: Day {} does not have 24 time levels in it.".format(thisDay)
                print len(todayInd)
 
-            for hr in range(len(todayInd)):  # loop through hours on this day
-               N_now = N[todayInd[0]+hr, :]
-               h_now = h[todayInd[0]+hr, :]
-               Q_now = Q[todayInd[0]+hr, :]
-               bigQ = np.where(Q_now>0.01)
+            # all hours of this day at once
+            hrs = slice(todayInd[0], todayInd[0]+len(todayInd))
+            nhr = len(todayInd)
+            Q_now = Q[hrs, :]
+            bigQ = Q_now>0.01
 
-               self.h_mean[hr,i] = h_now[indIce].mean()
-               self.h_min[hr,i] = h_now[indIce].min()
-               self.h_max[hr,i] = h_now[indIce].max()
+            h_stats = iceGroup.stats(h[hrs, :])
+            self.h_mean[:nhr,i] = h_stats['mean'][:,0]
+            self.h_min[:nhr,i] = h_stats['min'][:,0]
+            self.h_max[:nhr,i] = h_stats['max'][:,0]
 
-               self.N_mean[hr,i] = N_now[indIce].mean()
-               self.N_min[hr,i] = N_now[indIce].min()
-               self.N_max[hr,i] = N_now[indIce].max()
+            N_stats = iceGroup.stats(N[hrs, :])
+            self.N_mean[:nhr,i] = N_stats['mean'][:,0]
+            self.N_min[:nhr,i] = N_stats['min'][:,0]
+            self.N_max[:nhr,i] = N_stats['max'][:,0]
 
-               self.Q_max[hr,i] = Q_now.max()
-               self.Q_mean[hr,i] = Q_now[bigQ].mean()
+            self.Q_max[:nhr,i] = Q_now.max(axis=1)
+            self.Q_mean[:nhr,i] = np.where(bigQ, Q_now, 0.0).sum(axis=1) / bigQ.sum(axis=1)
 
 
 # Open file
@@ -19,6 +19,7 @@ from matplotlib import cm
 # from matplotlib.contour import QuadContourSet
 # import time
 import random
+from profile_aggregator import ProfileGrouping
 
 secInYr = 3600.0 * 24.0 * 365.0  # Note: this may be slightly wrong for some calendar types!
 
@@ -70,7 +71,8 @@ class AnnualData:
         N = f.variables['effectivePressure']
         Q = f.variables['channelDischarge']
         
-        indIce = np.where(h[0,:]>0.0)
+        # a single group with all ice-covered cells
+        iceGroup = ProfileGrouping(np.zeros((nCells,)), include=h[0,:]>0.0)
         
         # calculate mean,min,max for all x values for needed variables
         self.N_mean = np.zeros((nTime,))
@@ -81,22 +83,19 @@ class AnnualData:
         self.h_max = np.zeros((nTime,))
         self.Q_sum = np.zeros((nTime,))
         self.Q_max = np.zeros((nTime,))
-        for i in range(nTime):
-            N_now = N[i,:]
-            h_now = h[i,:]
-            Q_now = np.absolute(Q[i,:])
-            bigQ = np.where(Q_now>0.01)
-        
-            self.h_mean[i] = h_now[indIce].mean()
-            self.h_min[i] = h_now[indIce].min()
-            self.h_max[i] = h_now[indIce].max()
-        
-            self.N_mean[i] = N_now[indIce].mean()
-            self.N_min[i] = N_now[indIce].min()
-            self.N_max[i] = N_now[indIce].max()
-        
-            self.Q_max[i] = Q_now.max()
-            self.Q_sum[i] = Q_now.sum()
+        h_stats = iceGroup.stats(h[:,:])
+        self.h_mean[:] = h_stats['mean'][:,0]
+        self.h_min[:] = h_stats['min'][:,0]
+        self.h_max[:] = h_stats['max'][:,0]
+
+        N_stats = iceGroup.stats(N[:,:])
+        self.N_mean[:] = N_stats['mean'][:,0]
+        self.N_min[:] = N_stats['min'][:,0]
+        self.N_max[:] = N_stats['max'][:,0]
+
+        Q_all = np.absolute(Q[:,:])
+        self.Q_max[:] = Q_all.max(axis=1)
+        self.Q_sum[:] = Q_all.sum(axis=1)
       
      
 # Create objects for each year
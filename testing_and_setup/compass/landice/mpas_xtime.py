@@ -0,0 +1,182 @@
+"""
+Decoding of MPAS xtime character arrays ('YYYY-MM-DD_hh:mm:ss') into numeric
+dates and times, shared by the landice analysis scripts.
+
+The characters are decoded with array operations on their byte values, so all
+time records are decoded at once, without building a string or a datetime
+object for each record.  Years may have any number of digits (long runs go
+past year 9999).  Elapsed times honor the model calendar: 'noleap' (the
+default, also 'gregorian_noleap' or '365_day') or 'gregorian'
+('proleptic_gregorian').
+
+read_xtime() decodes the xtime variable of a file and caches the result, both
+in memory and in a hidden file next to the netCDF file
+('.<file name>.<variable>.npz'), so the next script to read the same
+(unchanged) file doesn't decode it again.
+"""
+
+import os
+import numpy as np
+import netCDF4
+
+secInDay = 3600.0 * 24.0
+secInYr = secInDay * 365.0  # length of a year in the noleap calendar
+
+# Day of the year (0-based) on which each month starts, in the noleap calendar
+noleapMonthStart = np.array([0, 31, 59, 90, 120, 151, 181, 212, 243, 273,
+                             304, 334])
+
+fieldNames = ['year', 'month', 'day', 'hour', 'minute', 'second']
+
+# Position of the first of the two digits of each field after the year,
+# relative to the '-' that ends the year
+fieldOffsets = {'month': 1, 'day': 4, 'hour': 7, 'minute': 10, 'second': 13}
+
+# Decoded xtime fields, by (file path, variable name), along with the
+# modification time and size of the file when it was decoded
+xtime_cache = dict()
+
+
+def xtime_bytes(xtime):
+    """
+    Return the byte values of an xtime array as a 2D uint8 array with one row
+    per record.  xtime may be a character array (as read from a netCDF file)
+    or an array of strings.
+    """
+    xtime = np.ma.filled(xtime, b' ') if np.ma.isMaskedArray(xtime) else \
+        np.asarray(xtime)
+    if xtime.dtype.kind == 'U':
+        xtime = np.char.encode(xtime, 'ascii')
+    if xtime.ndim == 1:
+        # strings (or a single character array) become rows of characters
+        if xtime.dtype.itemsize > 1:
+            xtime = xtime.astype('S{}'.format(xtime.dtype.itemsize))
+            return np.frombuffer(xtime.tobytes(), dtype=np.uint8).reshape(
+                (len(xtime), xtime.dtype.itemsize))
+        xtime = xtime.reshape((1, len(xtime)))
+    xtime = np.ascontiguousarray(xtime, dtype='S1')
+    return xtime.view(np.uint8).reshape(xtime.shape)
+
+
+def decode_xtime(xtime):
+    """
+    Decode an xtime array into a dictionary of integer arrays with the year,
+    month, day, hour, minute and second of each record.
+    """
+    codes = xtime_bytes(xtime)
+    nRecords, strLen = codes.shape
+    fields = dict()
+    if nRecords == 0:
+        for name in fieldNames:
+            fields[name] = np.zeros((0,), dtype=np.int64)
+        return fields
+
+    # The year is made of the digits before the first '-', and only the
+    # characters up to the end of the seconds are needed
+    yearEnd = np.argmax(codes == ord('-'), axis=1)
+    strLen = min(strLen, yearEnd.max() + fieldOffsets['second'] + 2)
+    digits = codes[:, :strLen].astype(np.int64) - ord('0')
+    isDigit = np.logical_and(digits >= 0, digits <= 9)
+
+    positions = np.arange(strLen)
+    power = yearEnd[:, np.newaxis] - 1 - positions[np.newaxis, :]
+    inYear = np.logical_and(isDigit, power >= 0)
+    fields['year'] = np.sum(np.where(inYear, digits, 0) *
+                            10**np.maximum(power, 0), axis=1)
+
+    rows = np.arange(nRecords)
+    for name in fieldNames[1:]:
+        first = np.minimum(yearEnd + fieldOffsets[name], strLen - 2)
+        fields[name] = 10*digits[rows, first] + digits[rows, first + 1]
+
+    return fields
+
+
+def days_since_start(fields, calendar='noleap'):
+    """
+    Return the number of days since 0000-01-01 of the date (ignoring the time
+    of day) of each record in fields.
+    """
+    year = fields['year']
+    month = fields['month']
+    day = fields['day']
+
+    if calendar in ['noleap', 'gregorian_noleap', '365_day']:
+        return 365*year + noleapMonthStart[month - 1] + day - 1
+
+    if calendar in ['gregorian', 'proleptic_gregorian', 'standard']:
+        # Days from the civil date, counting years from March so leap days
+        # come last
+        year = year - (month <= 2)
+        era = np.floor_divide(year, 400)
+        yearOfEra = year - 400*era
+        dayOfYear = (153*(month + np.where(month > 2, -3, 9)) + 2)//5 + day - 1
+        dayOfEra = 365*yearOfEra + yearOfEra//4 - yearOfEra//100 + dayOfYear
+        # 0000-03-01 is day 60 of year 0 (a leap year)
+        return 146097*era + dayOfEra + 60
+
+    raise ValueError('Unsupported calendar: {}'.format(calendar))
+
+
+def xtime_seconds(fields, calendar='noleap'):
+    """
+    Return the time in seconds since 0000-01-01_00:00:00 of each record in
+    fields.
+    """
+    days = days_since_start(fields, calendar)
+    return days*secInDay + 3600.0*fields['hour'] + 60.0*fields['minute'] + \
+        fields['second']
+
+
+def xtime_years(fields, calendar='noleap'):
+    """
+    Return the decimal year (in 365-day years since year 0) of each record in
+    fields.
+    """
+    return xtime_seconds(fields, calendar) / secInYr
+
+
+def read_xtime(fileName, varName='xtime', useDiskCache=True):
+    """
+    Return the decoded fields (see decode_xtime) of the variable varName in
+    the netCDF file fileName.  The result is cached until the file changes.
+    """
+    path = os.path.abspath(fileName)
+    status = os.stat(path)
+    stamp = (status.st_mtime, status.st_size)
+    key = (path, varName)
+
+    if key in xtime_cache and xtime_cache[key][0] == stamp:
+        return xtime_cache[key][1]
+
+    cachePath = os.path.join(os.path.dirname(path), '.{}.{}.npz'.format(
+        os.path.basename(path), varName))
+
+    fields = None
+    if useDiskCache and os.path.exists(cachePath):
+        try:
+            cached = np.load(cachePath)
+            if tuple(cached['stamp']) == stamp:
+                fields = dict([(name, cached[name]) for name in fieldNames])
+            cached.close()
+        except (IOError, OSError, ValueError, KeyError):
+            # A corrupt cache is decoded again
+            fields = None
+
+    if fields is None:
+        ncFile = netCDF4.Dataset(path, 'r')
+        fields = decode_xtime(ncFile.variables[varName][:])
+        ncFile.close()
+        if useDiskCache:
+            # Write to a temporary file first, so concurrent scripts never
+            # read a partial cache
+            tempPath = '{}.{}.npz'.format(cachePath[:-4], os.getpid())
+            try:
+                np.savez(tempPath, stamp=np.array(stamp), **fields)
+                os.rename(tempPath, cachePath)
+            except (IOError, OSError):
+                # The cache is optional, so a read-only directory is fine
+                pass
+
+    xtime_cache[key] = (stamp, fields)
+    return fields
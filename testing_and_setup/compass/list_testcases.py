@@ -10,6 +10,13 @@ criteria.
 
 Additionally, if -n is passed in to get information about a single test case,
 it will only print the flags needed to setup that specific test case.
+
+The test cases are kept in an index file (.testcase_index/index.json in the
+directory of this script) along with the modification times of the
+directories they were found in. Only directories that changed since the index
+was written are listed again, so most calls don't need to walk the whole
+tree. The --json flag prints the (filtered) test cases in JSON format, for use
+by other scripts.
 """
 
 from __future__ import absolute_import, division, print_function, \
@@ -18,21 +25,27 @@ from __future__ import absolute_import, division, print_function, \
 import os
 import fnmatch
 import argparse
-import xml.etree.ElementTree as ET
+import json
+from xml_cache import parse_xml
 import re
 
+# The index file is kept in a directory of its own, in the directory of this
+# script, so that writing it doesn't change the modification time of the
+# indexed directory
+index_dir_name = '.testcase_index'
+index_file_name = 'index.json'
+
+# The number of directory levels (core, configuration, resolution and test)
+# below the directory of this script
+index_levels = 4
+
 
 def print_case(quiet, args, core_dir, config_dir, res_dir, test_dir, case_num):
 
     # Print the options if a case file was found.
     if not quiet:
-        if (not args.core) or re.match(args.core, core_dir):
-            if (not args.configuration) or re.match(args.configuration,
-                                                    config_dir):
-                if (not args.resolution) or re.match(args.resolution, res_dir):
-                    if (not args.test) or re.match(args.test, test_dir):
-                        print("  {:d}: -o {} -c {} -r {} -t {}".format(
-                            case_num, core_dir, config_dir, res_dir, test_dir))
+        print("  {:d}: -o {} -c {} -r {} -t {}".format(
+            case_num, core_dir, config_dir, res_dir, test_dir))
     if quiet and case_num == args.number:
         print("-o {} -c {} -r {} -t {}".format(
             core_dir, config_dir, res_dir, test_dir))
@@ -40,6 +53,134 @@ def print_case(quiet, args, core_dir, config_dir, res_dir, test_dir, case_num):
     return case_num
 
 
+def get_test_cases(script_path=None, use_index=True):
+    # Return the (core, configuration, resolution, test) of every test case,
+    # in the order of their case numbers.
+    if script_path is None:
+        script_path = os.path.dirname(os.path.realpath(__file__))
+
+    if not use_index:
+        index, _ = update_index_node(script_path, None, index_levels)
+        return get_index_test_cases(index)
+
+    index_dir = '{}/{}'.format(script_path, index_dir_name)
+    index_path = '{}/{}'.format(index_dir, index_file_name)
+    if not os.path.isdir(index_dir):
+        # Made before the tree is checked, so the directory of this script is
+        # only changed (and listed again) once
+        try:
+            os.mkdir(index_dir)
+        except OSError:
+            # The index is only a cache, so a read-only tree is fine
+            pass
+
+    index = None
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, 'r') as index_file:
+                index = json.load(index_file)
+        except ValueError:
+            # A corrupt index is rebuilt from scratch
+            index = None
+
+    index, changed = update_index_node(script_path, index, index_levels)
+
+    if changed:
+        # Write to a temporary file first, so concurrent calls never read a
+        # partial index
+        temp_path = '{}.{}'.format(index_path, os.getpid())
+        try:
+            with open(temp_path, 'w') as index_file:
+                json.dump(index, index_file)
+            os.rename(temp_path, index_path)
+        except (IOError, OSError):
+            # The index is only a cache, so a read-only tree is fine
+            pass
+
+    return get_index_test_cases(index)
+
+
+def update_index_node(path, node, levels):
+    # Bring the index node of the directory at path up to date, and return it
+    # and whether anything changed. levels is the number of directory levels
+    # below path down to the tests. A directory is only listed again if its
+    # modification time changed (its entries were added, removed or renamed);
+    # otherwise the subdirectories from the index are checked in turn.
+    mtime = os.path.getmtime(path)
+    changed = node is None or node['mtime'] != mtime
+
+    if levels == 0:
+        if not changed:
+            return node, False
+        return {'mtime': mtime, 'is_test': is_test_case(path)}, True
+
+    if changed:
+        old_children = dict() if node is None else node['children']
+        names = list()
+        for name in os.listdir(path):
+            if levels == index_levels and name in ['.git', index_dir_name]:
+                continue
+            if os.path.isdir('{}/{}'.format(path, name)):
+                names.append(name)
+    else:
+        old_children = node['children']
+        names = list(old_children.keys())
+
+    children = dict()
+    for name in names:
+        child_path = '{}/{}'.format(path, name)
+        try:
+            child, child_changed = update_index_node(
+                child_path, old_children.get(name), levels - 1)
+        except OSError:
+            # The directory was removed after its parent was listed
+            changed = True
+            continue
+        children[name] = child
+        changed = changed or child_changed
+
+    return {'mtime': mtime, 'children': children}, changed
+
+
+def get_index_test_cases(node, parents=()):
+    # The test cases below an index node, in the order of their case numbers.
+    if 'children' not in node:
+        if node['is_test']:
+            return [parents]
+        return []
+
+    test_cases = list()
+    for name in sorted(node['children'].keys()):
+        test_cases.extend(get_index_test_cases(node['children'][name],
+                                               parents + (name,)))
+    return test_cases
+
+
+def filter_test_cases(test_cases, core=None, configuration=None,
+                      resolution=None, test=None, number=None):
+    # Return the (case number, test case) pairs of the test cases that match
+    # all of the given regular expressions and case number.
+    patterns = [core, configuration, resolution, test]
+    matches = list()
+    for case_num, test_case in enumerate(test_cases, start=1):
+        if number is not None and case_num != number:
+            continue
+        if all([pattern is None or re.match(pattern, name)
+                for pattern, name in zip(patterns, test_case)]):
+            matches.append((case_num, test_case))
+    return matches
+
+
+def is_test_case(test_path):
+    # A test case has a config file or a driver_script file.
+    for case_file in sorted(os.listdir(test_path)):
+        if fnmatch.fnmatch(case_file, '*.xml'):
+            root = parse_xml('{}/{}'.format(test_path, case_file))
+            if root.tag == 'config' or root.tag == 'driver_script':
+                return True
+    return False
+
+
 if __name__ == "__main__":
     # Define and process input arguments
     parser = argparse.ArgumentParser(
@@ -57,58 +198,39 @@ if __name__ == "__main__":
     parser.add_argument("-n", "--number", dest="number", type=int,
                         help="If set, script will print the flags to use a "
                              "the N'th configuration.")
+    parser.add_argument("--json", dest="json", action="store_true",
+                        help="If set, print the test cases as a JSON list "
+                             "of objects with their number, core, "
+                             "configuration, resolution and test.")
+    parser.add_argument("--no_index", dest="no_index", action="store_true",
+                        help="If set, walk the directory tree rather than "
+                             "using (and updating) the test case index.")
 
     args = parser.parse_args()
 
     quiet = args.number is not None
 
-    if not quiet:
-        print("Available test cases are:")
-
-    # Start case numbering at 1
-    case_num = 1
-
-    script_path = os.path.dirname(os.path.realpath(__file__))
-    os.chdir(script_path)
-
-    # Iterate over all cores
-    for core_dir in sorted(os.listdir('.')):
-        if os.path.isdir(core_dir) and core_dir != '.git':
-            # Iterate over all configurations within a core
-            for config_dir in sorted(os.listdir(core_dir)):
-                config_path = '{}/{}'.format(core_dir, config_dir)
-                if os.path.isdir(config_path):
-                    # Iterate over all resolutions within a configuration
-                    for res_dir in sorted(os.listdir(config_path)):
-                        res_path = '{}/{}'.format(config_path, res_dir)
-                        if os.path.isdir(res_path):
-                            # Iterate over all tests within a resolution
-                            for test_dir in sorted(os.listdir(res_path)):
-                                test_path = '{}/{}'.format(res_path, test_dir)
-                                if os.path.isdir(test_path):
-                                    do_print = False
-                                    # Iterate over all files within a test
-                                    for case_file in sorted(
-                                            os.listdir(test_path)):
-                                        if fnmatch.fnmatch(case_file, '*.xml'):
-                                            tree = ET.parse('{}/{}'.format(
-                                                test_path, case_file))
-                                            root = tree.getroot()
-
-                                            # Check to make sure the test is
-                                            # either a config file or a
-                                            # driver_script file
-                                            if root.tag == 'config' or \
-                                                    root.tag == \
-                                                    'driver_script':
-                                                do_print = True
-
-                                            del root
-                                            del tree
-
-                                    if do_print:
-                                        case_num = print_case(
-                                            quiet, args, core_dir, config_dir,
-                                            res_dir, test_dir, case_num)
+    test_cases = get_test_cases(use_index=not args.no_index)
+
+    if quiet:
+        # -n ignores the other filters
+        matches = filter_test_cases(test_cases, number=args.number)
+    else:
+        matches = filter_test_cases(test_cases, args.core, args.configuration,
+                                    args.resolution, args.test)
+
+    if args.json:
+        print(json.dumps([{'number': case_num, 'core': test_case[0],
+                           'configuration': test_case[1],
+                           'resolution': test_case[2], 'test': test_case[3]}
+                          for case_num, test_case in matches], indent=1))
+    else:
+        if not quiet:
+            print("Available test cases are:")
+
+        for case_num, test_case in matches:
+            core_dir, config_dir, res_dir, test_dir = test_case
+            print_case(quiet, args, core_dir, config_dir, res_dir, test_dir,
+                       case_num)
 
 # vim: foldmethod=marker ai ts=4 sts=4 et sw=4 ft=python
@@ -6,7 +6,11 @@ test cases that ensure one or more features in a model meet certain criteria.
 Using this script one can setup or clean a regression suite.
 
 When setting up a regression suite, this script will generate a script to run
-all tests in the suite, and additionally setup each individual test case.
+all tests in the suite, and additionally setup each individual test case. By
+default the generated script runs tests one after another. If --max_cores is
+given, the generated script instead treats the suite as a dependency graph
+(using the prerequisites of each test) and runs independent tests
+concurrently, as long as the cores they use fit within the given budget.
 
 When cleaning a regression suite, this script will remove any generated files
 for each individual test case, and the run script that runs all test cases.
@@ -19,24 +23,15 @@ import sys
 import os
 import fnmatch
 import argparse
-import xml.etree.ElementTree as ET
+from xml_cache import parse_xml
 import subprocess
 
+from setup_testcase import build_config, setup_test_cases
 
-def process_test_setup(test_tag, config_file, work_dir, model_runtime,
-                       suite_script, baseline_dir, verbose):  # {{{
 
-    if verbose:
-        stdout = open(work_dir + '/manage_regression_suite.py.out', 'a')
-        stderr = stdout
-        print('     Script setup outputs to {}'.format(
-            work_dir + '/manage_regression_suite.py.out'))
-    else:
-        dev_null = open('/dev/null', 'a')
-        stderr = dev_null
-        stdout = dev_null
-
-    # Process test attributes
+def get_test_attributes(test_tag):  # {{{
+    # Return the name, core, configuration, resolution and test of a <test>
+    # tag.
     try:
         test_name = test_tag.attrib['name']
     except KeyError:
@@ -76,27 +71,33 @@ def process_test_setup(test_tag, config_file, work_dir, model_runtime,
         print("Exiting...")
         sys.exit(1)
 
-    # Determine the file name for the test case output
-    case_output_name = test_name.replace(' ', '_')
+    return test_name, test_core, test_configuration, test_resolution, \
+        test_test
+# }}}
 
-    # Setup test case
 
-    if baseline_dir == 'NONE':
-        subprocess.check_call(
-            ['./setup_testcase.py', '-q', '-f', config_file,
-             '--work_dir', work_dir, '-o', test_core, '-c', test_configuration,
-             '-r', test_resolution, '-t', test_test,  '-m', model_runtime],
-            stdout=stdout, stderr=stderr)
-    else:
-        subprocess.check_call(
-            ['./setup_testcase.py', '-q', '-f', config_file,
-             '--work_dir', work_dir, '-o', test_core, '-c', test_configuration,
-             '-r', test_resolution, '-t', test_test,  '-m', model_runtime,
-             '-b', baseline_dir], stdout=stdout, stderr=stderr)
+def process_test_setup(test_tag, work_dir, suite_script, testcases=None,
+                       max_cores=None):  # {{{
+    # Write the steps to run a test case, which has already been set up, into
+    # the suite script.
+
+    # Process test attributes
+    test_name, test_core, test_configuration, test_resolution, test_test = \
+        get_test_attributes(test_tag)
+
+    # Determine the file name for the test case output
+    case_output_name = test_name.replace(' ', '_')
 
     print("   -- Setup case '{}': -o {} -c {} -r {} -t {}".format(
         test_name, test_core, test_configuration, test_resolution, test_test))
 
+    if max_cores is not None:
+        # Add the test to the dependency graph of the scheduled suite script,
+        # rather than writing serial steps to run it.
+        write_scheduled_test(test_tag, test_name, testcases[test_name],
+                             work_dir, case_output_name, suite_script)
+        return
+
     # Write step into suite script to cd into the base of the regression suite
     suite_script.write("os.chdir(base_path)\n")
 
@@ -140,55 +141,134 @@ def process_test_setup(test_tag, config_file, work_dir, model_runtime,
     # Finish writing test case output
     suite_script.write("case_output.close()\n")
     suite_script.write("\n")
-    if verbose:
-        stdout.close()
-    else:
-        dev_null.close()
 # }}}
 
 
-def process_test_clean(test_tag, work_dir):  # {{{
-    dev_null = open('/dev/null', 'a')
+def write_scheduled_test(test_tag, test_name, testcase, work_dir,
+                         case_output_name, suite_script):  # {{{
+    scripts = list()
+    for script in test_tag:
+        if script.tag == 'script':
+            try:
+                script_name = script.attrib['name']
+            except KeyError:
+                print("ERROR: <script> tag is missing 'name' attribute.")
+                print('Exiting...')
+                sys.exit(1)
+            scripts.append('{}/{}/{}'.format(work_dir, testcase['path'],
+                                             script_name))
 
-    # Process test attributes
-    try:
-        test_name = test_tag.attrib['name']
-    except KeyError:
-        print("ERROR: <test> tag is missing 'name' attribute.")
-        print("Exiting...")
-        sys.exit(1)
+    prereqs = [prereq['name'] for prereq in testcase['prereqs']]
 
-    try:
-        test_core = test_tag.attrib['core']
-    except KeyError:
-        print("ERROR: <test> tag with name '{}' is missing 'core' "
-              "attribute.".format(test_name))
-        print("Exiting...")
-        sys.exit(1)
+    suite_script.write("tests[{!r}] = {{\n".format(test_name))
+    suite_script.write("    'case_output': 'case_outputs/{}',\n".format(
+        case_output_name))
+    suite_script.write("    'path': '{}/{}',\n".format(work_dir,
+                                                       testcase['path']))
+    suite_script.write("    'scripts': {!r},\n".format(scripts))
+    suite_script.write("    'cores': {:d},\n".format(
+        testcase['procs'] * testcase['threads']))
+    suite_script.write("    'prereqs': {!r}}}\n".format(prereqs))
+    suite_script.write("\n")
+# }}}
 
-    try:
-        test_configuration = test_tag.attrib['configuration']
-    except KeyError:
-        print("ERROR: <test> tag with name '{}' is missing 'configuration' "
-              "attribute.".format(test_name))
-        print("Exiting...")
-        sys.exit(1)
 
-    try:
-        test_resolution = test_tag.attrib['resolution']
-    except KeyError:
-        print("ERROR: <test> tag with name '{}' is missing 'resolution' "
-              "attribute.".format(test_name))
-        print("Exiting...")
-        sys.exit(1)
+def write_suite_scheduler(suite_script, max_cores):  # {{{
+    # Write a scheduler that launches each test once all of its prerequisites
+    # have passed, as long as its cores fit in the remaining budget. A test
+    # that requests more cores than the budget runs on its own.
+    suite_script.write("max_cores = {:d}\n".format(max_cores))
+    suite_script.write("free_cores = max_cores\n")
+    suite_script.write("pending = list(tests.keys())\n")
+    suite_script.write("running = dict()\n")
+    suite_script.write("passed = dict()\n")
+    suite_script.write("\n")
+    suite_script.write("\n")
+    suite_script.write("def launch(name, script_index):\n")
+    suite_script.write("    test = tests[name]\n")
+    suite_script.write("    if script_index == 0:\n")
+    suite_script.write("        test['output'] = open(os.path.join("
+                       "base_path, test['case_output']), 'w')\n")
+    suite_script.write("    print(' ** Running case {}'.format(name))\n")
+    suite_script.write("    process = subprocess.Popen(\n")
+    suite_script.write("        ['time', '-p', test['scripts']"
+                       "[script_index]], cwd=test['path'],\n")
+    suite_script.write("        stdout=test['output'], "
+                       "stderr=test['output'])\n")
+    suite_script.write("    running[name] = (process, script_index)\n")
+    suite_script.write("\n")
+    suite_script.write("\n")
+    suite_script.write("def finish(name, success):\n")
+    suite_script.write("    global free_cores\n")
+    suite_script.write("    test = tests[name]\n")
+    suite_script.write("    test['output'].close()\n")
+    suite_script.write("    free_cores += min(test['cores'], max_cores)\n")
+    suite_script.write("    passed[name] = success\n")
+    suite_script.write("    if success:\n")
+    suite_script.write("        print('      PASS {}'.format(name))\n")
+    suite_script.write("    else:\n")
+    suite_script.write("        print('   ** FAIL {} (See {} for more "
+                       "information)'.format(\n")
+    suite_script.write("            name, test['case_output']))\n")
+    suite_script.write("\n")
+    suite_script.write("\n")
+    suite_script.write("while pending or running:\n")
+    suite_script.write("    # Launch every pending test whose prerequisites "
+                       "are done and that fits\n")
+    suite_script.write("    for name in list(pending):\n")
+    suite_script.write("        test = tests[name]\n")
+    suite_script.write("        if any(passed.get(prereq) is False for "
+                       "prereq in test['prereqs']):\n")
+    suite_script.write("            print('   ** FAIL {} (prerequisite "
+                       "failed, not run)'.format(name))\n")
+    suite_script.write("            passed[name] = False\n")
+    suite_script.write("            pending.remove(name)\n")
+    suite_script.write("            test_failed = True\n")
+    suite_script.write("            continue\n")
+    suite_script.write("        if not all(prereq in passed for prereq in "
+                       "test['prereqs']):\n")
+    suite_script.write("            continue\n")
+    suite_script.write("        cores = min(test['cores'], max_cores)\n")
+    suite_script.write("        if cores > free_cores:\n")
+    suite_script.write("            continue\n")
+    suite_script.write("        pending.remove(name)\n")
+    suite_script.write("        if len(test['scripts']) == 0:\n")
+    suite_script.write("            passed[name] = True\n")
+    suite_script.write("            continue\n")
+    suite_script.write("        free_cores -= cores\n")
+    suite_script.write("        launch(name, 0)\n")
+    suite_script.write("\n")
+    suite_script.write("    if not running:\n")
+    suite_script.write("        continue\n")
+    suite_script.write("\n")
+    suite_script.write("    time.sleep(1)\n")
+    suite_script.write("\n")
+    suite_script.write("    # Collect finished scripts, moving on to the "
+                       "next script of each test\n")
+    suite_script.write("    for name in list(running.keys()):\n")
+    suite_script.write("        process, script_index = running[name]\n")
+    suite_script.write("        returncode = process.poll()\n")
+    suite_script.write("        if returncode is None:\n")
+    suite_script.write("            continue\n")
+    suite_script.write("        del running[name]\n")
+    suite_script.write("        if returncode != 0:\n")
+    suite_script.write("            finish(name, False)\n")
+    suite_script.write("            test_failed = True\n")
+    suite_script.write("        elif script_index + 1 < "
+                       "len(tests[name]['scripts']):\n")
+    suite_script.write("            launch(name, script_index + 1)\n")
+    suite_script.write("        else:\n")
+    suite_script.write("            finish(name, True)\n")
+    suite_script.write("\n")
+# }}}
 
-    try:
-        test_test = test_tag.attrib['test']
-    except KeyError:
-        print("ERROR: <test> tag with name '{}' is missing 'test' "
-              "attribute.".format(test_name))
-        print("Exiting...")
-        sys.exit(1)
+
+def process_test_clean(test_tag, work_dir):  # {{{
+    dev_null = open('/dev/null', 'a')
+
+    # Process test attributes
+    test_name, test_core, test_configuration, test_resolution, test_test = \
+        get_test_attributes(test_tag)
 
     # Clean test case
     subprocess.check_call(
@@ -204,8 +284,28 @@ def process_test_clean(test_tag, work_dir):  # {{{
 # }}}
 
 
+def setup_suite_test_cases(suite_tag, work_dir, model_runtime, config_file,
+                           baseline_dir, output_file, jobs):  # {{{
+    # Set up all test cases of the suite in this process, through the
+    # setup_testcase.py functions, with up to jobs test cases at once.
+    test_cases = list()
+    for child in suite_tag:
+        if child.tag == 'test':
+            test_cases.append(get_test_attributes(child)[1:])
+
+    config = build_config(config_file, work_dir, model_runtime, baseline_dir)
+    _, errors = setup_test_cases(config, test_cases, jobs, output_file)
+
+    if len(errors) > 0:
+        for error in errors:
+            print("ERROR: {}".format(error))
+        print("Exiting...")
+        sys.exit(1)
+# }}}
+
+
 def setup_suite(suite_tag, work_dir, model_runtime, config_file, baseline_dir,
-                verbose):
+                verbose, testcases=None, max_cores=None, jobs=1):
     # {{{
     try:
         suite_name = suite_tag.attrib['name']
@@ -231,6 +331,9 @@ def setup_suite(suite_tag, work_dir, model_runtime, config_file, baseline_dir,
     regression_script.write('import sys\n')
     regression_script.write('import os\n')
     regression_script.write('import subprocess\n')
+    if max_cores is not None:
+        regression_script.write('import time\n')
+        regression_script.write('import collections\n')
     regression_script.write('import numpy as np\n')
     regression_script.write('\n')
     regression_script.write("os.environ['PYTHONUNBUFFERED'] = '1'\n")
@@ -240,16 +343,29 @@ def setup_suite(suite_tag, work_dir, model_runtime, config_file, baseline_dir,
     regression_script.write("    os.makedirs('case_outputs')\n")
     regression_script.write('\n')
     regression_script.write("base_path = '{}'\n".format(work_dir))
+    if max_cores is not None:
+        regression_script.write("tests = collections.OrderedDict()\n")
+        regression_script.write('\n')
 
     if verbose:
         # flush existing regression suite output file
-        open(work_dir + '/manage_regression_suite.py.out', 'w').close()
+        output_file = work_dir + '/manage_regression_suite.py.out'
+        open(output_file, 'w').close()
+        print('     Script setup outputs to {}'.format(output_file))
+    else:
+        output_file = '/dev/null'
+
+    setup_suite_test_cases(suite_tag, work_dir, model_runtime, config_file,
+                           baseline_dir, output_file, jobs)
 
     for child in suite_tag:
         # Process <test> tags within the test suite
         if child.tag == 'test':
-            process_test_setup(child, config_file, work_dir, model_runtime,
-                               regression_script, baseline_dir, verbose)
+            process_test_setup(child, work_dir, regression_script, testcases,
+                               max_cores)
+
+    if max_cores is not None:
+        write_suite_scheduler(regression_script, max_cores)
 
     regression_script.write("print('TEST RUNTIMES:')\n")
     regression_script.write("case_output = '/case_outputs/'\n")
@@ -356,8 +472,7 @@ def get_test_case_procs(suite_tag):  # {{{
             test_path = '{}/{}/{}/{}'.format(test_core, test_configuration,
                                              test_resolution, test_test)
             driver_path = '{}/config_driver.xml'.format(test_path)
-            config_tree = ET.parse(driver_path)
-            config_root = config_tree.getroot()
+            config_root = parse_xml(driver_path)
 
             cases = []
             assert(config_root.tag == 'driver_script')
@@ -391,7 +506,6 @@ def get_test_case_procs(suite_tag):  # {{{
                 prereqs.append(prereq)
 
             del config_root
-            del config_tree
 
             procs = 1
             threads = 1
@@ -401,27 +515,27 @@ def get_test_case_procs(suite_tag):  # {{{
                     # Build full file name
                     config_file = '{}/{}'.format(test_path, file)
 
-                    config_tree = ET.parse(config_file)
-                    config_root = config_tree.getroot()
+                    config_root = parse_xml(config_file)
 
                     if config_root.tag == 'config':
                         case = config_root.attrib['case']
                         if case in cases:
+                            # The test needs as many cores as its largest
+                            # model run
                             for model_run in config_root.iter('model_run'):
                                 try:
                                     procs_str = model_run.attrib['procs']
-                                    procs = int(procs_str)
+                                    procs = max(procs, int(procs_str))
                                 except (KeyError, ValueError):
-                                    procs = 1
+                                    pass
 
                                 try:
                                     threads_str = model_run.attrib['threads']
-                                    threads = int(threads_str)
+                                    threads = max(threads, int(threads_str))
                                 except (KeyError, ValueError):
-                                    threads = 1
+                                    pass
 
                     del config_root
-                    del config_tree
             testcases[test_name] = {'core': test_core,
                                     'configuration': test_configuration,
                                     'resolution': test_resolution,
@@ -485,6 +599,15 @@ def main ():  # {{{
                         help="If set, script will setup the test suite in "
                         "work_dir rather in this script's location.",
                         metavar="PATH")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=1,
+                        help="Number of test cases to set up at once. Test "
+                             "cases with the same core, configuration and "
+                             "resolution are always set up one after the "
+                             "other.", metavar="NUM")
+    parser.add_argument("--max_cores", dest="max_cores", type=int,
+                        help="If set, the generated suite script runs "
+                             "independent tests concurrently, using at most "
+                             "this many cores at once.", metavar="NUM")
 
     args = parser.parse_args()
 
@@ -512,6 +635,12 @@ def main ():  # {{{
     if not args.baseline_dir:
         args.baseline_dir = 'NONE'
 
+    if args.jobs < 1:
+        parser.error("--jobs must be a positive number of test cases.")
+
+    if args.max_cores is not None and args.max_cores < 1:
+        parser.error("--max_cores must be a positive number of cores.")
+
     if not args.setup and not args.clean:
         print('WARNING: Neither the setup (-s/--setup) nor the clean '
               '(-c/--clean) flags were provided. Script will perform no '
@@ -520,8 +649,7 @@ def main ():  # {{{
     write_history = False
 
     # Parse regression_suite file
-    suite_tree = ET.parse(args.test_suite)
-    suite_root = suite_tree.getroot()
+    suite_root = parse_xml(args.test_suite)
 
     # If the file was a <regression_suite> file, process it
     if suite_root.tag == 'regression_suite':
@@ -536,7 +664,8 @@ def main ():  # {{{
             print("Setting Up Test Cases:")
             testcases = get_test_case_procs(suite_root)
             setup_suite(suite_root, args.work_dir, args.model_runtime,
-                        args.config_file, args.baseline_dir, args.verbose)
+                        args.config_file, args.baseline_dir, args.verbose,
+                        testcases, args.max_cores, args.jobs)
             summarize_suite(testcases)
             if args.verbose:
                 cmd = ['cat',
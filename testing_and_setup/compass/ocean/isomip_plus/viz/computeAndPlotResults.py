@@ -3,12 +3,106 @@
 import argparse
 import os
 import subprocess
-import glob
+import multiprocessing
+import time
+
+from netCDF4 import Dataset
+
+# the plots made by plotResults.py and the movies (frame prefixes) of each
+plotPrefixes = [('bsf', ['bsf']),
+                ('meltRate', ['meltRate']),
+                ('oceanHeatFlux', ['oceanHeatFlux']),
+                ('iceHeatFlux', ['iceHeatFlux']),
+                ('thermalDriving', ['thermalDriving']),
+                ('halineDriving', ['halineDriving']),
+                ('fricVel', ['fricVel']),
+                ('Temp', ['topTemp', 'botTemp', 'centerTemp']),
+                ('Salinity', ['topSalinity', 'botSalinity', 'centerSalinity']),
+                ('LayerThickness', ['topLayerThickness', 'botLayerThickness',
+                                    'centerLayerThickness']),
+                ('deltaSSH', ['deltaSSH']),
+                ('Vx', ['topVx', 'botVx', 'centerVx']),
+                ('Vy', ['topVy', 'botVy', 'centerVy']),
+                ('osf', ['osf'])]
+
+def getTimeCount(folder):
+    # the number of time indices plotResults.py will plot
+    nTime = None
+    for fileName in ['output.nc', 'barotropicStreamfunction.nc',
+                     'overturningStreamfunction.nc']:
+        filePath = '%s/%s'%(folder, fileName)
+        if not os.path.exists(filePath):
+            continue
+        inFile = Dataset(filePath, 'r')
+        count = len(inFile.dimensions['Time'])
+        inFile.close()
+        if nTime is None or count < nTime:
+            nTime = count
+    return nTime
+
+def runTasks(tasks, jobs):
+    # Run the tasks (dicts with 'args', 'log' and 'name') with at most jobs
+    # processes at a time. Once all render tasks of a plot have finished, the
+    # encode tasks of its movies are queued, so encoding overlaps with the
+    # rendering of other plots.
+    pending = list(tasks)
+    running = []
+    remaining = {}
+    for task in tasks:
+        remaining[task['plot']] = remaining.get(task['plot'], 0) + 1
+    failed = False
+
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < jobs:
+            task = pending.pop(0)
+            print 'running %s'%' '.join(task['args'])
+            logFile = open(task['log'], 'a')
+            process = subprocess.Popen(task['args'], stdout=logFile, stderr=logFile)
+            running.append((task, process, logFile))
+
+        time.sleep(0.1)
+
+        stillRunning = []
+        for (task, process, logFile) in running:
+            status = process.poll()
+            if status is None:
+                stillRunning.append((task, process, logFile))
+                continue
+            logFile.close()
+            if status != 0:
+                print 'Error running %s'%task['name']
+                failed = True
+            if task['kind'] == 'render':
+                remaining[task['plot']] -= 1
+                if remaining[task['plot']] == 0:
+                    # encoding goes ahead of the rendering still pending
+                    pending = getEncodeTasks(task['plot']) + pending
+        running = stillRunning
+
+    return not failed
+
+def getEncodeTasks(plot):
+    tasks = []
+    for (plotName, prefixes) in plotPrefixes:
+        if plotName != plot:
+            continue
+        for prefix in prefixes:
+            # plots of fields missing from the output have no frames
+            if not os.path.exists('%s/plots/%s_0001.png'%(folder, prefix)):
+                continue
+            args = [avconv, '-y', '-r', framesPerSecond, '-i', '%s/plots/%s_%%04d.png'%(folder, prefix),
+                    '-b', '32000k', '-r', framesPerSecond, '%s/movies/%s.mp4'%(folder, prefix)]
+            tasks.append({'kind': 'encode', 'plot': plot, 'name': 'avconv',
+                          'args': args,
+                          'log': '%s/plotLogs/%s.log'%(folder, prefix)})
+    return tasks
 
 parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
 parser.add_argument("-f", "--folder", dest="folder", help="Folder for plots", required=True)
 parser.add_argument("-e", "--expt", dest="expt", help="Experiment number (0, 1 or 2)", required=True)
 parser.add_argument("-a", "--avconv", dest="avconv", help="full path to avconv")
+parser.add_argument("-j", "--jobs", dest="jobs", type=int, help="Maximum number of plotting and encoding processes to run at once (default: the number of processors)")
+parser.add_argument("--frames_per_task", dest="frames_per_task", type=int, default=100, help="Number of time indices each plotting process renders")
 
 args = parser.parse_args()
 
@@ -21,6 +115,12 @@ if(args.avconv is None):
 else:
     avconv = args.avconv
 
+if(args.jobs is None):
+    jobs = multiprocessing.cpu_count()
+else:
+    jobs = max(args.jobs, 1)
+framesPerTask = max(args.frames_per_task, 1)
+
 initFile = 'init.nc'
 print folder
 print 'expt ', expt
@@ -56,38 +156,32 @@ if(status != 0):
     print 'Error running computeOverturningStreamfunction.py'
     exit(1)
 
-logFile = open('%s/plotLogs/plot.log'%folder, 'w')
-args = ['./viz/plotResults.py', '--inFolder=%s'%folder, '--outImageFolder=%s/plots'%folder,
-        '--expt=%s'%expt]
-
-print 'running %s'%' '.join(args)
-subprocess.check_call(args, stdout=logFile, stderr=logFile)
-
-
 framesPerSecond = '30'
+try:
+    os.makedirs('%s/plots'%folder)
+except OSError:
+    pass
 try:
     os.makedirs('%s/movies'%folder)
 except OSError:
     pass
 
-
-processes = []
-
-for fileName in glob.glob('%s/plots/*0001.png'%folder):
-    prefix = fileName.split('/')[-1][:-9]
-    print prefix
-    logFile = open('%s/plotLogs/%s.log'%(folder,prefix), 'w')
-    args = [avconv, '-y', '-r', framesPerSecond, '-i', '%s/plots/%s_%%04d.png'%(folder, prefix),
-            '-b', '32000k', '-r', framesPerSecond, '%s/movies/%s.mp4'%(folder, prefix)]
- 
-    print 'running %s'%' '.join(args)
-    process = subprocess.Popen(args, stdout=logFile, stderr=logFile)
-    
-    processes.append(process)
-
-for process in processes:
-    status = process.wait()
-    
-    if(status != 0):
-        print 'Error running avconv'
-
+# split the rendering by plot and by ranges of time indices
+nTime = getTimeCount(folder)
+tasks = []
+for (plot, prefixes) in plotPrefixes:
+    open('%s/plotLogs/plot_%s.log'%(folder, plot), 'w').close()
+    for tStart in range(0, nTime, framesPerTask):
+        tEnd = min(tStart + framesPerTask, nTime)
+        args = ['./viz/plotResults.py', '--inFolder=%s'%folder, '--outImageFolder=%s/plots'%folder,
+                '--expt=%s'%expt, '--plots=%s'%plot, '--tStart=%d'%tStart, '--tEnd=%d'%tEnd]
+        tasks.append({'kind': 'render', 'plot': plot, 'name': 'plotResults.py',
+                      'args': args,
+                      'log': '%s/plotLogs/plot_%s.log'%(folder, plot)})
+
+for (plot, prefixes) in plotPrefixes:
+    for prefix in prefixes:
+        open('%s/plotLogs/%s.log'%(folder, prefix), 'w').close()
+
+if not runTasks(tasks, jobs):
+    exit(1)
@@ -10,69 +10,92 @@ import scipy.sparse.linalg
 import os.path
 
 
-def computeTransport():
-  transport = numpy.zeros(nEdges)
+def computeInnerEdges():
   innerEdges = numpy.logical_and(cellsOnEdge[:,0] >= 0,cellsOnEdge[:,1] >= 0)
   innerEdges = numpy.nonzero(innerEdges)[0]
-  for iEdge in innerEdges:
-    cell0 = cellsOnEdge[iEdge,0]
-    cell1 = cellsOnEdge[iEdge,1]
-    layerThicknessEdge = 0.5*(layerThickness[cell0,:] + layerThickness[cell1,:])
-    transport[iEdge] = dvEdge[iEdge]*numpy.sum(layerThicknessEdge*normalVelocity[iEdge,:])
+  return innerEdges
 
-  return (innerEdges,transport)
-  
-def computeBSF():
+def computeTransport():
+  # vertically integrated transport through each inner edge
+  transport = numpy.zeros(nEdges)
+  cell0 = cellsOnEdge[innerEdges,0]
+  cell1 = cellsOnEdge[innerEdges,1]
+  layerThicknessEdge = 0.5*(layerThickness[cell0,:] + layerThickness[cell1,:])
+  transport[innerEdges] = dvEdge[innerEdges]*numpy.sum(layerThicknessEdge*normalVelocity[innerEdges,:],axis=1)
+
+  return transport
+
+def buildBSFOperator():
+  # The bsf satisfies bsf[v1]-bsf[v0] = transport on each inner edge and is
+  # zero on boundary vertices, solved in the least-squares sense. The matrix
+  # only depends on the mesh, so the normal equations are factorized once and
+  # each time index only needs a new right-hand side.
   boundaryVertices = numpy.logical_or(cellsOnVertex[:,0] ==-1,cellsOnVertex[:,1] ==-1)
   boundaryVertices = numpy.logical_or(boundaryVertices,cellsOnVertex[:,2] ==-1)
   boundaryVertices = numpy.nonzero(boundaryVertices)[0]
   nBoundaryVertices = len(boundaryVertices)
   nInnerEdges = len(innerEdges)
-  
-  rhs = numpy.zeros(nInnerEdges+nBoundaryVertices,dtype=float)
-  indices = numpy.zeros((2,2*nInnerEdges+nBoundaryVertices),dtype=int)
+
+  rows = numpy.zeros(2*nInnerEdges+nBoundaryVertices,dtype=int)
+  cols = numpy.zeros(2*nInnerEdges+nBoundaryVertices,dtype=int)
   data = numpy.zeros(2*nInnerEdges+nBoundaryVertices,dtype=float)
-  for index in range(nInnerEdges):
-  
-    iEdge = innerEdges[index]
-    v0 = verticesOnEdge[iEdge,0]
-    v1 = verticesOnEdge[iEdge,1]
-    
-    indices[0,2*index] = index
-    indices[1,2*index] = v1
-    data[2*index] = 1.
-    indices[0,2*index+1] = index
-    indices[1,2*index+1] = v0
-    data[2*index+1] = -1.
-    
-    rhs[index] = transport[iEdge]*1e-6 #in Sv
-  
-  for index in range(nBoundaryVertices):
-    iVertex = boundaryVertices[index]
-    indices[0,2*nInnerEdges+index] = nInnerEdges+index
-    indices[1,2*nInnerEdges+index] = iVertex
-    data[2*nInnerEdges+index] = 1. 
-    rhs[nInnerEdges+index] = 0. # bsf is zero at the boundaries
-  
-  M = scipy.sparse.csr_matrix((data,indices),shape=(nInnerEdges+nBoundaryVertices,nVertices))
-  
-  solution = scipy.sparse.linalg.lsqr(M,rhs)
-  
-  bsf = -solution[0]
+
+  rows[0:2*nInnerEdges:2] = numpy.arange(nInnerEdges)
+  cols[0:2*nInnerEdges:2] = verticesOnEdge[innerEdges,1]
+  data[0:2*nInnerEdges:2] = 1.
+  rows[1:2*nInnerEdges:2] = numpy.arange(nInnerEdges)
+  cols[1:2*nInnerEdges:2] = verticesOnEdge[innerEdges,0]
+  data[1:2*nInnerEdges:2] = -1.
+
+  # bsf is zero at the boundaries
+  rows[2*nInnerEdges:] = nInnerEdges+numpy.arange(nBoundaryVertices)
+  cols[2*nInnerEdges:] = boundaryVertices
+  data[2*nInnerEdges:] = 1.
+
+  M = scipy.sparse.csr_matrix((data,(rows,cols)),shape=(nInnerEdges+nBoundaryVertices,nVertices))
+
+  try:
+    MT = M.transpose().tocsr()
+    solveNormal = scipy.sparse.linalg.factorized((MT*M).tocsc())
+    solve = lambda rhs: solveNormal(MT*rhs)
+  except RuntimeError:
+    # the normal equations are singular if part of the mesh has no boundary
+    # vertex, in which case lsqr finds the minimum-norm solution
+    print 'Normal equations are singular, falling back to lsqr'
+    solve = lambda rhs: scipy.sparse.linalg.lsqr(M,rhs)[0]
+
+  return (M.shape[0],solve)
+
+def computeBSF():
+  rhs = numpy.zeros(nRows,dtype=float)
+  rhs[0:len(innerEdges)] = transport[innerEdges]*1e-6 #in Sv
+
+  bsf = -solveBSF(rhs)
   return bsf
 
- 
+def buildBSFCellOperator():
+  # bsfCell is the average of bsf at the vertices of each cell, weighted by
+  # the area associated with each vertex, as a sparse nCells x nVertices
+  # operator
+  maxEdges = edgesOnCell.shape[1]
+  localIndices = numpy.arange(maxEdges)[numpy.newaxis,:]
+  valid = localIndices < nEdgesOnCell[:,numpy.newaxis]
+
+  indexM1 = numpy.mod(localIndices-1,nEdgesOnCell[:,numpy.newaxis])
+  edges = numpy.where(valid,edgesOnCell,0)
+  edgesM1 = edges[numpy.arange(nCells)[:,numpy.newaxis],indexM1]
+  areaEdge = dcEdge*dvEdge
+  areaVert = 0.5*(areaEdge[edges]+areaEdge[edgesM1])
+  areaVert = numpy.where(valid,areaVert,0.)
+  areaVert = areaVert/numpy.sum(areaVert,axis=1)[:,numpy.newaxis]
+
+  rows = numpy.repeat(numpy.arange(nCells)[:,numpy.newaxis],maxEdges,axis=1)
+  W = scipy.sparse.csr_matrix((areaVert[valid],(rows[valid],verticesOnCell[valid])),shape=(nCells,nVertices))
+  return W
+
 def computeBSFCell(bsf):
-  bsfCell = numpy.zeros(nCells)
-  for iCell in range(nCells):
-    edgeCount = nEdgesOnCell[iCell]
-    edges = edgesOnCell[iCell,0:edgeCount]
-    verts = verticesOnCell[iCell,0:edgeCount]
-    areaEdge = dcEdge[edges]*dvEdge[edges]
-    indexM1 = numpy.mod(numpy.arange(-1,edgeCount-1),edgeCount)
-    areaVert = 0.5*(areaEdge+areaEdge[indexM1])
-    bsfCell[iCell] = numpy.sum(areaVert*bsf[verts])/numpy.sum(areaVert)
-  
+  bsfCell = bsfCellOperator*bsf
+
   return bsfCell
 
 parser = OptionParser()
@@ -137,20 +160,24 @@ else:
   outBSF = outFile.createVariable('barotropicStreamfunction',float,['Time','nVertices'])
   outBSFCell = outFile.createVariable('barotropicStreamfunctionCell',float,['Time','nCells'])
 
+innerEdges = computeInnerEdges()
+(nRows,solveBSF) = buildBSFOperator()
+bsfCellOperator = buildBSFCellOperator()
+
 print nTimeOut, nTimeIn
 for tIndex in range(nTimeOut,nTimeIn):
   print tIndex, nTimeIn
   normalVelocity = inFile.variables['normalVelocity'][tIndex,:,:]
   layerThickness = inFile.variables['layerThickness'][tIndex,:,:]
-  
 
-  (innerEdges,transport) = computeTransport()
-  
+
+  transport = computeTransport()
+
   bsf = computeBSF()
-  
+
   bsfCell = computeBSFCell(bsf)
-  
-  
+
+
   outBSF[tIndex,:] = bsf
   outBSFCell[tIndex,:] = bsfCell
 
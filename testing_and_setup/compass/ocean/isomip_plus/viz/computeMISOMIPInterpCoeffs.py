@@ -1,17 +1,167 @@
 #!/usr/bin/env python
 import numpy
 from netCDF4 import Dataset
-from shapely.geometry import Polygon, LineString
 
 from optparse import OptionParser
 
-from progressbar import ProgressBar, Percentage, Bar, ETA
-
 import os.path
+import hashlib
+import shutil
 
-def getTransectWeights(outFileName, axis):
+# number of (MPAS cell, output cell) pairs clipped at once
+chunkSize = 100000
+
+def getCellPolygons():
+  # vertices of all MPAS cells, padded to maxEdges by repeating the last
+  # vertex, with their bounding boxes
+  maxEdges = verticesOnCell.shape[1]
+  localIndices = numpy.minimum(numpy.arange(maxEdges)[numpy.newaxis,:],
+                               nEdgesOnCell[:,numpy.newaxis]-1)
+  verts = verticesOnCell[numpy.arange(nCells)[:,numpy.newaxis],localIndices]
+  xVert = xVertex[verts]
+  yVert = yVertex[verts]
+  return (xVert, yVert)
+
+def getIndexRanges(corners, nOut, minCoord, maxCoord):
+  # the range [lower, upper) of output cells that may overlap each cell,
+  # from the bounding box of the cell (a bin index on the structured grid)
+  lower = numpy.maximum(numpy.searchsorted(corners, minCoord, side='left')-1, 0)
+  upper = numpy.minimum(numpy.searchsorted(corners, maxCoord, side='right'), nOut)
+  return (lower, numpy.maximum(upper, lower))
+
+def clipPolygons(xPoly, yPoly, counts, coord, sign, value):
+  # Sutherland-Hodgman clipping of many convex polygons (padded arrays of
+  # vertices, with the number of valid vertices in counts) against the
+  # half plane sign*(coord - value) >= 0, where coord is 0 for x and 1 for y
+  nPolys, width = xPoly.shape
+  rows = numpy.arange(nPolys)[:,numpy.newaxis]
+  localIndices = numpy.arange(width)[numpy.newaxis,:]
+  inPoly = localIndices < counts[:,numpy.newaxis]
+  nextIndices = numpy.mod(localIndices+1, numpy.maximum(counts,1)[:,numpy.newaxis])
+
+  xNext = xPoly[rows,nextIndices]
+  yNext = yPoly[rows,nextIndices]
+  if coord == 0:
+    distance = sign*(xPoly - value)
+    distanceNext = sign*(xNext - value)
+  else:
+    distance = sign*(yPoly - value)
+    distanceNext = sign*(yNext - value)
+  inside = distance >= 0.
+  insideNext = distanceNext >= 0.
+
+  # each edge adds the point where it crosses the boundary (if it does) and
+  # then its end point (if that is inside)
+  crosses = numpy.logical_and(inPoly, inside != insideNext)
+  denominator = numpy.where(crosses, distance - distanceNext, 1.)
+  fraction = numpy.where(crosses, distance/denominator, 0.)
+  xCross = xPoly + fraction*(xNext - xPoly)
+  yCross = yPoly + fraction*(yNext - yPoly)
+
+  xOut = numpy.zeros((nPolys,2*width))
+  yOut = numpy.zeros((nPolys,2*width))
+  valid = numpy.zeros((nPolys,2*width),bool)
+  xOut[:,0::2] = xCross
+  yOut[:,0::2] = yCross
+  valid[:,0::2] = crosses
+  xOut[:,1::2] = xNext
+  yOut[:,1::2] = yNext
+  valid[:,1::2] = numpy.logical_and(inPoly, insideNext)
+
+  # move the valid vertices to the front, keeping their order
+  order = numpy.argsort(numpy.logical_not(valid), axis=1, kind='mergesort')
+  counts = numpy.sum(valid, axis=1)
+  width = max(numpy.amax(counts), 1)
+  order = order[:,0:width]
+  return (xOut[rows,order], yOut[rows,order], counts)
+
+def polygonAreas(xPoly, yPoly, counts):
+  # shoelace formula over the first counts vertices of each polygon
+  nPolys, width = xPoly.shape
+  rows = numpy.arange(nPolys)[:,numpy.newaxis]
+  localIndices = numpy.arange(width)[numpy.newaxis,:]
+  nextIndices = numpy.mod(localIndices+1, numpy.maximum(counts,1)[:,numpy.newaxis])
+  cross = xPoly*yPoly[rows,nextIndices] - xPoly[rows,nextIndices]*yPoly
+  cross = numpy.where(localIndices < counts[:,numpy.newaxis], cross, 0.)
+  return 0.5*numpy.abs(numpy.sum(cross, axis=1))
+
+def getSliceIndices(outIndices):
+  # number each intersection within the intersections of its output cell,
+  # in order of cell index, and sort first by that slice index, then by the
+  # output cell
+  order = numpy.argsort(outIndices, kind='mergesort')
+  sortedOut = outIndices[order]
+  groupStart = numpy.ones(len(sortedOut),bool)
+  groupStart[1:] = sortedOut[1:] != sortedOut[:-1]
+  starts = numpy.nonzero(groupStart)[0]
+  ranks = numpy.arange(len(sortedOut)) - numpy.repeat(starts, numpy.diff(numpy.append(starts, len(sortedOut))))
+  sliceIndices = numpy.zeros(len(outIndices),int)
+  sliceIndices[order] = ranks
+
+  sortedIndices = numpy.lexsort((outIndices, sliceIndices))
+  return (sliceIndices, sortedIndices)
+
+def getHorizWeights(outFileName):
+  (xVert, yVert) = getCellPolygons()
+
+  (xl, xu) = getIndexRanges(x, outNx, numpy.amin(xVert,axis=1), numpy.amax(xVert,axis=1))
+  (yl, yu) = getIndexRanges(y, outNy, numpy.amin(yVert,axis=1), numpy.amax(yVert,axis=1))
+
+  # all (cell, output cell) pairs whose bounding boxes overlap, in the same
+  # order as looping over cells, then y, then x
+  nxCell = xu - xl
+  nyCell = yu - yl
+  nPairsCell = nxCell*nyCell
+  pairCells = numpy.repeat(numpy.arange(nCells), nPairsCell)
+  localIndices = numpy.arange(numpy.sum(nPairsCell)) - numpy.repeat(
+    numpy.cumsum(nPairsCell) - nPairsCell, nPairsCell)
+  pairY = yl[pairCells] + localIndices // numpy.maximum(nxCell[pairCells],1)
+  pairX = xl[pairCells] + numpy.mod(localIndices, numpy.maximum(nxCell[pairCells],1))
+
+  areas = numpy.zeros(len(pairCells))
+  for start in range(0, len(pairCells), chunkSize):
+    end = min(start+chunkSize, len(pairCells))
+    cells = pairCells[start:end]
+    xPoly = xVert[cells,:]
+    yPoly = yVert[cells,:]
+    counts = nEdgesOnCell[cells]
+    for (coord, sign, value) in [(0, 1., x[pairX[start:end]]),
+                                 (0, -1., x[pairX[start:end]+1]),
+                                 (1, 1., y[pairY[start:end]]),
+                                 (1, -1., y[pairY[start:end]+1])]:
+      (xPoly, yPoly, counts) = clipPolygons(xPoly, yPoly, counts, coord, sign,
+                                            value[:,numpy.newaxis])
+    areas[start:end] = polygonAreas(xPoly, yPoly, counts)
+
+  mask = areas > 0.
+  cellIndices = pairCells[mask]
+  xIndices = pairX[mask]
+  yIndices = pairY[mask]
+  weights = areas[mask]/outDx**2
 
-  pbar = ProgressBar(widgets=[Percentage(), Bar(), ETA()], maxval=nCells).start()
+  # sort the intersections first by sliceIndex, then by yIndex, then by
+  # xIndex for efficiency
+  (sliceIndices, sortedIndices) = getSliceIndices(xIndices + outNx*yIndices)
+
+  outFile = Dataset(outFileName,'w',format='NETCDF4')
+  outFile.meshHash = meshHash
+  outFile.createDimension('nIntersections', len(cellIndices))
+  outFile.createVariable('cellIndices','i4',('nIntersections',))
+  outFile.createVariable('xIndices','i4',('nIntersections',))
+  outFile.createVariable('yIndices','i4',('nIntersections',))
+  outFile.createVariable('sliceIndices','i4',('nIntersections',))
+  outFile.createVariable('mpasToMisomipWeights','f8',('nIntersections',))
+
+  outVars = outFile.variables
+  outVars['cellIndices'][:] = cellIndices[sortedIndices]
+  outVars['xIndices'][:] = xIndices[sortedIndices]
+  outVars['yIndices'][:] = yIndices[sortedIndices]
+  outVars['sliceIndices'][:] = sliceIndices[sortedIndices]
+  outVars['mpasToMisomipWeights'][:] = weights[sortedIndices]
+
+  outFile.close()
+
+def getTransectWeights(outFileName, axis):
 
   if axis == 'x':
     slicePos = xTransect
@@ -22,90 +172,59 @@ def getTransectWeights(outFileName, axis):
     outNOther = outNx
     outOtherAxis = x
 
-  sliceCount = numpy.zeros(outNOther,int)
-  cellIndices = []
-  otherIndices = []
-  weights = []
-  sliceIndices = []
-
-  for iCell in range(nCells):
-    verts = verticesOnCell[iCell,0:nEdgesOnCell[iCell]]
-    verts = numpy.append(verts,verts[0])
-    xVert = xVertex[verts]
-    yVert = yVertex[verts]
-
-    if axis == 'x':
-      sliceAxisVerts = xVert
-      otherAxisVerts = yVert
-    else:
-      sliceAxisVerts = yVert
-      otherAxisVerts = xVert
-
-
-
-    if(numpy.amax(sliceAxisVerts) < slicePos) or (numpy.amin(sliceAxisVerts) > slicePos):
-      # this polygon doesn't intersect the slice
-      continue
-
-    mpasPolygon = Polygon(zip(xVert,yVert))
-
-    indices = numpy.nonzero(outOtherAxis < numpy.amin(otherAxisVerts))[0]
-    if len(indices) == 0:
-      lower = 0
-    else:
-      lower = indices[-1]
-
-    indices = numpy.nonzero(outOtherAxis > numpy.amax(otherAxisVerts))[0]
-    if len(indices) == 0:
-      upper = outNOther
-    else:
-      upper = indices[0]
-
-    for otherIndex in range(lower, upper):
-      if axis == 'x':
-        vertices = ((slicePos, outOtherAxis[otherIndex]),
-                    (slicePos, outOtherAxis[otherIndex+1]))
-      else:
-        vertices = ((outOtherAxis[otherIndex], slicePos),
-                    (outOtherAxis[otherIndex+1], slicePos))
-
-      line = LineString(vertices)
-      if not mpasPolygon.intersects(line):
-        continue
-      length = mpasPolygon.intersection(line).length
-      if length == 0.0:
-        continue
-
-      cellIndices.append(iCell)
-      otherIndices.append(otherIndex)
-  
-      weights.append(length/outDx)
-  
-      sliceIndex = sliceCount[otherIndex]
-      sliceCount[otherIndex] += 1
-      sliceIndices.append(sliceIndex)
-    pbar.update(iCell+1)
-  
-  pbar.finish()
-
-  cellIndices = numpy.array(cellIndices)
-  otherIndices = numpy.array(otherIndices)
-  sliceIndices = numpy.array(sliceIndices)
-  weights = numpy.array(weights)
+  (xVert, yVert) = getCellPolygons()
+  if axis == 'x':
+    sliceAxisVerts = xVert
+    otherAxisVerts = yVert
+  else:
+    sliceAxisVerts = yVert
+    otherAxisVerts = xVert
+
+  # the extent along the other axis of the part of each (convex) cell on the
+  # transect, from the points where its edges cross the transect
+  sliceNext = numpy.roll(sliceAxisVerts, -1, axis=1)
+  otherNext = numpy.roll(otherAxisVerts, -1, axis=1)
+  crosses = numpy.logical_and(numpy.minimum(sliceAxisVerts, sliceNext) <= slicePos,
+                              numpy.maximum(sliceAxisVerts, sliceNext) >= slicePos)
+  parallel = sliceAxisVerts == sliceNext
+  denominator = numpy.where(parallel, 1., sliceNext - sliceAxisVerts)
+  fraction = numpy.where(parallel, 0., (slicePos - sliceAxisVerts)/denominator)
+  otherCross = otherAxisVerts + fraction*(otherNext - otherAxisVerts)
+
+  # edges lying on the transect contribute both of their end points
+  lowerCross = numpy.where(parallel, numpy.minimum(otherAxisVerts, otherNext), otherCross)
+  upperCross = numpy.where(parallel, numpy.maximum(otherAxisVerts, otherNext), otherCross)
+  onTransect = numpy.any(crosses, axis=1)
+  lowerCross = numpy.where(crosses, lowerCross, numpy.inf)
+  upperCross = numpy.where(crosses, upperCross, -numpy.inf)
+
+  cells = numpy.nonzero(onTransect)[0]
+  lowerCell = numpy.amin(lowerCross[cells,:], axis=1)
+  upperCell = numpy.amax(upperCross[cells,:], axis=1)
+
+  (lower, upper) = getIndexRanges(outOtherAxis, outNOther,
+                                  numpy.amin(otherAxisVerts[cells,:], axis=1),
+                                  numpy.amax(otherAxisVerts[cells,:], axis=1))
+
+  nPairsCell = upper - lower
+  pairCells = numpy.repeat(numpy.arange(len(cells)), nPairsCell)
+  otherIndices = lower[pairCells] + numpy.arange(numpy.sum(nPairsCell)) - \
+    numpy.repeat(numpy.cumsum(nPairsCell) - nPairsCell, nPairsCell)
+
+  lengths = numpy.minimum(upperCell[pairCells], outOtherAxis[otherIndices+1]) - \
+    numpy.maximum(lowerCell[pairCells], outOtherAxis[otherIndices])
+
+  mask = lengths > 0.
+  cellIndices = cells[pairCells[mask]]
+  otherIndices = otherIndices[mask]
+  weights = lengths[mask]/outDx
 
   # sort the intersections first by otherIndex, then by sliceIndex
   # for efficiency
-  nSlices = numpy.amax(sliceCount)
-  sortedIndices = numpy.zeros(0,int)
-  pbar = ProgressBar(widgets=[Percentage(), Bar(), ETA()], maxval=nSlices).start()
-  for sliceIndex in range(nSlices):
-    intersectionsInSlice = numpy.nonzero(sliceIndices == sliceIndex)[0]
-    indices = numpy.argsort(otherIndices[intersectionsInSlice])
-    sortedIndices = numpy.append(sortedIndices,intersectionsInSlice[indices])
-    pbar.update(sliceIndex+1)
-  pbar.finish()
-  
+  (sliceIndices, sortedIndices) = getSliceIndices(otherIndices)
+
   outFile = Dataset(outFileName,'w',format='NETCDF4')
+  outFile.meshHash = meshHash
   outFile.createDimension('nIntersections', len(cellIndices))
   outFile.createVariable('cellIndices','i4',('nIntersections',))
   if axis == 'x':
@@ -114,7 +233,7 @@ def getTransectWeights(outFileName, axis):
     outFile.createVariable('xIndices','i4',('nIntersections',))
   outFile.createVariable('sliceIndices','i4',('nIntersections',))
   outFile.createVariable('mpasToMisomipWeights','f8',('nIntersections',))
-  
+
   outVars = outFile.variables
   outVars['cellIndices'][:] = cellIndices[sortedIndices]
   if axis == 'x':
@@ -124,16 +243,58 @@ def getTransectWeights(outFileName, axis):
 
   outVars['sliceIndices'][:] = sliceIndices[sortedIndices]
   outVars['mpasToMisomipWeights'][:] = weights[sortedIndices]
-  
+
   outFile.close()
 
+def computeMeshHash():
+  # a hash of the mesh geometry and the output grid, identifying the weights
+  meshHash = hashlib.sha256()
+  for array in [nEdgesOnCell, verticesOnCell, xVertex, yVertex]:
+    meshHash.update(numpy.ascontiguousarray(numpy.ma.getdata(array)).tobytes())
+  meshHash.update(repr((outDx, outX0, outY0, xTransect, yTransect, outNx,
+                        outNy)).encode('utf-8'))
+  return meshHash.hexdigest()
+
+def isUpToDate(fileName):
+  # weights files are only reused if they were computed for this mesh
+  if not os.path.exists(fileName):
+    return False
+  inFile = Dataset(fileName,'r')
+  upToDate = 'meshHash' in inFile.ncattrs() and inFile.meshHash == meshHash
+  inFile.close()
+  return upToDate
+
+def getWeights(fileName, computeWeights):
+  if isUpToDate(fileName):
+    return
+
+  if cacheDir is not None:
+    cacheFileName = '%s/%s/%s'%(cacheDir, meshHash, os.path.basename(fileName))
+    if os.path.exists(cacheFileName):
+      print('Using cached %s'%cacheFileName)
+      shutil.copyfile(cacheFileName, fileName)
+      return
+
+  print('Computing %s'%fileName)
+  computeWeights(fileName)
+
+  if cacheDir is not None:
+    try:
+      os.makedirs('%s/%s'%(cacheDir, meshHash))
+    except OSError:
+      pass
+    shutil.copyfile(fileName, cacheFileName)
+
 parser = OptionParser()
+parser.add_option("--cacheDir", type="string", dest="cacheDir",
+                  help="directory in which weights are cached by mesh, so they are only computed once for each mesh")
 options, args = parser.parse_args()
 
 if(len(args) == 0):
   folder = '.'
 else:
   folder = args[0]
+cacheDir = options.cacheDir
 meshFileName = '%s/init.nc'%folder
 interpWeightsFileName = '%s/intersections.nc'%folder
 xTransectFileName = '%s/xTransectIntersections.nc'%folder
@@ -166,117 +327,11 @@ xVertex = inVars['xVertex'][:]
 yVertex = inVars['yVertex'][:]
 
 inFile.close()
-if(not os.path.exists(interpWeightsFileName)):
-  
-  cellIndices = []
-  xIndices = []
-  yIndices = []
-  weights = []
-  sliceIndices = []
-  
-  sliceCount = numpy.zeros((outNy,outNx),int)
-  
-  pbar = ProgressBar(widgets=[Percentage(), Bar(), ETA()], maxval=nCells).start()
-  
-  for iCell in range(nCells):
-    verts = verticesOnCell[iCell,0:nEdgesOnCell[iCell]]
-    verts = numpy.append(verts,verts[0])
-    xVert = xVertex[verts]
-    yVert = yVertex[verts]
-    mpasPolygon = Polygon(zip(xVert,yVert))
-    #mpasArea = mpasPolygon.area
-  
-    # find the out indices that bound the MPAS polygon
-    indices = numpy.nonzero(x < numpy.amin(xVert))[0]
-    if len(indices) == 0:
-      xl = 0
-    else:
-      xl = indices[-1]
-  
-    indices = numpy.nonzero(x > numpy.amax(xVert))[0]
-    if len(indices) == 0:
-      xu = outNx
-    else:
-      xu = indices[0]
-  
-    indices = numpy.nonzero(y < numpy.amin(yVert))[0]
-    if len(indices) == 0:
-      yl = 0
-    else:
-      yl = indices[-1]
-  
-    indices = numpy.nonzero(y > numpy.amax(yVert))[0]
-    if len(indices) == 0:
-      yu = outNy
-    else:
-      yu = indices[0]
-  
-    for yIndex in range(yl, yu):
-      for xIndex in range(xl, xu):
-        vertices = ((x[xIndex], y[yIndex]),
-                    (x[xIndex+1], y[yIndex]),
-                    (x[xIndex+1], y[yIndex+1]),
-                    (x[xIndex], y[yIndex+1]),
-                    (x[xIndex], y[yIndex]))
-        outPoly = Polygon(vertices)
-        if not mpasPolygon.intersects(outPoly):
-          continue
-        intersectionArea = mpasPolygon.intersection(outPoly).area
-        if intersectionArea == 0.:
-          continue
-  
-        cellIndices.append(iCell)
-        xIndices.append(xIndex)
-        yIndices.append(yIndex)
-  
-        weights.append(intersectionArea/outDx**2)
-  
-        sliceIndex = sliceCount[yIndex,xIndex]
-        sliceCount[yIndex,xIndex] += 1
-        sliceIndices.append(sliceIndex)
-    pbar.update(iCell+1)
-  
-  pbar.finish()
-  
-  cellIndices = numpy.array(cellIndices)
-  xIndices = numpy.array(xIndices)
-  yIndices = numpy.array(yIndices)
-  sliceIndices = numpy.array(sliceIndices)
-  weights = numpy.array(weights)
-  
-  # sort the intersections first by xIndex, then by yIndex, then by sliceIndex
-  # for efficiency
-  nSlices = numpy.amax(sliceCount)
-  sortedIndices = numpy.zeros(0,int)
-  xyIndices = xIndices + outNx*yIndices
-  pbar = ProgressBar(widgets=[Percentage(), Bar(), ETA()], maxval=nSlices).start()
-  for sliceIndex in range(nSlices):
-    intersectionsInSlice = numpy.nonzero(sliceIndices == sliceIndex)[0]
-    indices = numpy.argsort(xyIndices[intersectionsInSlice])
-    sortedIndices = numpy.append(sortedIndices,intersectionsInSlice[indices])
-    pbar.update(sliceIndex+1)
-  pbar.finish()
-  
-  outFile = Dataset(interpWeightsFileName,'w',format='NETCDF4')
-  outFile.createDimension('nIntersections', len(cellIndices))
-  outFile.createVariable('cellIndices','i4',('nIntersections',))
-  outFile.createVariable('xIndices','i4',('nIntersections',))
-  outFile.createVariable('yIndices','i4',('nIntersections',))
-  outFile.createVariable('sliceIndices','i4',('nIntersections',))
-  outFile.createVariable('mpasToMisomipWeights','f8',('nIntersections',))
-  
-  outVars = outFile.variables
-  outVars['cellIndices'][:] = cellIndices[sortedIndices]
-  outVars['xIndices'][:] = xIndices[sortedIndices]
-  outVars['yIndices'][:] = yIndices[sortedIndices]
-  outVars['sliceIndices'][:] = sliceIndices[sortedIndices]
-  outVars['mpasToMisomipWeights'][:] = weights[sortedIndices]
-  
-  outFile.close()
 
-if(not os.path.exists(xTransectFileName)):
-  getTransectWeights(xTransectFileName, axis='x')
+meshHash = computeMeshHash()
+
+getWeights(interpWeightsFileName, getHorizWeights)
+
+getWeights(xTransectFileName, lambda fileName: getTransectWeights(fileName, axis='x'))
 
-if(not os.path.exists(yTransectFileName)):
-  getTransectWeights(yTransectFileName, axis='y')
-  
+getWeights(yTransectFileName, lambda fileName: getTransectWeights(fileName, axis='y'))
@@ -6,20 +6,43 @@ from optparse import OptionParser
 
 import os.path
 
-import shapely.geometry
+import scipy.sparse
 
 from progressbar import ProgressBar, Percentage, Bar, ETA
 
+def computeIntersectingEdges(point1,point2):
+  # indices of the edges (as segments between their vertices) that intersect
+  # or touch the segment from point1 to point2, tested for all edges at once
+  def orientation(ax,ay,bx,by,cx,cy):
+    return numpy.sign((bx-ax)*(cy-ay) - (by-ay)*(cx-ax))
+
+  (px1,py1) = point1
+  (px2,py2) = point2
+  qx1 = xVertex[verticesOnEdge[:,0]]
+  qy1 = yVertex[verticesOnEdge[:,0]]
+  qx2 = xVertex[verticesOnEdge[:,1]]
+  qy2 = yVertex[verticesOnEdge[:,1]]
+
+  o1 = orientation(px1,py1,px2,py2,qx1,qy1)
+  o2 = orientation(px1,py1,px2,py2,qx2,qy2)
+  o3 = orientation(qx1,qy1,qx2,qy2,px1,py1)
+  o4 = orientation(qx1,qy1,qx2,qy2,px2,py2)
+
+  # the bounding boxes must overlap, which also handles collinear segments
+  boxesOverlap = numpy.logical_and(
+    numpy.logical_and(numpy.minimum(qx1,qx2) <= max(px1,px2),
+                      numpy.maximum(qx1,qx2) >= min(px1,px2)),
+    numpy.logical_and(numpy.minimum(qy1,qy2) <= max(py1,py2),
+                      numpy.maximum(qy1,qy2) >= min(py1,py2)))
+
+  intersects = numpy.logical_and(numpy.logical_and(o1*o2 <= 0, o3*o4 <= 0),
+                                 boxesOverlap)
+  return list(numpy.nonzero(intersects)[0])
+
 def computeSectionEdgeIndices(point1,point2):
   #print 'section at between', point1, point2
-  
-  shapelySection = shapely.geometry.LineString([point1,point2])
-
 
-  edgeIndices = []
-  for iEdge in range(nEdges):
-    if shapelySection.intersects(shapelyEdges[iEdge]):
-      edgeIndices.append(iEdge)
+  edgeIndices = computeIntersectingEdges(point1,point2)
   if(len(edgeIndices) == 0):
     return (numpy.array(edgeIndices),numpy.array([]))
 
@@ -85,7 +108,98 @@ def computeSectionEdgeIndices(point1,point2):
   
   return (numpy.array(edgeIndices),numpy.array(edgeSigns))
 
-                       
+
+def buildSectionOperators():
+  # Flatten the sections into one list of section edges and build sparse
+  # (nx x nSectionEdges) operators that sum the signed transport and the area
+  # of the section edges into each x column. These only depend on the mesh.
+  sectionLengths = [len(edgeIndices) for edgeIndices in sectionEdgeIndices]
+  nSectionEdges = numpy.sum(sectionLengths)
+  if(nSectionEdges > 0):
+    edges = numpy.concatenate([numpy.asarray(edgeIndices,int) for edgeIndices in sectionEdgeIndices])
+    signs = numpy.concatenate([numpy.asarray(edgeSigns,float) for edgeSigns in sectionEdgeSigns])
+  else:
+    edges = numpy.zeros(0,int)
+    signs = numpy.zeros(0,float)
+  xIndices = numpy.repeat(numpy.arange(nx),sectionLengths)
+
+  # edges without a valid level (e.g. on the boundary) carry no transport
+  valid = maxLevelEdgeTop[edges] >= 0
+  edges = edges[valid]
+  signs = signs[valid]
+  xIndices = xIndices[valid]
+  columns = numpy.arange(len(edges))
+
+  transportOperator = scipy.sparse.csr_matrix((signs*dvEdge[edges],(xIndices,columns)),shape=(nx,len(edges)))
+  areaOperator = scipy.sparse.csr_matrix((dvEdge[edges],(xIndices,columns)),shape=(nx,len(edges)))
+  return (edges,transportOperator,areaOperator)
+
+def computeCumulativeProfiles(edges,zInterfaceCell):
+  # For each section edge, the integral from the bottom up to each z
+  # interface of the output grid of the normal velocity (transport per unit
+  # length) and of 1 (thickness). The edge's layers are stacked from the
+  # bottom of its deepest level using the average thickness of the cells on
+  # either side. Anything below the grid goes into the lowest z layer and
+  # anything above z[0] is dropped.
+  nSectionEdges = len(edges)
+  cell1 = cellsOnEdge[edges,0]
+  cell2 = cellsOnEdge[edges,1]
+  maxLevel = maxLevelEdgeTop[edges]
+
+  zBot = 0.5*(zInterfaceCell[cell1,maxLevel+1] + zInterfaceCell[cell2,maxLevel+1])
+  levelMask = numpy.arange(nVertLevels)[numpy.newaxis,:] <= maxLevel[:,numpy.newaxis]
+  layerThicknessEdge = levelMask*0.5*(layerThickness[cell1,:] + layerThickness[cell2,:])
+  velocity = levelMask*normalVelocity[edges,:]
+
+  # interfaces from the bottom up: zBot and the top of each level
+  reversedThickness = layerThicknessEdge[:,::-1]
+  zKnots = numpy.zeros((nSectionEdges,nVertLevels+1))
+  zKnots[:,0] = zBot
+  zKnots[:,1:] = zBot[:,numpy.newaxis] + numpy.cumsum(reversedThickness,axis=1)
+  transportKnots = numpy.zeros((nSectionEdges,nVertLevels+1))
+  transportKnots[:,1:] = numpy.cumsum(reversedThickness*velocity[:,::-1],axis=1)
+  thicknessKnots = numpy.zeros((nSectionEdges,nVertLevels+1))
+  thicknessKnots[:,1:] = numpy.cumsum(reversedThickness,axis=1)
+
+  # the interfaces between the z layers of the output grid, bottom up
+  zGrid = z[nz-2::-1]
+  nGrid = len(zGrid)
+
+  # interpolate each edge's piecewise linear profiles at the grid interfaces
+  # in one call by shifting each edge to its own, non-overlapping z range
+  zRange = max(numpy.amax(zKnots),numpy.amax(zGrid)) - min(numpy.amin(zKnots),numpy.amin(zGrid)) + 1.0
+  offsets = zRange*numpy.arange(nSectionEdges)[:,numpy.newaxis]
+  shiftedKnots = (zKnots + offsets).ravel()
+  shiftedGrid = (zGrid[numpy.newaxis,:] + offsets).ravel()
+
+  # beyond an edge's column, the profiles are constant
+  transport = numpy.interp(shiftedGrid,shiftedKnots,transportKnots.ravel())
+  thickness = numpy.interp(shiftedGrid,shiftedKnots,thicknessKnots.ravel())
+  below = zGrid[numpy.newaxis,:] <= zKnots[:,0:1]
+  above = zGrid[numpy.newaxis,:] >= zKnots[:,-1:]
+  transport = numpy.where(below,0.,numpy.where(above,transportKnots[:,-1:],transport.reshape(nSectionEdges,nGrid)))
+  thickness = numpy.where(below,0.,numpy.where(above,thicknessKnots[:,-1:],thickness.reshape(nSectionEdges,nGrid)))
+
+  return (transport,thickness)
+
+def computeTransportSection(edges,transportOperator,areaOperator,zInterfaceCell):
+  (transport,thickness) = computeCumulativeProfiles(edges,zInterfaceCell)
+
+  # the amount in each z layer is the difference across its interfaces,
+  # where the lowest layer also gets everything below it
+  nSectionEdges = len(edges)
+  transportLayer = numpy.zeros((nSectionEdges,nz-1))
+  thicknessLayer = numpy.zeros((nSectionEdges,nz-1))
+  # columns of transport and thickness are z[nz-2], ..., z[0]
+  transportLayer[:,nz-2] = transport[:,0]
+  thicknessLayer[:,nz-2] = thickness[:,0]
+  transportLayer[:,0:nz-2] = numpy.diff(transport,axis=1)[:,::-1]
+  thicknessLayer[:,0:nz-2] = numpy.diff(thickness,axis=1)[:,::-1]
+
+  transportSection = (transportOperator*transportLayer).T
+  transportSectionArea = (areaOperator*thicknessLayer).T
+  return (transportSection,transportSectionArea)
+
 parser = OptionParser()
            
 options, args = parser.parse_args()
@@ -161,14 +275,6 @@ else:
   nz = int((zMax-zMin)/dz)+1
   z = numpy.linspace(zMax,zMin,nz)
 
-  #print "Building shapely edges"
-  shapelyEdges = []
-  for iEdge in range(nEdges):
-    points = []
-    for v in verticesOnEdge[iEdge,:]:
-      points.append((xVertex[v],yVertex[v]))
-    shapelyEdges.append(shapely.geometry.LineString(points))
-
   #print "Finding section indices"
   maxSectionLength = 0
   sectionEdgeIndices = []
@@ -214,11 +320,11 @@ bottomDepth = inFile.variables['bottomDepth'][:]
 
 #print "Building maxLevelEdgeTop"
 maxLevelEdgeTop = -1*numpy.ones(nEdges,int)
-for iEdge in range(nEdges):
-  cell1 = cellsOnEdge[iEdge,0]
-  cell2 = cellsOnEdge[iEdge,1]
-  if(cell1 >= 0 and cell2 >= 0):
-    maxLevelEdgeTop[iEdge] = min(maxLevelCell[cell1],maxLevelCell[cell2])
+innerEdges = numpy.logical_and(cellsOnEdge[:,0] >= 0,cellsOnEdge[:,1] >= 0)
+maxLevelEdgeTop[innerEdges] = numpy.minimum(maxLevelCell[cellsOnEdge[innerEdges,0]],
+                                            maxLevelCell[cellsOnEdge[innerEdges,1]])
+
+(sectionEdges,transportOperator,areaOperator) = buildSectionOperators()
 
 pbar = ProgressBar(widgets=[Percentage(), Bar(), ETA()], maxval=nTimeIn*nx).start()
 for tIndex in range(nTimeOut,nTimeIn):
@@ -236,41 +342,10 @@ for tIndex in range(nTimeOut,nTimeIn):
   
         
   #print "Computing transport over sections"
-  transportSection = numpy.zeros((nz-1,nx))
-  transportSectionArea = numpy.zeros((nz-1,nx))
-  for xIndex in range(nx):
-    for sIndex in range(len(sectionEdgeIndices[xIndex])):
-      iEdge = sectionEdgeIndices[xIndex][sIndex]
-      sign = sectionEdgeSigns[xIndex][sIndex]
-
-      cell1 = cellsOnEdge[iEdge,0]
-      cell2 = cellsOnEdge[iEdge,1]
-      levelIndex = maxLevelEdgeTop[iEdge]
-      zBot = 0.5*(zInterfaceCell[cell1,levelIndex+1] + zInterfaceCell[cell2,levelIndex+1])
-      layerThicknessEdge = 0.5*(layerThickness[cell1,levelIndex]
-                              + layerThickness[cell2,levelIndex])
-      zTop = zBot + layerThicknessEdge
-      for zIndex in range(nz-2,-1,-1):
-        #print zIndex
-        # sum the fluxes (if any) within this level on the output grid
-        while (levelIndex >= 0) and (zBot < z[zIndex]):
-          #print zIndex, levelIndex, z[zIndex], zBot
-          v = normalVelocity[iEdge,levelIndex]
-          if(zTop <= z[zIndex]):
-            dz = zTop - zBot
-            zBot = zTop
-            layerThicknessEdge = 0.5*(layerThickness[cell1,levelIndex]
-                                    + layerThickness[cell2,levelIndex])
-            zTop += layerThicknessEdge
-            levelIndex -= 1
-          else:
-            dz = z[zIndex] - zBot
-            zBot = z[zIndex]
-          area = dvEdge[iEdge]*dz
-          transportSection[zIndex,xIndex] += sign*area*v
-          transportSectionArea[zIndex,xIndex] += area
-    pbar.update(tIndex*nx+xIndex+1)
-    
+  (transportSection,transportSectionArea) = computeTransportSection(
+    sectionEdges,transportOperator,areaOperator,zInterfaceCell)
+  pbar.update((tIndex+1)*nx)
+
   transportMask = 1.0*(transportSectionArea > 0.0)
 
   #print "Computing overturning streamfunction"
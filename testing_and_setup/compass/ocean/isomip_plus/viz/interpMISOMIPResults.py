@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import numpy
 from netCDF4 import Dataset
+import scipy.sparse
 
 from optparse import OptionParser
 
@@ -8,42 +9,50 @@ from progressbar import ProgressBar, Percentage, Bar, ETA
 
 import os.path
 
+def buildHorizOperator():
+  # sparse (outNy*outNx x nCells) operator from the intersection weights,
+  # excluding land cells; built once, as it only depends on the mesh
+  weights = xyMpasToMisomipWeights*(maxLevelCell[xyCellIndices] >= 0)
+  rows = xyYIndices*outNx + xyXIndices
+  return scipy.sparse.csr_matrix((weights,(rows,xyCellIndices)),
+                                 shape=(outNy*outNx,nCells))
+
 def interpHoriz(field, normalize=True):
-  outField = numpy.zeros((outNy,outNx))
-  for sliceIndex in range(xyNSlices):
-    mask = xySliceIndices == sliceIndex
-    cellsSlice = xyCellIndices[mask]
-    fieldSlice = field[cellsSlice]*(maxLevelCell[cellsSlice] >= 0)
-    outField[xyYIndices[mask],xyXIndices[mask]] += (xyMpasToMisomipWeights[mask]
-      * fieldSlice)
+  outField = (xyOperator*numpy.asarray(field)).reshape((outNy,outNx))
   if normalize:
     outField[xyOceanMask] /= xyOceanFraction[xyOceanMask]
     outField[xyOceanMask == False] = 0.
   return outField
 
+def buildTransectOperator(cellIndices, outIndices, weights, nOut):
+  # sparse (outNz*nOut x nCells*nVertLevels) operator that samples the layer
+  # of each intersecting cell containing each z of the output grid, weighted
+  # by the intersection weights. Layers are stacked down from ssh, so the
+  # operator changes with time but is shared by all fields at a time.
+  levels = numpy.arange(nVertLevels)
+  layerThick = layerThickness[cellIndices,:]*(
+    levels[numpy.newaxis,:] <= maxLevelCell[cellIndices,numpy.newaxis])
+  # depth below ssh of the bottom of each layer
+  depthBottom = numpy.cumsum(layerThick,axis=1)
+  depth = ssh[cellIndices,numpy.newaxis] - z[numpy.newaxis,:]
+
+  layerIndices = numpy.zeros(depth.shape,int)
+  for level in levels:
+    layerIndices += depthBottom[:,level:level+1] <= depth
+
+  # points above ssh or below the bottom of the column are not in the ocean
+  inColumn = numpy.logical_and(depth >= 0., layerIndices < nVertLevels)
+  inColumn = numpy.logical_and(inColumn, depth <= depthBottom[:,-1:])
+
+  zIndices = numpy.repeat(numpy.arange(outNz)[numpy.newaxis,:],len(cellIndices),axis=0)
+  rows = zIndices*nOut + outIndices[:,numpy.newaxis]
+  columns = cellIndices[:,numpy.newaxis]*nVertLevels + layerIndices
+  data = numpy.repeat(weights[:,numpy.newaxis],outNz,axis=1)
+  return scipy.sparse.csr_matrix((data[inColumn],(rows[inColumn],columns[inColumn])),
+                                 shape=(outNz*nOut,nCells*nVertLevels))
+
 def interpXZTransect(field, normalize=True):
-  outField = numpy.zeros((outNz,outNx))
-
-  for sliceIndex in range(xzNSlices):
-    mask = xzSliceIndices == sliceIndex
-    cellsSlice = xzCellIndices[mask]
-    xIndices = xzXIndices[mask]
-    weights = xzMpasToMisomipWeights[mask]
-    for index in range(len(cellsSlice)):
-      iCell = cellsSlice[index]
-      xIndex = xIndices[index]
-      weight = weights[index]
-      layerThick = layerThickness[iCell,:]
-      layerThick[maxLevelCell[iCell]+1:] = 0.
-      zInterface = numpy.zeros(2*nVertLevels)
-      fieldColumn = numpy.zeros(2*nVertLevels)
-      fieldColumn[0::2] = field[iCell,:]
-      fieldColumn[1::2] = field[iCell,:]
-      zInterface[0] = ssh[iCell]
-      zInterface[1::2] = ssh[iCell] - numpy.cumsum(layerThick[:])
-      zInterface[2::2] = ssh[iCell] - numpy.cumsum(layerThick[:-1])
-      outField[:,xIndex] += weight*numpy.interp(z, zInterface[::-1], fieldColumn[::-1],
-                                                left=0., right=0.)
+  outField = (xzOperator*numpy.asarray(field).ravel()).reshape((outNz,outNx))
 
   if normalize:
     outField[xzOceanMask] /= xzOceanFraction[xzOceanMask]
@@ -52,28 +61,7 @@ def interpXZTransect(field, normalize=True):
   return outField
 
 def interpYZTransect(field, normalize=True):
-  outField = numpy.zeros((outNz,outNy))
-
-  for sliceIndex in range(yzNSlices):
-    mask = yzSliceIndices == sliceIndex
-    cellsSlice = yzCellIndices[mask]
-    yIndices = yzYIndices[mask]
-    weights = yzMpasToMisomipWeights[mask]
-    for index in range(len(cellsSlice)):
-      iCell = cellsSlice[index]
-      yIndex = yIndices[index]
-      weight = weights[index]
-      layerThick = layerThickness[iCell,:]
-      layerThick[maxLevelCell[iCell]+1:] = 0.
-      zInterface = numpy.zeros(2*nVertLevels)
-      fieldColumn = numpy.zeros(2*nVertLevels)
-      fieldColumn[0::2] = field[iCell,:]
-      fieldColumn[1::2] = field[iCell,:]
-      zInterface[0] = ssh[iCell]
-      zInterface[1::2] = ssh[iCell] - numpy.cumsum(layerThick[:])
-      zInterface[2::2] = ssh[iCell] - numpy.cumsum(layerThick[:-1])
-      outField[:,yIndex] += weight*numpy.interp(z, zInterface[::-1], fieldColumn[::-1],
-                                                left=0., right=0.)
+  outField = (yzOperator*numpy.asarray(field).ravel()).reshape((outNz,outNy))
 
   if normalize:
     outField[yzOceanMask] /= yzOceanFraction[yzOceanMask]
@@ -130,28 +118,22 @@ inVars = inFile.variables
 xyCellIndices = inVars['cellIndices'][:]
 xyXIndices = inVars['xIndices'][:]
 xyYIndices = inVars['yIndices'][:]
-xySliceIndices = inVars['sliceIndices'][:]
 xyMpasToMisomipWeights = inVars['mpasToMisomipWeights'][:]
 inFile.close()
-xyNSlices = numpy.amax(xySliceIndices)+1
 
 inFile = Dataset('%s/xTransectIntersections.nc'%folder,'r')
 inVars = inFile.variables
 yzCellIndices = inVars['cellIndices'][:]
 yzYIndices = inVars['yIndices'][:]
-yzSliceIndices = inVars['sliceIndices'][:]
 yzMpasToMisomipWeights = inVars['mpasToMisomipWeights'][:]
 inFile.close()
-yzNSlices = numpy.amax(yzSliceIndices)+1
 
 inFile = Dataset('%s/yTransectIntersections.nc'%folder,'r')
 inVars = inFile.variables
 xzCellIndices = inVars['cellIndices'][:]
 xzXIndices = inVars['xIndices'][:]
-xzSliceIndices = inVars['sliceIndices'][:]
 xzMpasToMisomipWeights = inVars['mpasToMisomipWeights'][:]
 inFile.close()
-xzNSlices = numpy.amax(xzSliceIndices)+1
 
 dynamicTopo = experiment in ['Ocean3', 'Ocean4', 'IceOcean1', 'IceOcean2']
 
@@ -296,12 +278,10 @@ areaCell = outputVars['areaCell'][:]
 bathymetry = -outputVars['bottomDepth'][:]
 maxLevelCell = outputVars['maxLevelCell'][:]-1
 
-cellMask = numpy.zeros((nCells, nVertLevels))
-for iCell in range(nCells):
-  k = maxLevelCell[iCell]
-  if (k >= 0):
-    cellMask[iCell,0:k+1] = 1.0
+cellMask = 1.0*(numpy.arange(nVertLevels)[numpy.newaxis,:]
+                <= maxLevelCell[:,numpy.newaxis])
 
+xyOperator = buildHorizOperator()
 xyOceanFraction = interpHoriz(cellMask[:,0], normalize=False)
 xyOceanMask = xyOceanFraction > 0.001
 
@@ -391,7 +371,12 @@ for timeIn in timesIn:
 
   #writeVar('overturningStreamfunction', resampleXZ(sfOverturn),
   #                    resampleXZ(osfMask) > .999)
-  
+
+  xzOperator = buildTransectOperator(xzCellIndices, xzXIndices,
+                                     xzMpasToMisomipWeights, outNx)
+  yzOperator = buildTransectOperator(yzCellIndices, yzYIndices,
+                                     yzMpasToMisomipWeights, outNy)
+
   xzOceanFraction = interpXZTransect(cellMask, normalize=False)
   xzOceanMask = xzOceanFraction > 0.001
 
@@ -5,7 +5,8 @@ from netCDF4 import Dataset
 from optparse import OptionParser
 import matplotlib
 matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.patches import Polygon
 from matplotlib.collections import PatchCollection
 import matplotlib.colors as colors
@@ -13,8 +14,6 @@ import matplotlib.colors as colors
 import os
 import os.path
 
-import copy
-
 def makeFerretColormap():
   red = numpy.array([[0,0.6],
                      [0.15,1],
@@ -61,54 +60,103 @@ def computeCellPatches(mask):
     # expand by 1% to avoid annoying gaps
     #for iVert in range(nVert):
       #vertices[iVert,:] = expansion*(vertices[iVert,:]-middle) + middle
-    polygon = Polygon(vertices, True)
+    polygon = Polygon(vertices, closed=True)
     patches.append(polygon)
-    
-  p = PatchCollection(patches, cmap=ferretMap, alpha=1.)
-    
-  return p
-  
+
+  return patches
+
+def getFrameFileName(prefix):
+  return '%s/%s_%04i.png'%(options.outImageFolder,prefix,tIndex+1)
+
+def framesExist(prefixes):
+  # frames already on disk are skipped, so their data needn't be read
+  for prefix in prefixes:
+    if(not os.path.exists(getFrameFileName(prefix))):
+      return False
+  return True
+
+def plotNeeded(plotName, prefixes):
+  # a plot is rendered if it was requested (all are by default) and any of
+  # its frames for this time index is missing
+  if(plotNames is not None and plotName not in plotNames):
+    return False
+  return not framesExist(prefixes)
+
+def updateClim(mappable, vmin, vmax):
+  # fixed limits, or limits from the data of this frame
+  mappable.norm.vmin = vmin
+  mappable.norm.vmax = vmax
+  mappable.autoscale_None()
+
 def plotHorizField(field, title, prefix, oceanDomain=True, vmin=None, vmax=None, figsize=[9,6]):
-  outFileName = '%s/%s_%04i.png'%(options.outImageFolder,prefix,tIndex+1)
+  # Each prefix has one figure and PatchCollection, made for its first frame,
+  # and later frames only update the array of the collection.
+  outFileName = getFrameFileName(prefix)
   if(os.path.exists(outFileName)):
     return
   if(oceanDomain):
-    localPatches = copy.copy(oceanPatches)
-    localPatches.set_array(field[oceanMask])
+    data = field[oceanMask]
   else:
-    localPatches = copy.copy(cavityPatches)
-    localPatches.set_array(field[cavityMask])
-  localPatches.set_edgecolor('face')
-  localPatches.set_clim(vmin=vmin, vmax=vmax)
-  
-  plt.figure(figsize=figsize)
-  ax = plt.subplot('111')
-  ax.add_collection(localPatches)
-  plt.colorbar(localPatches)
-  plt.axis([0,500,0,1000])
-  ax.set_aspect('equal')
-  ax.autoscale(tight=True)
-  plt.title(title)
-  plt.savefig(outFileName)
-  plt.close()  
+    data = field[cavityMask]
+
+  if(prefix not in figures):
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    if(oceanDomain):
+      localPatches = PatchCollection(oceanPatches, cmap=ferretMap, alpha=1.)
+    else:
+      localPatches = PatchCollection(cavityPatches, cmap=ferretMap, alpha=1.)
+    localPatches.set_array(data)
+    localPatches.set_edgecolor('face')
+    updateClim(localPatches, vmin, vmax)
+    ax.add_collection(localPatches)
+    colorbar = fig.colorbar(localPatches, ax=ax)
+    ax.axis([0,500,0,1000])
+    ax.set_aspect('equal')
+    ax.autoscale(tight=True)
+    ax.set_title(title)
+    figures[prefix] = {'figure': fig, 'artist': localPatches,
+                       'colorbar': colorbar}
+  else:
+    localPatches = figures[prefix]['artist']
+    localPatches.set_array(data)
+    updateClim(localPatches, vmin, vmax)
+    figures[prefix]['colorbar'].update_normal(localPatches)
+
+  figures[prefix]['figure'].savefig(outFileName)
 
 def plotVertField(field, title, prefix, vmin=None, vmax=None, figsize=[9,6], inX=None, inZ=None):
-  outFileName = '%s/%s_%04i.png'%(options.outImageFolder,prefix,tIndex+1)
+  # The z coordinates (and the mask) change in time, so the pcolor is
+  # redrawn for each frame, but the figure, axes and colorbar are reused.
+  outFileName = getFrameFileName(prefix)
   if(os.path.exists(outFileName)):
     return
   if(inX is None):
     inX = X
   if(inZ is None):
     inZ = Z
-  plt.figure(figsize=figsize)
-  ax = plt.subplot('111')
-  plt.pcolor(1e-3*inX,inZ,field,vmin=vmin,vmax=vmax,cmap=ferretMap)
-  plt.colorbar()
+
+  if(prefix not in figures):
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.set_title(title)
+    figures[prefix] = {'figure': fig, 'axes': ax, 'artist': None,
+                       'colorbar': None}
+  else:
+    figures[prefix]['artist'].remove()
+
+  ax = figures[prefix]['axes']
+  artist = ax.pcolor(1e-3*inX,inZ,field,vmin=vmin,vmax=vmax,cmap=ferretMap)
+  if(figures[prefix]['colorbar'] is None):
+    figures[prefix]['colorbar'] = figures[prefix]['figure'].colorbar(artist, ax=ax)
+  else:
+    figures[prefix]['colorbar'].update_normal(artist)
+  figures[prefix]['artist'] = artist
   ax.autoscale(tight=True)
-  plt.ylim([numpy.amin(inZ),20])
-  plt.title(title)
-  plt.savefig(outFileName)
-  plt.close()  
+  ax.set_ylim([numpy.amin(inZ),20])
+  figures[prefix]['figure'].savefig(outFileName)
 
 def plotHorizVertField(field, name, units, prefix, oceanDomain=True, vmin=None, vmax=None):
   if(vmin is None):
@@ -119,17 +167,16 @@ def plotHorizVertField(field, name, units, prefix, oceanDomain=True, vmin=None,
   print name, numpy.amin(field[cellMask == 1.0]), numpy.amax(field[cellMask == 1.0])
   plotHorizField(field[:,0], 'top %s (%s)'%(name,units), 'top%s'%prefix, oceanDomain, vmin=vmin, vmax=vmax)
   botField = numpy.zeros(nCells)
-  for iCell in range(nCells):
-    k = maxLevelCell[iCell]-1
-    if (k < 0):
-      continue
-    botField[iCell] = field[iCell,k]
   mask = maxLevelCell > 0
+  botField[mask] = field[numpy.arange(nCells)[mask],maxLevelCell[mask]-1]
   print 'bot.', name, numpy.amin(botField[mask]), numpy.amax(botField[mask])
   plotHorizField(botField, 'bot. %s (%s)'%(name,units), 'bot%s'%prefix, oceanDomain, vmin=vmin, vmax=vmax)
   field = field[sectionCellIndices,:].T
   plotVertField(field, '%s along center line (%s)'%(name,units), 'center%s'%prefix, vmin=vmin, vmax=vmax)
 
+def horizVertPrefixes(prefix):
+  return ['top%s'%prefix, 'bot%s'%prefix, 'center%s'%prefix]
+
 def computeSectionCellIndices():
   y = options.sectionY
   xMin = numpy.amin(xCell)
@@ -160,14 +207,28 @@ parser.add_option("--outImageFolder", type="string", default="plots", dest="outI
 parser.add_option("--inFolder", type="string", default=".", dest="inFolder")
 parser.add_option("--expt", type="int", default="1", dest="expt")
 parser.add_option("--sectionY", type="float", default=40e3, dest="sectionY")
+parser.add_option("--tStart", type="int", default=0, dest="tStart",
+                  help="first time index to plot")
+parser.add_option("--tEnd", type="int", default=None, dest="tEnd",
+                  help="time index after the last one to plot (default: all)")
+parser.add_option("--plots", type="string", default=None, dest="plots",
+                  help="comma-separated list of plots to make (e.g. bsf,Temp,osf; default: all)")
 
 options, args = parser.parse_args()
 
+if(options.plots is None):
+  plotNames = None
+else:
+  plotNames = options.plots.split(',')
+
 rho_sw = 1026.
 rho_fw = 1000.
 
 ferretMap = makeFerretColormap()
 
+# the figure, artist and colorbar of each plot, by prefix
+figures = {}
+
 try:
   os.makedirs(options.outImageFolder)
 except OSError as e:
@@ -208,6 +269,11 @@ nTime = len(outputFile.dimensions['Time'])
 nTime = min(nTime,len(bsfFile.dimensions['Time']))
 if(useOSF):
   nTime = min(nTime,len(osfFile.dimensions['Time']))
+tStart = options.tStart
+if(options.tEnd is None):
+  tEnd = nTime
+else:
+  tEnd = min(options.tEnd,nTime)
 
 nVerticesOnCell = numpy.array(outputFile.variables['nEdgesOnCell'])
 verticesOnCell = numpy.array(outputFile.variables['verticesOnCell'])-1
@@ -217,18 +283,16 @@ yVertex = numpy.array(outputFile.variables['yVertex'])
 maxLevelCell = numpy.array(outputFile.variables['maxLevelCell'])-1
 oceanMask = maxLevelCell >= 0
 cavityMask = numpy.logical_and(oceanMask,landIceFraction > 0.01)
-cellMask = numpy.zeros((nCells, nVertLevels))
-for iCell in range(nCells):
-  k = maxLevelCell[iCell]
-  if (k < 0):
-    continue
-  cellMask[iCell,0:k+1] = 1.0
+cellMask = 1.0*(numpy.arange(nVertLevels)[numpy.newaxis,:]
+                <= maxLevelCell[:,numpy.newaxis])
 
 oceanPatches = computeCellPatches(oceanMask)
 cavityPatches = computeCellPatches(cavityMask)
 
-for tIndex in range(nTime):
-  bsf = numpy.array(bsfFile.variables['barotropicStreamfunctionCell'])[tIndex,:]
+for tIndex in range(tStart,tEnd):
+  if(not plotNeeded('bsf', ['bsf'])):
+    continue
+  bsf = bsfFile.variables['barotropicStreamfunctionCell'][tIndex,:]
   if(options.expt == 1):
     vmin=-1
     vmax=1
@@ -251,106 +315,128 @@ X = numpy.zeros((nVertLevels+1,nx))
 for zIndex in range(nVertLevels+1):
   X[zIndex,:] = x
 
-for tIndex in range(nTime):
+horizVertPlots = ['Temp', 'Salinity', 'LayerThickness', 'Vx', 'Vy']
+
+for tIndex in range(tStart,tEnd):
   print tIndex+1, '/', nTime
-  layerThickness = numpy.ma.masked_array(outputFile.variables['layerThickness'][tIndex,:,:],cellMask == 0.0)
-  Z = numpy.ma.masked_all((nVertLevels+1,nx))
-  Z[0,:] = 0.0
-  for zIndex in range(0,nVertLevels):
-    layerThicknessSection = cellToSectionEdges(layerThickness[:,zIndex])
-    Z[zIndex+1,:] = Z[zIndex,:] - layerThicknessSection
-  ZMin = numpy.ma.amin(Z,axis=0)
-  offset = cellToSectionEdges(-bottomDepth) - ZMin
-  for zIndex in range(nVertLevels+1):
-    Z[zIndex,:] += offset
-
-  try:
-    secPerYear = 365*24*60*60
-    freshwaterFlux = landIceFluxesFile.variables['landIceFreshwaterFlux'][tIndex,:]
-    meltRate = freshwaterFlux/rho_fw*secPerYear
-    plotHorizField(meltRate, 'melt rate (m/yr)', 'meltRate', oceanDomain=False, vmin=-100., vmax=100.)
-  except KeyError:
-    print "Key landIceFreshwaterFlux not found."
-    pass
-
-  try:
-    flux = landIceFluxesFile.variables['landIceHeatFlux'][tIndex,:]
-    plotHorizField(flux, 'ocean heat flux (W/s)', 'oceanHeatFlux', oceanDomain=False, vmin=-1e3, vmax=1e3)
-  except KeyError:
-    print "Key landIceHeatFlux not found."
-    pass
-
-  try:
-    flux = landIceFluxesFile.variables['heatFluxToLandIce'][tIndex,:]
-    plotHorizField(flux, 'ice heat flux (W/s)', 'iceHeatFlux', oceanDomain=False, vmin=-1e1, vmax=1e1)
-  except KeyError:
-    print "Key heatFluxToLandIce not found."
-    pass
-
-  try:
-    Ti = landIceFluxesFile.variables['landIceInterfaceTemperature'][tIndex,:]
-    To = landIceFluxesFile.variables['landIceBoundaryLayerTemperature'][tIndex,:]
-    thermalDriving = To-Ti
-    plotHorizField(thermalDriving, 'thermal driving (deg C)', 'thermalDriving', oceanDomain=False, vmin=-2, vmax=2)
-  except KeyError:
-    print "Key landIceInterfaceTemperature or landIceBoundaryLayerTemperature not found."
-    pass
-  try:
-    Si = landIceFluxesFile.variables['landIceInterfaceSalinity'][tIndex,:]
-    So = landIceFluxesFile.variables['landIceBoundaryLayerSalinity'][tIndex,:]
-    halineDriving = So-Si
-    plotHorizField(halineDriving, 'haline driving (PSU)', 'halineDriving', oceanDomain=False, vmin=-10, vmax=10)
-  except KeyError:
-    print "Key landIceInterfaceSalinity or landIceBoundaryLayerSalinity not found."
-    pass
-  try:
-    uStar = landIceFluxesFile.variables['landIceFrictionVelocity'][tIndex,:]
-    plotHorizField(uStar, 'friction velocity (m/s)', 'fricVel', oceanDomain=True, vmin=0, vmax=0.05)
-  except KeyError:
-    print "Key landIceFrictionVelocity not found."
-    pass
-  temp = outputFile.variables['temperature'][tIndex,:,:]
-  plotHorizVertField(temp, 'temperature', 'deg C', 'Temp', oceanDomain=True, vmin=-2.5, vmax=1.0)
-
-  salt = outputFile.variables['salinity'][tIndex,:,:]
-  plotHorizVertField(salt, 'salinity', 'PSU', 'Salinity', oceanDomain=True, vmin=33.8, vmax=34.7)
-
-  plotHorizVertField(layerThickness, 'layer thickness', 'm', 'LayerThickness', oceanDomain=True, vmin=0.0, vmax=25.0)
-
-  ssh = outputFile.variables['ssh'][tIndex,:]
-  delta_ssh = ssh-sshRef
-  print 'delta_ssh', numpy.amin(delta_ssh), numpy.amax(delta_ssh)
-  #oceanThickness = numpy.sum(layerThickness,axis=1)
-  #sshDiff = ssh - (oceanThickness-bottomDepth)
-  #print 'sshDiff', numpy.amin(sshDiff), numpy.amax(sshDiff)
-  plotHorizField(delta_ssh, 'change in ssh (m)', 'deltaSSH', oceanDomain=True, vmin=-2, vmax=10)
-
-  #rho = numpy.array(outputFile.variables['potentialDensity'])[tIndex,:,:]-1000.
+
+  # the sections need the layer interfaces, but only if one is still to be
+  # plotted
+  needZ = False
+  for prefix in horizVertPlots:
+    needZ = needZ or plotNeeded(prefix, ['center%s'%prefix])
+  if(needZ or plotNeeded('LayerThickness', horizVertPrefixes('LayerThickness'))):
+    layerThickness = numpy.ma.masked_array(outputFile.variables['layerThickness'][tIndex,:,:],cellMask == 0.0)
+  if(needZ):
+    Z = numpy.ma.masked_all((nVertLevels+1,nx))
+    Z[0,:] = 0.0
+    for zIndex in range(0,nVertLevels):
+      layerThicknessSection = cellToSectionEdges(layerThickness[:,zIndex])
+      Z[zIndex+1,:] = Z[zIndex,:] - layerThicknessSection
+    ZMin = numpy.ma.amin(Z,axis=0)
+    offset = cellToSectionEdges(-bottomDepth) - ZMin
+    for zIndex in range(nVertLevels+1):
+      Z[zIndex,:] += offset
+
+  if(plotNeeded('meltRate', ['meltRate'])):
+    try:
+      secPerYear = 365*24*60*60
+      freshwaterFlux = landIceFluxesFile.variables['landIceFreshwaterFlux'][tIndex,:]
+      meltRate = freshwaterFlux/rho_fw*secPerYear
+      plotHorizField(meltRate, 'melt rate (m/yr)', 'meltRate', oceanDomain=False, vmin=-100., vmax=100.)
+    except KeyError:
+      print "Key landIceFreshwaterFlux not found."
+      pass
+
+  if(plotNeeded('oceanHeatFlux', ['oceanHeatFlux'])):
+    try:
+      flux = landIceFluxesFile.variables['landIceHeatFlux'][tIndex,:]
+      plotHorizField(flux, 'ocean heat flux (W/s)', 'oceanHeatFlux', oceanDomain=False, vmin=-1e3, vmax=1e3)
+    except KeyError:
+      print "Key landIceHeatFlux not found."
+      pass
+
+  if(plotNeeded('iceHeatFlux', ['iceHeatFlux'])):
+    try:
+      flux = landIceFluxesFile.variables['heatFluxToLandIce'][tIndex,:]
+      plotHorizField(flux, 'ice heat flux (W/s)', 'iceHeatFlux', oceanDomain=False, vmin=-1e1, vmax=1e1)
+    except KeyError:
+      print "Key heatFluxToLandIce not found."
+      pass
+
+  if(plotNeeded('thermalDriving', ['thermalDriving'])):
+    try:
+      Ti = landIceFluxesFile.variables['landIceInterfaceTemperature'][tIndex,:]
+      To = landIceFluxesFile.variables['landIceBoundaryLayerTemperature'][tIndex,:]
+      thermalDriving = To-Ti
+      plotHorizField(thermalDriving, 'thermal driving (deg C)', 'thermalDriving', oceanDomain=False, vmin=-2, vmax=2)
+    except KeyError:
+      print "Key landIceInterfaceTemperature or landIceBoundaryLayerTemperature not found."
+      pass
+  if(plotNeeded('halineDriving', ['halineDriving'])):
+    try:
+      Si = landIceFluxesFile.variables['landIceInterfaceSalinity'][tIndex,:]
+      So = landIceFluxesFile.variables['landIceBoundaryLayerSalinity'][tIndex,:]
+      halineDriving = So-Si
+      plotHorizField(halineDriving, 'haline driving (PSU)', 'halineDriving', oceanDomain=False, vmin=-10, vmax=10)
+    except KeyError:
+      print "Key landIceInterfaceSalinity or landIceBoundaryLayerSalinity not found."
+      pass
+  if(plotNeeded('fricVel', ['fricVel'])):
+    try:
+      uStar = landIceFluxesFile.variables['landIceFrictionVelocity'][tIndex,:]
+      plotHorizField(uStar, 'friction velocity (m/s)', 'fricVel', oceanDomain=True, vmin=0, vmax=0.05)
+    except KeyError:
+      print "Key landIceFrictionVelocity not found."
+      pass
+  if(plotNeeded('Temp', horizVertPrefixes('Temp'))):
+    temp = outputFile.variables['temperature'][tIndex,:,:]
+    plotHorizVertField(temp, 'temperature', 'deg C', 'Temp', oceanDomain=True, vmin=-2.5, vmax=1.0)
+
+  if(plotNeeded('Salinity', horizVertPrefixes('Salinity'))):
+    salt = outputFile.variables['salinity'][tIndex,:,:]
+    plotHorizVertField(salt, 'salinity', 'PSU', 'Salinity', oceanDomain=True, vmin=33.8, vmax=34.7)
+
+  if(plotNeeded('LayerThickness', horizVertPrefixes('LayerThickness'))):
+    plotHorizVertField(layerThickness, 'layer thickness', 'm', 'LayerThickness', oceanDomain=True, vmin=0.0, vmax=25.0)
+
+  if(plotNeeded('deltaSSH', ['deltaSSH'])):
+    ssh = outputFile.variables['ssh'][tIndex,:]
+    delta_ssh = ssh-sshRef
+    print 'delta_ssh', numpy.amin(delta_ssh), numpy.amax(delta_ssh)
+    #oceanThickness = numpy.sum(layerThickness,axis=1)
+    #sshDiff = ssh - (oceanThickness-bottomDepth)
+    #print 'sshDiff', numpy.amin(sshDiff), numpy.amax(sshDiff)
+    plotHorizField(delta_ssh, 'change in ssh (m)', 'deltaSSH', oceanDomain=True, vmin=-2, vmax=10)
+
+  #rho = outputFile.variables['potentialDensity'][tIndex,:,:]-1000.
   #plotHorizVertField(rho, 'potential density', 'kg/m^3 - 1000.', 'PotRho', vmin=27., vmax=28.)
 
-#  N = numpy.array(outputFile.variables['BruntVaisalaFreqTop'])[tIndex,:,:]
+#  N = outputFile.variables['BruntVaisalaFreqTop'][tIndex,:,:]
 #  plotHorizVertField(N, 'Brunt Vaisala freq.', '1/s', 'BruntVaisala')
-  vx = numpy.array(outputFile.variables['velocityX'])[tIndex,:,:]
-  plotHorizVertField(vx, 'X velocity', 'm/s', 'Vx', oceanDomain=True)
-  vy = numpy.array(outputFile.variables['velocityY'])[tIndex,:,:]
-  plotHorizVertField(vy, 'Y velocity', 'm/s', 'Vy', oceanDomain=True)
-#  Ri = numpy.array(outputFile.variables['RiTopOfCell'])[tIndex,:,:-1]
+  if(plotNeeded('Vx', horizVertPrefixes('Vx'))):
+    vx = outputFile.variables['velocityX'][tIndex,:,:]
+    plotHorizVertField(vx, 'X velocity', 'm/s', 'Vx', oceanDomain=True)
+  if(plotNeeded('Vy', horizVertPrefixes('Vy'))):
+    vy = outputFile.variables['velocityY'][tIndex,:,:]
+    plotHorizVertField(vy, 'Y velocity', 'm/s', 'Vy', oceanDomain=True)
+#  Ri = outputFile.variables['RiTopOfCell'][tIndex,:,:-1]
 #  plotHorizVertField(Ri, 'Richardson number', 'nondim.', 'Ri',vmin=-1., vmax=1.)
 #  try:
-#    vertVisc = numpy.array(outputFile.variables['vertViscTopOfCell'])[tIndex,:,:-1]
+#    vertVisc = outputFile.variables['vertViscTopOfCell'][tIndex,:,:-1]
 #    plotHorizVertField(vertVisc, 'Vertical viscosity', 'm^2/s', 'VertVisc')
 #  except KeyError:
 #    print "Key vertViscTopOfCell not found."
 #    pass
 
 #  try:
-#    vertDiff = numpy.array(outputFile.variables['vertDiffTopOfCell'])[tIndex,:,:-1]
+#    vertDiff = outputFile.variables['vertDiffTopOfCell'][tIndex,:,:-1]
 #    plotHorizVertField(vertDiff, 'Vertical difusivity', 'm^2/s', 'VertDiff')
 #  except KeyError:
 #    print "Key vertDiffTopOfCell not found."
 #    pass
 
-  if(useOSF):
+  if(useOSF and plotNeeded('osf', ['osf'])):
     osf = osfFile.variables['overturningStreamfunction'][tIndex,:,:]
     if(options.expt == 1):
       vmin=-0.3
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+This script fills the shared input-file cache with the files that test cases
+require (their <get_file> tags), so that setting up the test cases later
+doesn't need to download anything.
+
+The cache is the directory given by the file_cache option in the paths section
+of the configuration file. The test cases are either those of a regression
+suite (-t), or those given by case number (-n), as listed by
+list_testcases.py. Up to --jobs files are downloaded at once.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import sys
+import os
+import fnmatch
+import argparse
+from multiprocessing.pool import ThreadPool
+from six.moves import configparser
+
+from xml_cache import parse_xml
+from list_testcases import get_test_cases
+import file_cache
+
+
+def get_suite_test_cases(suite_file):  # {{{
+    # The (core, configuration, resolution, test) of each test in a suite
+    suite_root = parse_xml(suite_file)
+    test_cases = list()
+    for test_tag in suite_root.iter('test'):
+        test_cases.append(tuple(test_tag.attrib[tag] for tag in
+                                ['core', 'configuration', 'resolution',
+                                 'test']))
+    return test_cases
+# }}}
+
+
+def get_required_files(test_cases):  # {{{
+    # The required files of the test cases, as a list of (file name, hash,
+    # mirror urls), with each file (and hash) only once.
+    files = dict()
+    for test_case in test_cases:
+        test_path = '{}/{}/{}/{}'.format(*test_case)
+        for file in sorted(os.listdir(test_path)):
+            if not fnmatch.fnmatch(file, '*.xml'):
+                continue
+            config_root = parse_xml('{}/{}'.format(test_path, file))
+            if config_root.tag != 'config':
+                continue
+            for get_file in config_root:
+                if get_file.tag != 'get_file':
+                    continue
+                file_name = get_file.attrib['file_name']
+                file_hash = get_file.attrib.get('hash')
+                key = file_cache.get_cache_key(file_name, file_hash)
+                if key not in files:
+                    files[key] = (file_name, file_hash, list())
+                urls = files[key][2]
+                for mirror in get_file.iter('mirror'):
+                    if mirror.attrib.get('protocol') == 'wget' and \
+                            mirror.attrib['url'] not in urls:
+                        urls.append(mirror.attrib['url'])
+
+    return [files[key] for key in sorted(files.keys())]
+# }}}
+
+
+def prefetch_file(task):  # {{{
+    cache_dir, (file_name, file_hash, urls) = task
+    try:
+        object_file = file_cache.fetch_into_cache(file_name, urls, cache_dir,
+                                                  file_hash)
+    except (IOError, OSError) as e:
+        # The cache isn't writable by this user
+        print(" Can't write '{}' to the cache: {}".format(file_name, e))
+        object_file = None
+    return file_name, object_file is not None
+# }}}
+
+
+if __name__ == "__main__":
+    # Define and process input arguments
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-f", "--config_file", dest="config_file",
+                        help="Configuration file for test case setup",
+                        metavar="FILE")
+    parser.add_argument("-t", "--test_suite", dest="test_suite",
+                        help="Path to file containing a test suite whose "
+                             "files should be cached", metavar="FILE")
+    parser.add_argument("-n", "--case_number", dest="case_num",
+                        help="Case number whose files should be cached, as "
+                             "listed from list_testcases.py. Can be a comma "
+                             "delimited list of case numbers.", metavar="NUM")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=4,
+                        help="Number of files to download at once.",
+                        metavar="NUM")
+
+    args = parser.parse_args()
+
+    if not args.config_file:
+        print("WARNING: No configuration file specified. Using the default "
+              "of 'local.config'")
+        args.config_file = 'local.config'
+
+    if not os.path.exists(args.config_file):
+        parser.error(" Configuration file '{}' does not exist. Please create "
+                     "and setup before running again.".format(
+                         args.config_file))
+
+    if not args.test_suite and not args.case_num:
+        parser.error(' Either a test suite (-t) or case numbers (-n) are '
+                     'required.')
+
+    if args.jobs < 1:
+        parser.error("--jobs must be a positive number of files.")
+
+    if sys.version_info >= (3, 2):
+        config = configparser.ConfigParser()
+    else:
+        config = configparser.SafeConfigParser()
+    config.read(args.config_file)
+
+    if not config.has_option('paths', 'file_cache'):
+        parser.error(" Configuration file '{}' has no file_cache option in "
+                     "its paths section.".format(args.config_file))
+    cache_dir = config.get('paths', 'file_cache')
+
+    if args.test_suite:
+        args.test_suite = os.path.abspath(args.test_suite)
+
+    # Paths to test cases are relative to this script
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+    test_cases = list()
+    if args.test_suite:
+        test_cases.extend(get_suite_test_cases(args.test_suite))
+    if args.case_num:
+        all_test_cases = get_test_cases()
+        test_cases.extend([all_test_cases[int(case_num) - 1]
+                           for case_num in args.case_num.split(',')])
+
+    files = get_required_files(test_cases)
+    print("Caching {} files in {}".format(len(files), cache_dir))
+
+    failed = False
+    pool = ThreadPool(processes=args.jobs)
+    try:
+        for file_name, success in pool.imap_unordered(
+                prefetch_file, [(cache_dir, task) for task in files]):
+            if success:
+                print(" -- Cached {}".format(file_name))
+            else:
+                print(" -- Failed to cache {}".format(file_name))
+                failed = True
+    finally:
+        pool.close()
+        pool.join()
+
+    if failed:
+        sys.exit(1)
+
+# vim: foldmethod=marker ai ts=4 sts=4 et sw=4 ft=python
@@ -21,23 +21,26 @@ import os
 import fnmatch
 import argparse
 import xml.etree.ElementTree as ET
+from xml_cache import parse_xml, parse_xml_copy
+import file_cache
 import subprocess
 from six.moves import configparser
 import textwrap
-import netCDF4
 import shutil
 import errno
+import multiprocessing
 
-try:
-    from collections import defaultdict
-except ImportError:
-    from utils import defaultdict
+from list_testcases import get_test_cases
 
 
 # *** Namelist setup functions *** # {{{
+# Parsed namelist templates, keyed by path, so that each template is read once
+# no matter how many cases are set up from it
+namelist_templates = dict()
+
+
 def generate_namelist_files(config_file, case_path, configs):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
+    config_root = parse_xml(config_file)
 
     # Iterate over all namelists to be generated
     for namelists in config_root.iter('namelist'):
@@ -65,67 +68,98 @@ def generate_namelist_files(config_file, case_path, configs):  # {{{
 
         template_namelist = configs.get("namelists", namelist_mode)
 
-        # Ingest namelist template into a dictionary
-        namelist_dict = defaultdict(lambda: defaultdict(list))
-        ingest_namelist(template_namelist, namelist_dict)
+        # Start from a copy of the (cached) namelist template
+        namelist = copy_namelist(ingest_namelist(template_namelist))
 
-        # Modify the dictionary to have the desired values
-        configure_namelist(namelist_dict, namelists, configs)
+        # Modify the namelist to have the desired values
+        configure_namelist(namelist, namelists, configs)
 
-        # Write the namelist using the template to determine the writing order.
-        write_namelist(namelist_dict, namelist_file, template_namelist)
-        del namelist_dict
+        # Write the namelist in the order of the template.
+        write_namelist(namelist, namelist_file)
+        del namelist
 
     del config_root
-    del config_tree
 # }}}
 
 
-def ingest_namelist(namelist_file, namelist_dict):  # {{{
+def ingest_namelist(namelist_file):  # {{{
+    # Parse a namelist template, or return it from the cache if it has already
+    # been parsed.  The namelist is a dictionary with:
+    #   records - list of (record name, record line, list of option names), in
+    #             the order of the template
+    #   option_records - for each option name, the records it appears in
+    #   values - the value of each option, keyed by (record name, option name)
+    # The cached namelist must not be modified; use copy_namelist() first.
+    if namelist_file in namelist_templates:
+        return namelist_templates[namelist_file]
+
     # Read the template file
     namelistfile = open(namelist_file, 'r')
     lines = namelistfile.readlines()
+    namelistfile.close()
 
-    record_name = 'NONE!!!'
+    records = list()
+    option_records = dict()
+    values = dict()
+    options = None
 
-    # Add each linke into the corresponding record / option entry in the
-    # dictionary.
+    # Add each line into the corresponding record / option entry.
     for line in lines:
         if line.find('&') >= 0:
             record_name = line.strip().strip('&').strip('\n')
-            namelist_dict[record_name] = defaultdict(list)
+            options = list()
+            records.append((record_name, line, options))
         elif line.find('=') >= 0:
             opt, val = line.strip().strip('\n').split('=')
-            if record_name != "NONE!!!":
-                namelist_dict[record_name][opt].append(val)
+            if options is not None:
+                opt = opt.strip()
+                options.append(opt)
+                key = (record_name, opt)
+                if key not in values:
+                    values[key] = val
+                    option_records.setdefault(opt, list()).append(
+                        record_name)
+
+    namelist = {'file': namelist_file, 'records': records,
+                'option_records': option_records, 'values': values}
+    namelist_templates[namelist_file] = namelist
+    return namelist
 # }}}
 
 
-def set_namelist_val(namelist_dict, option_name, option_val):  # {{{
-    # Set the value of the namelist option.
-    for record, opts in namelist_dict.items():
-        for opt, val in opts.items():
-            if opt.strip() == option_name:
-                val[0] = option_val
+def copy_namelist(namelist):  # {{{
+    # Copy a namelist so its values can be changed.  Only the values are
+    # copied; the records and the option index are shared with the template.
+    namelist_copy = dict(namelist)
+    namelist_copy['values'] = dict(namelist['values'])
+    return namelist_copy
 # }}}
 
 
-def configure_namelist(namelist_dict, namelist_tag, configs):  # {{{
+def set_namelist_val(namelist, option_name, option_val):  # {{{
+    # Set the value of the namelist option in every record that has it.
+    values = namelist['values']
+    for record_name in namelist['option_records'].get(option_name, []):
+        values[(record_name, option_name)] = option_val
+# }}}
+
+
+def configure_namelist(namelist, namelist_tag, configs):  # {{{
     # Iterate over all children within the namelist tag.
     for child in namelist_tag:
         # Process <option> tags
         if child.tag == 'option':
             option_name = child.attrib['name']
             option_val = child.text
-            set_namelist_val(namelist_dict, option_name, option_val)
+            set_namelist_val(namelist, option_name, option_val)
         # Process <template> tags
         elif child.tag == 'template':
-            apply_namelist_template(namelist_dict, child, configs)
+            apply_namelist_template(namelist, child, configs)
 
 # }}}
 
 
-def apply_namelist_template(namelist_dict, template_tag, configs):  # {{{
+def apply_namelist_template(namelist, template_tag, configs):  # {{{
     # Determine the template information, like it's path and the filename
     template_info = get_template_info(template_tag, configs)
 
@@ -134,8 +168,7 @@ def apply_namelist_template(namelist_dict, template_tag, configs):  # {{{
                                    template_info['template_file'])
 
     # Parse the template
-    template_tree = ET.parse(template_file)
-    template_root = template_tree.getroot()
+    template_root = parse_xml(template_file)
 
     # Apply the template, by changing each option
     for child in template_root:
@@ -144,42 +177,26 @@ def apply_namelist_template(namelist_dict, template_tag, configs):  # {{{
                 if grandchild.tag == 'option':
                     option_name = grandchild.attrib['name']
                     option_val = grandchild.text
-                    set_namelist_val(namelist_dict, option_name, option_val)
+                    set_namelist_val(namelist, option_name, option_val)
                 elif grandchild.tag == 'template':
-                    apply_namelist_template(namelist_dict, grandchild, configs)
+                    apply_namelist_template(namelist, grandchild, configs)
 
     del template_root
-    del template_tree
     del template_info
 # }}}
 
 
-def write_namelist(namelist_dict, outfilename, infilename):  # {{{
-    # Write the namelist out, using the infilename as a template to determine
-    # the writing order.
-    in_namelist = open(infilename, 'r')
-    lines = in_namelist.readlines()
-    in_namelist.close()
+def write_namelist(namelist, outfilename):  # {{{
+    # Write the namelist out, in the order of its template.
+    values = namelist['values']
 
     out_namelist = open(outfilename, 'w+')
 
-    record_name = 'NONE!!!'
-
-    for line in lines:
-        if line.find('&') >= 0:
-            if record_name != "NONE!!!":
-                out_namelist.write('/\n')
-
-            record_name = line.strip().strip('&').strip('\n')
-            out_namelist.write(line)
-        elif line.find('=') >= 0:
-            opt, val = line.strip().strip('\n').split('=')
-            if record_name != "NONE!!!":
-                out_namelist.write('    {} = {}\n'.format(
-                        opt.strip(),
-                        namelist_dict[record_name][opt][0].strip()))
-
-    if record_name != "NONE!!!":
+    for record_name, record_line, options in namelist['records']:
+        out_namelist.write(record_line)
+        for opt in options:
+            out_namelist.write('    {} = {}\n'.format(
+                    opt, values[(record_name, opt)].strip()))
         out_namelist.write('/\n')
 
     out_namelist.close()
@@ -190,8 +207,7 @@ def write_namelist(namelist_dict, outfilename, infilename):  # {{{
 # *** Streams setup functions *** # {{{
 
 def generate_streams_files(config_file, case_path, configs):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
+    config_root = parse_xml(config_file)
 
     # Iterate over all sterams files to be generated
     for streams in config_root:
@@ -217,8 +233,7 @@ def generate_streams_files(config_file, case_path, configs):  # {{{
             template_streams = configs.get("streams", streams_mode)
 
             # Parse the template
-            streams_tree = ET.parse(template_streams)
-            streams_root = streams_tree.getroot()
+            streams_root = parse_xml_copy(template_streams)
 
             # Configure the new streams file, using the template as a starting
             # place.
@@ -229,7 +244,6 @@ def generate_streams_files(config_file, case_path, configs):  # {{{
                                '{}'.format(case_path))
 
             del streams_root
-            del streams_tree
 # }}}
 
 
@@ -339,8 +353,7 @@ def apply_stream_template(streams_file, template_tag, configs):  # {{{
                                    template_info['template_file'])
 
     # Parse the template
-    template_tree = ET.parse(template_file)
-    template_root = template_tree.getroot()
+    template_root = parse_xml(template_file)
 
     # Apply the streams portion of the template to the streams file
     for child in template_root:
@@ -351,15 +364,13 @@ def apply_stream_template(streams_file, template_tag, configs):  # {{{
                 elif grandchild.tag == 'template':
                     apply_stream_template(streams_file, grandchild, configs)
 
-    del template_tree
     del template_root
     del template_info
 # }}}
 
 
 def write_streams_file(streams, config_file, filename, init_path):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
+    config_root = parse_xml(config_file)
 
     stream_file = open(filename, 'w')
 
@@ -444,7 +455,6 @@ def write_streams_file(streams, config_file, filename, init_path):  # {{{
     stream_file.write('\n')
     stream_file.write('</streams>\n')
 
-    del config_tree
     del config_root
 # }}}
 # }}}
@@ -452,8 +462,7 @@ def write_streams_file(streams, config_file, filename, init_path):  # {{{
 
 # *** Script Generation Functions *** # {{{
 def generate_run_scripts(config_file, init_path, configs):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
+    config_root = parse_xml(config_file)
     dev_null = open('/dev/null', 'r+')
 
     for run_script in config_root:
@@ -496,19 +505,17 @@ def generate_run_scripts(config_file, init_path, configs):  # {{{
                                   stdout=dev_null, stderr=dev_null)
 
     dev_null.close()
-    del config_tree
     del config_root
 # }}}
 
 
 def generate_driver_scripts(config_file, configs):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
+    config_root = parse_xml(config_file)
     dev_null = open('/dev/null', 'r+')
 
     # init_path is where the driver script will live after it's generated.
-    init_path = '{}/{}'.format(config.get('script_paths', 'work_dir'),
-                               config.get('script_paths', 'config_path'))
+    init_path = '{}/{}'.format(configs.get('script_paths', 'work_dir'),
+                               configs.get('script_paths', 'config_path'))
 
     # Ensure we're in a <driver_script> tag
     if config_root.tag == 'driver_script':
@@ -777,55 +784,32 @@ def process_compare_fields_step(compare_tag, configs, script):  # {{{
         baseline_root = '{}/{}'.format(baseline_root,
                                        configs.get('script_paths', 'test_dir'))
 
+    # Gather all fields, including those from templates, so each pair of
+    # files is compared in a single pass.
+    field_tags = list()
     for child in compare_tag:
         # Process field comparisons
         if child.tag == 'field':
-            if not (missing_file1 or missing_file2):
-                process_field_definition(child, configs, script, file1, file2,
-                                         False)
-
-            if not missing_file1 and baseline_root != 'NONE':
-                process_field_definition(child, configs, script, file1,
-                                         '{}/{}'.format(baseline_root, file1),
-                                         True)
-
-            if not missing_file2 and baseline_root != 'NONE':
-                process_field_definition(child, configs, script, file2,
-                                         '{}/{}'.format(baseline_root, file2),
-                                         True)
+            field_tags.append(child)
         # Process field comparison template
         elif child.tag == 'template':
-            apply_compare_fields_template(child, compare_tag, configs, script)
-# }}}
+            apply_compare_fields_template(child, configs, field_tags)
 
+    if not (missing_file1 or missing_file2):
+        process_field_definitions(field_tags, configs, script, file1, file2,
+                                  False)
 
-def apply_compare_fields_template(template_tag, compare_tag, configs, script):
-    # {{{
-    missing_file1 = False
-    missing_file2 = False
-    # Determine comparison attributes
-    try:
-        file1 = compare_tag.attrib['file1']
-    except KeyError:
-        missing_file1 = True
-
-    try:
-        file2 = compare_tag.attrib['file2']
-    except KeyError:
-        missing_file2 = True
+    if not missing_file1 and baseline_root != 'NONE':
+        process_field_definitions(field_tags, configs, script, file1,
+                                  '{}/{}'.format(baseline_root, file1), True)
 
-    if missing_file1 and missing_file2:
-        print("ERROR: <compare_fields> tag is missing both 'file1' and "
-              "'file2' tags. At least one is required.")
-        print("Exiting...")
-        sys.exit(1)
+    if not missing_file2 and baseline_root != 'NONE':
+        process_field_definitions(field_tags, configs, script, file2,
+                                  '{}/{}'.format(baseline_root, file2), True)
+# }}}
 
-    # Build the path to the baselines
-    baseline_root = configs.get('script_paths', 'baseline_dir')
-    if baseline_root != 'NONE':
-        baseline_root = '{}/{}'.format(baseline_root,
-                                       configs.get('script_paths', 'test_dir'))
 
+def apply_compare_fields_template(template_tag, configs, field_tags):  # {{{
     # Determine template information, like path and filename
     template_info = get_template_info(template_tag, configs)
 
@@ -833,8 +817,7 @@ def apply_compare_fields_template(template_tag, compare_tag, configs, script):
                                    template_info['template_file'])
 
     # Parse the template
-    template_tree = ET.parse(template_file)
-    template_root = template_tree.getroot()
+    template_root = parse_xml(template_file)
 
     # Find a child tag that is validation->compare_fields->field, and add each
     # field
@@ -844,64 +827,51 @@ def apply_compare_fields_template(template_tag, compare_tag, configs, script):
                 if compare_fields.tag == 'compare_fields':
                     for field in compare_fields:
                         if field.tag == 'field':
-                            if not (missing_file1 or missing_file2):
-                                process_field_definition(field, configs,
-                                                         script, file1, file2,
-                                                         False)
-
-                            if not missing_file1 and baseline_root != 'NONE':
-                                process_field_definition(
-                                    field, configs, script, file1,
-                                    '{}/{}'.format(baseline_root, file1), True)
-
-                            if not missing_file2 and baseline_root != 'NONE':
-                                process_field_definition(
-                                    field, configs, script, file2,
-                                    '{}/{}'.format(baseline_root, file2), True)
+                            field_tags.append(field)
                         elif field.tag == 'template':
-                            apply_compare_fields_template(field, compare_tag,
-                                                          configs, script)
+                            apply_compare_fields_template(field, configs,
+                                                          field_tags)
 
     del template_root
-    del template_tree
     del template_info
 # }}}
 
 
-def process_field_definition(field_tag, configs, script, file1, file2,
-                             baseline_comp):  # {{{
+def process_field_definitions(field_tags, configs, script, file1, file2,
+                              baseline_comp):  # {{{
+    if len(field_tags) == 0:
+        return
+
     # Build the path to the comparison script.
     compare_executable = '{}/compare_fields.py'.format(
         configs.get('script_paths', 'utility_scripts'))
 
-    field_name = field_tag.attrib['name']
+    # Build the base command to compare all fields in one pass over the files
+    command_args = [compare_executable, '-q', '-1', file1, '-2', file2]
 
-    # Build the base command to compare the fields
-    command_args = [compare_executable, '-q', '-1', file1, '-2', file2, '-v',
-                    field_name]
+    for field_tag in field_tags:
+        field_spec = field_tag.attrib['name']
 
-    # Determine norm thresholds
-    if baseline_comp:
-        command_args.extend(['--l1', '0.0', '--l2', '0.0', '--linf', '0.0'])
-    else:
-        if 'l1_norm' in field_tag.attrib.keys():
-            command_args.extend(['--l1', field_tag.attrib['l1_norm']])
-        if 'l2_norm' in field_tag.attrib.keys():
-            command_args.extend(['--l2', field_tag.attrib['l2_norm']])
-        if 'linf_norm' in field_tag.attrib.keys():
-            command_args.extend(['--linf', field_tag.attrib['linf_norm']])
+        # Determine norm thresholds
+        if baseline_comp:
+            field_spec = '{},l1=0.0,l2=0.0,linf=0.0'.format(field_spec)
+        else:
+            for norm in ['l1', 'l2', 'linf']:
+                attr = '{}_norm'.format(norm)
+                if attr in field_tag.attrib.keys():
+                    field_spec = '{},{}={}'.format(field_spec, norm,
+                                                   field_tag.attrib[attr])
+
+        command_args.extend(['--field', field_spec])
 
     command = wrap_subprocess_command(command_args, indentation='    ',
                                       quiet=False)
 
-    # Write the pass/fail logic.
+    # Write the pass/fail logic. compare_fields.py reports the result for
+    # each field.
     script.write('try:\n')
     script.write('{}\n'.format(command))
-    script.write("    print(' ** PASS Comparison of {} between {} and\\n'\n"
-                 "          '    {}')\n".format(field_name, file1, file2))
     script.write('except subprocess.CalledProcessError:\n')
-    script.write("    print(' ** FAIL Comparison of {} between {} and\\n'\n"
-                 "          '    {}')\n".format(field_name, file1, file2))
     script.write('    error = True\n')
 # }}}
 # }}}
@@ -977,8 +947,7 @@ def apply_compare_timers_template(template_tag, compare_tag, configs, script):
                                    template_info['template_file'])
 
     # Parse template file
-    template_tree = ET.parse(template_file)
-    template_root = template_tree.getroot()
+    template_root = parse_xml(template_file)
 
     for validation in template_root:
         if validation.tag == 'validation':
@@ -1005,7 +974,6 @@ def apply_compare_timers_template(template_tag, compare_tag, configs, script):
                             apply_compare_timers_template(timer, compare_tag,
                                                           configs, script)
     del template_root
-    del template_tree
     del template_info
 
 # }}}
@@ -1023,12 +991,43 @@ def process_timer_definition(timer_tag, configs, script, basedir, compdir):
         print("Exiting...")
         sys.exit(1)
 
-    command = 'subprocess.check_call(["{}", "-b", "{}", "-c", "{}", "-t", ' \
-              '"{}"])'.format(compare_script, compdir, basedir, timer_name)
+    command_args = [compare_script, '-b', basedir, '-c', compdir, '-t',
+                    timer_name]
+
+    # A tolerance turns the comparison into a performance-regression gate
+    reference = 'baseline'
+    if 'tolerance' in timer_tag.attrib:
+        command_args.extend(['--tolerance', timer_tag.attrib['tolerance']])
+        if 'reference' in timer_tag.attrib:
+            reference = timer_tag.attrib['reference']
+            if reference not in ['baseline', 'median']:
+                print("ERROR: <timer> tag has an invalid reference '{}'. "
+                      "Valid references are 'baseline' and "
+                      "'median'.".format(reference))
+                print("Exiting...")
+                sys.exit(1)
+            command_args.extend(['--reference', reference])
+        if 'window' in timer_tag.attrib:
+            command_args.extend(['--window', timer_tag.attrib['window']])
+
+    # Every compared run is recorded in the timer history, keyed by the test
+    # case and run directory
+    command_args.extend(['--history', get_timer_history(configs),
+                         '--history_key', '{}/{}'.format(
+                             configs.get('script_paths', 'test_dir'),
+                             compdir)])
+
+    command = 'subprocess.check_call([{}])'.format(
+        ', '.join(['"{}"'.format(arg) for arg in command_args]))
 
     script.write('\n')
-    script.write('if os.path.exists("{}") and \\\n'
-                 '        os.path.exists("{}"):\n'.format(compdir, basedir))
+    if reference == 'median':
+        # The history median doesn't need a baseline run
+        script.write('if os.path.exists("{}"):\n'.format(compdir))
+    else:
+        script.write('if os.path.exists("{}") and \\\n'
+                     '        os.path.exists("{}"):\n'.format(compdir,
+                                                             basedir))
     script.write('    try:\n')
     script.write('        {}\n'.format(command))
     script.write("        print(' ** PASS Comparison of timer {} between {} "
@@ -1042,14 +1041,24 @@ def process_timer_definition(timer_tag, configs, script, basedir, compdir):
                                                     basedir))
     script.write("        error = True\n")
 # }}}
+
+
+def get_timer_history(configs):  # {{{
+    # The timer history lives at the timer_history path of the config file,
+    # or otherwise in the work directory, so it persists across runs of the
+    # same suite.
+    if configs.has_option('paths', 'timer_history'):
+        return configs.get('paths', 'timer_history')
+    return '{}/timer_history.db'.format(configs.get('script_paths',
+                                                    'work_dir'))
+# }}}
 # }}}
 
 
 def process_model_run_step(model_run_tag, configs, script):  # {{{
     run_definition_file = configs.get('script_input_arguments',
                                       'model_runtime')
-    run_config_tree = ET.parse(run_definition_file)
-    run_config_root = run_config_tree.getroot()
+    run_config_root = parse_xml_copy(run_definition_file)
 
     dev_null = open('/dev/null', 'r+')
 
@@ -1075,18 +1084,18 @@ def process_model_run_step(model_run_tag, configs, script):  # {{{
                     arg_text = grandchild.text
 
                     if arg_text == 'model':
-                        executable_full_path = config.get('executables',
-                                                          executable_name)
+                        executable_full_path = configs.get('executables',
+                                                           executable_name)
                         executable_parts = executable_full_path.split('/')
                         executable_link = \
                             executable_parts[len(executable_parts) - 1]
                         link_path = '{}/{}/{}'.format(
-                            config.get('script_paths', 'work_dir'),
-                            config.get('script_paths', 'case_dir'),
+                            configs.get('script_paths', 'work_dir'),
+                            configs.get('script_paths', 'case_dir'),
                             executable_link)
                         subprocess.check_call(
                             ['ln', '-sf',
-                             config.get('executables', executable_name),
+                             configs.get('executables', executable_name),
                              link_path],
                             stdout=dev_null, stderr=dev_null)
                         grandchild.text = './{}'.format(executable_link)
@@ -1164,8 +1173,7 @@ def wrap_subprocess_command(command_args, indentation, quiet):  # {{{
 
 # *** General Utility Functions *** #{{{
 def add_links(config_file, configs):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
+    config_root = parse_xml(config_file)
 
     case = config_root.attrib['case']
 
@@ -1257,8 +1265,7 @@ def get_source_file(child, config):  # {{{
 
 
 def copy_files(config_file, config):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
+    config_root = parse_xml(config_file)
 
     case = config_root.attrib['case']
 
@@ -1280,8 +1287,7 @@ def copy_files(config_file, config):  # {{{
 
 
 def make_case_dir(config_file, base_path):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
+    config_root = parse_xml(config_file)
 
     case_name = config_root.attrib['case']
 
@@ -1290,16 +1296,13 @@ def make_case_dir(config_file, base_path):  # {{{
         os.makedirs('{}/{}'.format(base_path, case_name))
 
     del config_root
-    del config_tree
 
     return case_name
 # }}}
 
 
 def get_defined_files(config_file, init_path, configs):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
-    dev_null = open('/dev/null', 'w')
+    config_root = parse_xml(config_file)
 
     for get_file in config_root:
         # Process <get_file> tag
@@ -1357,115 +1360,58 @@ def get_defined_files(config_file, init_path, configs):  # {{{
                     print(" Exiting...")
                     sys.exit(1)
 
-            # if the dest_path doesn't exist, create it
-            if not os.path.exists(dest_path):
-                os.makedirs(dest_path)
-
-            # If the file doesn't exist in dest_path, process it's mirrors
-            if not os.path.exists('{}/{}'.format(dest_path, file_name)):
-                file_found = False
-                if not file_found:
-                    for mirror in get_file:
-                        # Process each mirror
-                        if mirror.tag == 'mirror':
-                            # Determine the protocol for the mirror
-                            try:
-                                protocol = mirror.attrib['protocol']
-                            except KeyError:
-                                print("Mirror is missing the 'protocol' "
-                                      "attribute.")
-                                print("Exiting...")
-                                sys.exit(1)
-
-                            # Process a wget mirror
-                            if protocol == 'wget':
-                                if config.get('script_input_arguments',
-                                              'no_download') == 'no':
-                                    try:
-                                        path = '{}/{}'.format(
-                                            mirror.attrib['url'], file_name)
-                                    except KeyError:
-                                        print(" Mirror with protocol 'wget' "
-                                              "is missing a 'url' attribute")
-                                        print(" Exiting...")
-                                        sys.exit(1)
-
-                                    try:
-                                        subprocess.check_call(
-                                            ['wget', '-q', '{}'.format(path)],
-                                            stdout=dev_null, stderr=dev_null)
-                                    except subprocess.CalledProcessError:
-                                        print(" Wget failed....")
-
-                                    try:
-                                        subprocess.check_call(
-                                            ['mv', '{}'.format(file_name),
-                                             '{}/{}'.format(dest_path,
-                                                            file_name)],
-                                            stdout=dev_null, stderr=dev_null)
-                                    except subprocess.CalledProcessError:
-                                        print("  -- Web mirror attempt failed."
-                                              " Trying other mirrors...")
-
-                        # If the file exists in dest_path, determine if it
-                        # should be validated
-                        if os.path.exists('{}/{}'.format(dest_path,
-                                          file_name)):
-                            try:
-                                expected_hash = get_file.attrib['hash']
-                                validate_file = True
-                            except KeyError:
-                                validate_file = False
-
-                            # Validate the file, if requested (i.e. file had a
-                            # hash attribute)
-                            if validate_file:
-                                if os.path.exists('{}/{}'.format(dest_path,
-                                                                 file_name)):
-                                    nc = netCDF4.Dataset('{}/{}'.format(
-                                        dest_path, file_name), 'r')
-                                    try:
-                                        file_hash = nc.file_id
-                                    except AttributeError:
-                                        nc.close()
-                                        print(" Downloaded file '{}' does "
-                                              "not have a 'file_id' "
-                                              "attribute.".format(file_name))
-                                        print(" Deleting file and exiting...")
-                                        subprocess.check_call(
-                                            ['rm', '-f',
-                                             '{}/{}'.format(dest_path,
-                                                            file_name)],
-                                            stdout=dev_null, stderr=dev_null)
-                                        sys.exit(1)
-
-                                    nc.close()
-
-                                    if file_hash.strip() != \
-                                            expected_hash.strip():
-                                        print("*** ERROR: Base mesh has "
-                                              "hash of '{}' which does not "
-                                              "match expected hash of "
-                                              "'{}'.".format(file_hash,
-                                                             expected_hash))
-                                        print(" Deleting file...")
-                                        subprocess.check_call(
-                                            ['rm', '-f',
-                                             '{}/{}'.format(dest_path,
-                                                            file_name)],
-                                            stdout=dev_null, stderr=dev_null)
-
-                    # IF validation valied, exit.
-                    if not os.path.exists('{}/{}'.format(dest_path,
-                                                         file_name)):
-                        print(" Failed to acquire required file '{}'.".format(
-                            file_name))
-                        print(" Exiting...")
+            # Collect the urls of the mirrors
+            urls = list()
+            for mirror in get_file:
+                # Process each mirror
+                if mirror.tag == 'mirror':
+                    # Determine the protocol for the mirror
+                    try:
+                        protocol = mirror.attrib['protocol']
+                    except KeyError:
+                        print("Mirror is missing the 'protocol' "
+                              "attribute.")
+                        print("Exiting...")
                         sys.exit(1)
 
-    del config_tree
+                    # Process a wget mirror
+                    if protocol == 'wget':
+                        try:
+                            urls.append(mirror.attrib['url'])
+                        except KeyError:
+                            print(" Mirror with protocol 'wget' "
+                                  "is missing a 'url' attribute")
+                            print(" Exiting...")
+                            sys.exit(1)
+
+            # The file is validated if the tag has a hash attribute
+            try:
+                expected_hash = get_file.attrib['hash']
+            except KeyError:
+                expected_hash = None
+
+            # Get the file from the file cache, if there is one, or from its
+            # mirrors
+            download = configs.get('script_input_arguments',
+                                   'no_download') == 'no'
+            if not file_cache.get_file(file_name, dest_path, urls,
+                                       get_file_cache_dir(configs),
+                                       expected_hash, download):
+                print(" Failed to acquire required file '{}'.".format(
+                    file_name))
+                print(" Exiting...")
+                sys.exit(1)
+
     del config_root
-    dev_null.close()
+# }}}
+
+
+def get_file_cache_dir(configs):  # {{{
+    # The shared input-file cache is at the file_cache path of the config
+    # file.  Without one, files are downloaded straight into their dest_path.
+    if configs.has_option('paths', 'file_cache'):
+        return configs.get('paths', 'file_cache')
+    return None
 # }}}
 
 
@@ -1526,29 +1472,25 @@ def get_template_info(template, configs):  # {{{
 
 
 def get_config_file_type(config_file):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
+    config_root = parse_xml(config_file)
 
     # Determine file type
     file_type = config_root.tag
 
     del config_root
-    del config_tree
 
     return file_type
 # }}}
 
 
 def get_case_name(config_file):  # {{{
-    config_tree = ET.parse(config_file)
-    config_root = config_tree.getroot()
+    config_root = parse_xml(config_file)
 
     # Determine file type
     if config_root.tag == 'config':
         name = config_root.attrib['case']
 
     del config_root
-    del config_tree
 
     return name
 # }}}
@@ -1573,6 +1515,273 @@ def link_load_compass_env(init_path, configs):  # {{{
 # }}}
 
 
+# *** Test case setup functions *** # {{{
+def build_config(config_file, work_dir=None, model_runtime=None,
+                 baseline_dir=None, no_download=False,
+                 link_load_compass=False):  # {{{
+    # Read the configuration file and add the input arguments and paths that
+    # the setup functions need.
+    if sys.version_info >= (3, 2):
+        config = configparser.ConfigParser()
+    else:
+        config = configparser.SafeConfigParser()
+    config.read(config_file)
+
+    if not work_dir:
+        work_dir = os.getcwd()
+
+    # Add configuation information to the config object.
+    # This allows passing config around with all of the config options needed
+    # to build paths, and determine options.
+    config.add_section('script_input_arguments')
+    config.add_section('script_paths')
+
+    if baseline_dir:
+        config.set('script_paths', 'baseline_dir', baseline_dir)
+    else:
+        config.set('script_paths', 'baseline_dir', 'NONE')
+
+    if no_download:
+        config.set('script_input_arguments', 'no_download', 'yes')
+    else:
+        config.set('script_input_arguments', 'no_download', 'no')
+
+    config.set('script_paths', 'script_path',
+               os.path.dirname(os.path.realpath(__file__)))
+    config.set('script_paths', 'work_dir', os.path.abspath(work_dir))
+    config.set('script_paths', 'utility_scripts',
+               '{}/utility_scripts'.format(config.get('script_paths',
+                                                      'script_path')))
+
+    if not model_runtime:
+        config.set('script_input_arguments', 'model_runtime',
+                   '{}/runtime_definitions/mpirun.xml'.format(
+                       config.get('script_paths', 'script_path')))
+        print(' WARNING: No runtime definition selected. Using the default '
+              'of {}'.format(config.get('script_input_arguments',
+                                        'model_runtime')))
+    else:
+        config.set('script_input_arguments', 'model_runtime', model_runtime)
+
+    if not config.has_section('conda'):
+        config.add_section('conda')
+
+    if not config.has_option('conda', 'link_load_compass'):
+        config.set('conda', 'link_load_compass', 'False')
+
+    if link_load_compass:
+        config.set('conda', 'link_load_compass', 'True')
+
+    return config
+# }}}
+
+
+def set_test_case_paths(config, core, configuration, resolution,
+                        test):  # {{{
+    # Set the input arguments and paths of one test case in config.  Returns
+    # the path of the test case (relative to this script) and its work
+    # directory.
+    config.set('script_input_arguments', 'core', core)
+    config.set('script_input_arguments', 'configuration', configuration)
+    config.set('script_input_arguments', 'resolution', resolution)
+    config.set('script_input_arguments', 'test', test)
+
+    # Setup each xml file in the configuration directory:
+    test_path = '{}/{}/{}/{}'.format(core, configuration, resolution, test)
+    work_dir = '{}/{}'.format(config.get('script_paths', 'work_dir'),
+                              test_path)
+
+    # Set paths to core, configuration, resolution, and case for use in
+    # functions
+    config.set('script_paths', 'core_dir', core)
+    config.set('script_paths', 'configuration_dir',
+               '{}/{}'.format(core, configuration))
+    config.set('script_paths', 'resolution_dir',
+               '{}/{}/{}'.format(core, configuration, resolution))
+    config.set('script_paths', 'test_dir', test_path)
+    config.set('script_paths', 'config_path', test_path)
+
+    return test_path, work_dir
+# }}}
+
+
+def setup_test_case(config, core, configuration, resolution, test):  # {{{
+    # Set up the cases and driver script of one test case.  Paths are relative
+    # to the directory of this script, which must be the current directory.
+    # Returns True if anything was set up.
+    test_path, work_dir = set_test_case_paths(config, core, configuration,
+                                              resolution, test)
+
+    # Only write history if we did something...
+    write_history = False
+
+    # Loop over all files in test_path that have the .xml extension.
+    for file in os.listdir('{}'.format(test_path)):
+        if fnmatch.fnmatch(file, '*.xml'):
+            # Build full file name
+            config_file = '{}/{}'.format(test_path, file)
+
+            # Determine the type of the config file
+            # Could be config, driver_script, template, etc.
+            # The type is defined by the parent tag.
+            config_type = get_config_file_type(config_file)
+
+            # Process config files
+            if config_type == 'config':
+                write_history = True
+                # Ensure the case directory exists
+                case_dir = make_case_dir(config_file, work_dir)
+                case_name = get_case_name(config_file)
+
+                # Set case_dir path for function calls
+                config.set('script_paths', 'case_dir',
+                           '{}/{}'.format(config.get('script_paths',
+                                                     'test_dir'),
+                                          case_name))
+
+                case_path = '{}/{}'.format(work_dir, case_dir)
+
+                # Generate all namelists for this case
+                generate_namelist_files(config_file, case_path, config)
+
+                # Generate all streams files for this case
+                generate_streams_files(config_file, case_path, config)
+
+                # Ensure required files exist for this case
+                get_defined_files(config_file, '{}'.format(case_path),
+                                  config)
+
+                # Process all links for this case
+                add_links(config_file, config)
+
+                copy_files(config_file, config)
+
+                # Generate run scripts for this case.
+                generate_run_scripts(config_file, '{}'.format(case_path),
+                                     config)
+
+                print(" -- Set up case: {}/{}".format(work_dir, case_dir))
+            # Process driver scripts
+            elif config_type == 'driver_script':
+                write_history = True
+
+                # Generate driver scripts.
+                generate_driver_scripts(config_file, config)
+                print(" -- Set up driver script in {}".format(work_dir))
+
+    return write_history
+# }}}
+
+
+# The configuration shared with the worker processes
+worker_config = {}
+
+
+def init_setup_worker(config, output_file):  # {{{
+    worker_config['config'] = config
+
+    # Send everything the setup writes, including from subprocesses, to the
+    # output file
+    sys.stdout.flush()
+    sys.stderr.flush()
+    output = open(output_file, 'a')
+    os.dup2(output.fileno(), sys.stdout.fileno())
+    os.dup2(output.fileno(), sys.stderr.fileno())
+# }}}
+
+
+def get_test_case_files(test_cases):  # {{{
+    # Acquire the required files (<get_file> tags) of all the test cases in a
+    # single worker process, before any of them is set up.  Test cases often
+    # share files (even across configurations and resolutions), which would
+    # otherwise be downloaded to the same place by several workers at once.
+    # Once acquired, a file isn't downloaded again when its test cases are
+    # set up.  Returns the test cases whose files couldn't be acquired and
+    # the errors.
+    config = worker_config['config']
+    failed = list()
+    errors = list()
+    for test_case in test_cases:
+        try:
+            test_path, work_dir = set_test_case_paths(config, *test_case)
+            for file in sorted(os.listdir(test_path)):
+                if not fnmatch.fnmatch(file, '*.xml'):
+                    continue
+                config_file = '{}/{}'.format(test_path, file)
+                if get_config_file_type(config_file) != 'config':
+                    continue
+                case_name = get_case_name(config_file)
+                config.set('script_paths', 'case_dir',
+                           '{}/{}'.format(test_path, case_name))
+                get_defined_files(config_file,
+                                  '{}/{}'.format(work_dir, case_name), config)
+        except (Exception, SystemExit) as e:
+            failed.append(tuple(test_case))
+            errors.append('Failed to get the files of {}: {}'.format(
+                ' '.join(test_case), repr(e)))
+    sys.stdout.flush()
+    return failed, errors
+# }}}
+
+
+def setup_test_case_group(test_cases):  # {{{
+    # Set up a group of test cases in a worker process, one after the other.
+    # Returns the test cases that were set up and the error, if any.
+    config = worker_config['config']
+    done = list()
+    try:
+        for test_case in test_cases:
+            setup_test_case(config, *test_case)
+            done.append(test_case)
+    except (Exception, SystemExit) as e:
+        sys.stdout.flush()
+        return done, 'Failed to set up {}: {}'.format(
+            ' '.join(test_cases[len(done)]), repr(e))
+    sys.stdout.flush()
+    return done, None
+# }}}
+
+
+def setup_test_cases(config, test_cases, jobs=1, output_file='/dev/null'):
+    # {{{
+    # Set up a list of (core, configuration, resolution, test) test cases,
+    # with up to jobs of them at once in worker processes.  The required
+    # files of all test cases are acquired first, one at a time, and then
+    # test cases with the same core, configuration and resolution are set up
+    # one after the other.  The output of the setup goes to output_file.
+    # Returns the test cases that were set up and the errors.
+    done = list()
+    pool = multiprocessing.Pool(processes=max(1, min(jobs, len(test_cases))),
+                                initializer=init_setup_worker,
+                                initargs=(config, output_file))
+    try:
+        failed, errors = pool.apply(get_test_case_files, (test_cases,))
+
+        groups = list()
+        group_index = dict()
+        for test_case in test_cases:
+            if tuple(test_case) in failed:
+                continue
+            key = tuple(test_case[0:3])
+            if key not in group_index:
+                group_index[key] = len(groups)
+                groups.append(list())
+            groups[group_index[key]].append(tuple(test_case))
+
+        for group_done, error in pool.imap_unordered(setup_test_case_group,
+                                                     groups):
+            done.extend(group_done)
+            if error is not None:
+                errors.append(error)
+    finally:
+        pool.close()
+        pool.join()
+
+    return done, errors
+# }}}
+# }}}
+
+
 if __name__ == "__main__":
     # Define and process input arguments
     parser = argparse.ArgumentParser(
@@ -1645,72 +1854,18 @@ if __name__ == "__main__":
     if args.case_num:
         use_case_list = True
         case_list = args.case_num.split(',')
+        all_test_cases = get_test_cases(
+            os.path.dirname(os.path.realpath(__file__)))
+        test_cases = [all_test_cases[int(case_num) - 1]
+                      for case_num in case_list]
     else:
         use_case_list = False
-        case_list = list()
-        case_list.append(0)
-
-    if sys.version_info >= (3, 2):
-        config = configparser.ConfigParser()
-    else:
-        config = configparser.SafeConfigParser()
-    config.read(args.config_file)
-
-    if not args.no_download:
-        args.no_download = False
+        test_cases = [(args.core, args.configuration, args.resolution,
+                       args.test)]
 
-    if not args.work_dir:
-        args.work_dir = os.getcwd()
-
-    # Add configuation information to the config object.
-    # This allows passing config around with all of the config options needed
-    # to build paths, and determine options.
-    config.add_section('script_input_arguments')
-    config.add_section('script_paths')
-
-    if not use_case_list:
-        config.set('script_input_arguments', 'core', args.core)
-        config.set('script_input_arguments', 'configuration',
-                   args.configuration)
-        config.set('script_input_arguments', 'resolution', args.resolution)
-        config.set('script_input_arguments', 'test', args.test)
-
-    if args.baseline_dir:
-        config.set('script_paths', 'baseline_dir', args.baseline_dir)
-    else:
-        config.set('script_paths', 'baseline_dir', 'NONE')
-
-    if args.no_download:
-        config.set('script_input_arguments', 'no_download', 'yes')
-    else:
-        config.set('script_input_arguments', 'no_download', 'no')
-
-    config.set('script_paths', 'script_path',
-               os.path.dirname(os.path.realpath(__file__)))
-    config.set('script_paths', 'work_dir', os.path.abspath(args.work_dir))
-    config.set('script_paths', 'utility_scripts',
-               '{}/utility_scripts'.format(config.get('script_paths',
-                                                      'script_path')))
-
-    if not args.model_runtime:
-        config.set('script_input_arguments', 'model_runtime',
-                   '{}/runtime_definitions/mpirun.xml'.format(
-                       config.get('script_paths', 'script_path')))
-        print(' WARNING: No runtime definition selected. Using the default '
-              'of {}'.format(config.get('script_input_arguments',
-                                        'model_runtime')))
-    else:
-        config.set('script_input_arguments', 'model_runtime',
-                   args.model_runtime)
-
-    if not config.has_section('conda'):
-        config.add_section('conda')
-
-    if not config.has_option('conda', 'link_load_compass'):
-        config.set('conda', 'link_load_compass', 'False')
-
-    if args.link_load_compass:
-        config.set('conda', 'link_load_compass', 'True')
+    config = build_config(args.config_file, args.work_dir, args.model_runtime,
+                          args.baseline_dir, args.no_download,
+                          args.link_load_compass)
 
     # Build variables for history output
     old_dir = os.getcwd()
@@ -1723,106 +1878,14 @@ if __name__ == "__main__":
         calling_command = "{}{} ".format(calling_command, arg)
     os.chdir(old_dir)
 
-    # Iterate over all cases in the case_list.
-    # There is only one if the (-o, -c, -r) options were used in place of (-n)
-    for case_num in case_list:
-
-        # If we're using a case_list, determine the core, configuration, and
-        # resolution for the current test case.
-        if use_case_list:
-            core_configuration = subprocess.check_output(
-                ['{}/list_testcases.py'.format(config.get('script_paths',
-                                                          'script_path')),
-                 '-n', '{:d}'.format(int(case_num))]).decode('utf-8')
-            config_options = core_configuration.strip('\n').split(' ')
-            config.set('script_input_arguments', 'core', config_options[1])
-            config.set('script_input_arguments', 'configuration',
-                       config_options[3])
-            config.set('script_input_arguments', 'resolution',
-                       config_options[5])
-            config.set('script_input_arguments', 'test', config_options[7])
-
-        # Setup each xml file in the configuration directory:
-        test_path = '{}/{}/{}/{}'.format(
-            config.get('script_input_arguments', 'core'),
-            config.get('script_input_arguments', 'configuration'),
-            config.get('script_input_arguments', 'resolution'),
-            config.get('script_input_arguments', 'test'))
-        work_dir = '{}/{}'.format(config.get('script_paths', 'work_dir'),
-                                  test_path)
-
-        # Set paths to core, configuration, resolution, and case for use in
-        # functions
-        config.set('script_paths', 'core_dir',
-                   config.get('script_input_arguments', 'core'))
-        config.set('script_paths', 'configuration_dir',
-                   '{}/{}'.format(config.get('script_paths', 'core_dir'),
-                                  config.get('script_input_arguments',
-                                             'configuration')))
-        config.set('script_paths', 'resolution_dir',
-                   '{}/{}'.format(config.get('script_paths',
-                                             'configuration_dir'),
-                                  config.get('script_input_arguments',
-                                             'resolution')))
-        config.set('script_paths', 'test_dir', test_path)
-        config.set('script_paths', 'config_path', test_path)
-
-        # Only write history if we did something...
-        write_history = False
-
-        # Loop over all files in test_path that have the .xml extension.
-        for file in os.listdir('{}'.format(test_path)):
-            if fnmatch.fnmatch(file, '*.xml'):
-                # Build full file name
-                config_file = '{}/{}'.format(test_path, file)
-
-                # Determine the type of the config file
-                # Could be config, driver_script, template, etc.
-                # The type is defined by the parent tag.
-                config_type = get_config_file_type(config_file)
-
-                # Process config files
-                if config_type == 'config':
-                    write_history = True
-                    # Ensure the case directory exists
-                    case_dir = make_case_dir(config_file, work_dir)
-                    case_name = get_case_name(config_file)
-
-                    # Set case_dir path for function calls
-                    config.set('script_paths', 'case_dir',
-                               '{}/{}'.format(config.get('script_paths',
-                                                         'test_dir'),
-                                              case_name))
-
-                    case_path = '{}/{}'.format(work_dir, case_dir)
-
-                    # Generate all namelists for this case
-                    generate_namelist_files(config_file, case_path, config)
-
-                    # Generate all streams files for this case
-                    generate_streams_files(config_file, case_path, config)
+    # Only write history if we did something...
+    write_history = False
 
-                    # Ensure required files exist for this case
-                    get_defined_files(config_file, '{}'.format(case_path),
-                                      config)
-
-                    # Process all links for this case
-                    add_links(config_file, config)
-
-                    copy_files(config_file, config)
-
-                    # Generate run scripts for this case.
-                    generate_run_scripts(config_file, '{}'.format(case_path),
-                                         config)
-
-                    print(" -- Set up case: {}/{}".format(work_dir, case_dir))
-                # Process driver scripts
-                elif config_type == 'driver_script':
-                    write_history = True
-
-                    # Generate driver scripts.
-                    generate_driver_scripts(config_file, config)
-                    print(" -- Set up driver script in {}".format(work_dir))
+    # Iterate over all test cases.
+    # There is only one if the (-o, -c, -r) options were used in place of (-n)
+    for core, configuration, resolution, test in test_cases:
+        if setup_test_case(config, core, configuration, resolution, test):
+            write_history = True
 
     # Write the history of this command to the command_history file, for
     # provenance.
@@ -1841,27 +1904,19 @@ if __name__ == "__main__":
         history_file.write('command: {}\n'.format(calling_command))
         history_file.write('setup the following cases:\n')
         if use_case_list:
-            for case_num in case_list:
-                core_configuration = subprocess.check_output(
-                    ['./list_testcases.py', '-n',
-                     '{:d}'.format(int(case_num))]).decode('utf-8')
-                config_options = core_configuration.strip('\n').split(' ')
+            for core, configuration, resolution, test in test_cases:
                 history_file.write('\n')
-                history_file.write('    core: {}\n'.format(config_options[1]))
+                history_file.write('    core: {}\n'.format(core))
                 history_file.write('    configuration: {}\n'.format(
-                    config_options[3]))
-                history_file.write('    resolution: {}\n'.format(
-                    config_options[5]))
-                history_file.write('    test: {}\n'.format(config_options[7]))
+                    configuration))
+                history_file.write('    resolution: {}\n'.format(resolution))
+                history_file.write('    test: {}\n'.format(test))
         else:
-            history_file.write('core: {}\n'.format(
-                config.get('script_input_arguments', 'core')))
+            history_file.write('core: {}\n'.format(args.core))
             history_file.write('configuration: {}\n'.format(
-                config.get('script_input_arguments', 'configuration')))
-            history_file.write('resolution: {}\n'.format(
-                config.get('script_input_arguments', 'resolution')))
-            history_file.write('test: {}\n'.format(
-                config.get('script_input_arguments', 'test')))
+                args.configuration))
+            history_file.write('resolution: {}\n'.format(args.resolution))
+            history_file.write('test: {}\n'.format(args.test))
 
         history_file.write('**************************************************'
                            '*********************\n')
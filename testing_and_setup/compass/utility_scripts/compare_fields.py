@@ -1,4 +1,18 @@
 #!/usr/bin/env python
+"""
+Compares one or more fields between two MPAS files and checks the L1, L2 and
+L_Infinity norms of the difference against the requested thresholds.
+
+A single field can be given with -v and the --l1, --l2 and --linf thresholds.
+Any number of fields, each with its own thresholds, can be compared in one
+pass over the two files with repeated --field arguments of the form
+    NAME[,l1=VAL][,l2=VAL][,linf=VAL]
+in which case a PASS or FAIL line is reported for each field.
+
+Fields are read in bounded hyperslabs (at most --chunk_size elements from each
+file at a time) and the norms are accumulated as the chunks are read, so the
+peak memory use does not depend on the size of the field.
+"""
 from __future__ import absolute_import, division, print_function, \
     unicode_literals
 
@@ -9,6 +23,204 @@ import numpy as np
 from netCDF4 import Dataset as NetCDFFile
 import argparse
 
+
+def hyperslabs(shape, max_elements):#{{{
+    # Yield tuples of slices that cover an array of the given shape, each
+    # selecting at most max_elements values (or a single value along the
+    # trailing dimension if that alone is larger).
+    if len(shape) == 0:
+        yield ()
+        return
+
+    row_size = int(np.prod(shape[1:]))
+    if row_size <= max_elements:
+        step = max(1, max_elements // max(row_size, 1))
+        for start in range(0, shape[0], step):
+            yield (slice(start, min(start + step, shape[0])),)
+    else:
+        for index in range(shape[0]):
+            for sub_slab in hyperslabs(shape[1:], max_elements):
+                yield (slice(index, index + 1),) + sub_slab
+#}}}
+
+
+def accumulate_norms(field1, field2, prefix, shape, max_elements):#{{{
+    # Accumulate sum(|diff|), sum(diff^2) and max(|diff|) over the part of the
+    # fields selected by prefix, one hyperslab at a time.
+    l1_sum = 0.0
+    l2_sum = 0.0
+    linf = None
+    for slab in hyperslabs(shape, max_elements):
+        index = prefix + slab
+        diff = np.absolute(field1[index] - field2[index])
+        if np.size(diff) == 0:
+            continue
+
+        l1_sum = l1_sum + np.sum(diff)
+        l2_sum = l2_sum + np.sum(diff * diff)
+        chunk_max = np.amax(diff)
+        if chunk_max is not np.ma.masked and (linf is None or
+                                              chunk_max > linf):
+            linf = chunk_max
+        del diff
+
+    return l1_sum, l2_sum, linf
+#}}}
+
+
+def compute_norms(field1, field2, time_index, max_elements):#{{{
+    # Compute the L1, L2 and L_Infinity norms of the difference of two fields,
+    # either for one time level or (if time_index is None) for the whole
+    # field.
+    field_dims = field1.dimensions
+    if time_index is not None:
+        prefix = (time_index,)
+        shape = field1.shape[1:]
+    elif len(field_dims) >= 2:
+        prefix = ()
+        shape = field1.shape
+    else:
+        # Matches the historical behavior of comparing only the first entry
+        # of a 1D field without a Time dimension
+        prefix = (0,)
+        shape = ()
+
+    l1_sum, l2_sum, linf = accumulate_norms(field1, field2, prefix, shape,
+                                            max_elements)
+
+    l2_norm = np.sqrt(l2_sum)
+    l1_norm = l1_sum
+    if len(field_dims) >= 2:
+        l1_norm = l1_norm / np.sum(shape)
+
+    return l1_norm, l2_norm, linf
+#}}}
+
+
+def check_norms(l1_norm, l2_norm, linf_norm, thresholds, quiet,
+                diff_str):#{{{
+    l1_thresh, l2_thresh, linf_thresh = thresholds
+
+    passed = True
+    if l1_thresh:
+        if float(l1_thresh) < l1_norm:
+            passed = False
+    diff_str = '%s l1: %16.14e '%(diff_str, l1_norm)
+
+    if l2_thresh:
+        if float(l2_thresh) < l2_norm:
+            passed = False
+    diff_str = '%s l2: %16.14e '%(diff_str, l2_norm)
+
+    if linf_thresh:
+        if float(linf_thresh) < linf_norm:
+            passed = False
+    diff_str = '%s linf: %16.14e '%(diff_str, linf_norm)
+
+    if not quiet:
+        print(diff_str)
+    elif not passed:
+        print(diff_str)
+
+    return passed
+#}}}
+
+
+def parse_field_spec(spec):#{{{
+    # Parse NAME[,l1=VAL][,l2=VAL][,linf=VAL] into a name and the
+    # (l1, l2, linf) thresholds, with None for any threshold not given.
+    parts = spec.split(',')
+    name = parts[0].strip()
+    norms = {'l1': None, 'l2': None, 'linf': None}
+    for part in parts[1:]:
+        try:
+            norm, value = part.split('=')
+        except ValueError:
+            raise ValueError("Invalid threshold '%s' for field '%s'"%(part,
+                                                                      name))
+        norm = norm.strip()
+        if norm not in norms:
+            raise ValueError("Unknown norm '%s' for field '%s'"%(norm, name))
+        float(value)
+        norms[norm] = value.strip()
+
+    if name == '':
+        raise ValueError("Field specification '%s' is missing a name"%(spec))
+
+    return name, (norms['l1'], norms['l2'], norms['linf'])
+#}}}
+
+
+def compare_field(f1, f2, variable, thresholds, quiet, chunk_size):#{{{
+    # Compare one variable between two open files, returning True if all
+    # requested norms are within their thresholds.
+    l1_thresh, l2_thresh, linf_thresh = thresholds
+
+    if (not l2_thresh) and (not l1_thresh) and (not linf_thresh):
+        print("WARNING: Comparison of '%s' will pass since no norm values have been defined."%(variable))
+
+    try:
+        time_length = f1.variables['xtime'].shape[0]
+    except:
+        time_length = 1
+
+    try:
+        field1 = f1.variables[variable]
+        field2 = f2.variables[variable]
+    except:
+        print("ERROR: Field '%s' does not exist in both"%(variable))
+        print("           file1: %s"%(f1.filepath()))
+        print("       and file2: %s"%(f2.filepath()))
+        print("Exiting with a failed comparision, since no comparision can be done but a comparison was requested.")
+        return False
+
+    if not field1.shape == field2.shape:
+        print("ERROR: Field sizes don't match in different files.")
+        return False
+
+    linf_norm = -(sys.float_info.max)
+
+    pass_val = True
+
+    print("Beginning variable comparisons for all time levels of field '%s'. Note any time levels reported are 0-based."%(variable))
+    if ( l2_thresh or l1_thresh or linf_thresh ):
+        print("    Pass thresholds are:")
+        if ( l1_thresh ):
+            print("       L1: %16.14e"%(float(l1_thresh)))
+        if ( l2_thresh ):
+            print("       L2: %16.14e"%(float(l2_thresh)))
+        if ( linf_thresh ):
+            print("       L_Infinity: %16.14e"%(float(linf_thresh)))
+
+    field_dims = field1.dimensions
+
+    if "Time" in field_dims:
+        for t in range( 0, time_length):
+            l1_norm, l2_norm, linf = compute_norms(field1, field2, t,
+                                                   chunk_size)
+
+            # The L_Infinity norm is a running maximum over time levels
+            if linf is not None and linf > linf_norm:
+                linf_norm = linf
+
+            if not check_norms(l1_norm, l2_norm, linf_norm, thresholds,
+                               quiet, '%d: '%(t)):
+                pass_val = False
+    else:
+        l1_norm, l2_norm, linf = compute_norms(field1, field2, None,
+                                               chunk_size)
+
+        if linf is not None and linf > linf_norm:
+            linf_norm = linf
+
+        if not check_norms(l1_norm, l2_norm, linf_norm, thresholds, quiet,
+                           ''):
+            pass_val = False
+
+    return pass_val
+#}}}
+
+
 parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
 parser.add_argument("-1", "--file1", dest="filename1", help="first input file", metavar="FILE")
 parser.add_argument("-2", "--file2", dest="filename2", help="second input file", metavar="FILE")
@@ -16,7 +228,9 @@ parser.add_argument("-v", "--var", dest="variable", help="variable to compute er
 parser.add_argument("--l2", dest="l2_norm", help="value of L2 norm for a pass.", metavar="VAL")
 parser.add_argument("--l1", dest="l1_norm", help="value of L1 norm for a pass.", metavar="VAL")
 parser.add_argument("--linf", dest="linf_norm", help="value of L_Infinity norm for a pass.", metavar="VAL")
+parser.add_argument("--field", dest="fields", action="append", default=[], help="field to compare with its own thresholds, as NAME[,l1=VAL][,l2=VAL][,linf=VAL]. Can be given multiple times.", metavar="SPEC")
 parser.add_argument("-q", "--quiet", dest="quiet", help="turns off printing if diff passes test.", action="store_true")
+parser.add_argument("--chunk_size", dest="chunk_size", type=int, default=4194304, help="maximum number of elements read from each file at once.", metavar="NUM")
 
 args = parser.parse_args()
 
@@ -26,11 +240,21 @@ if not args.filename1:
 if not args.filename2:
     parser.error("Two filenames are required inputs.")
 
-if not args.variable:
+if not args.variable and not args.fields:
     parser.error("Variable is a required input.")
 
-if (not args.l2_norm) and (not args.l1_norm) and (not args.linf_norm):
-    print("WARNING: Script will pass since no norm values have been defined.")
+if args.chunk_size < 1:
+    parser.error("Chunk size must be positive.")
+
+fields = []
+if args.variable:
+    fields.append((args.variable, (args.l1_norm, args.l2_norm,
+                                   args.linf_norm)))
+for spec in args.fields:
+    try:
+        fields.append(parse_field_spec(spec))
+    except ValueError as e:
+        parser.error(str(e))
 
 files_exist = True
 
@@ -48,124 +272,24 @@ if not files_exist:
 f1 = NetCDFFile(args.filename1,'r')
 f2 = NetCDFFile(args.filename2,'r')
 
-try:
-    time_length = f1.variables['xtime'].shape[0]
-except:
-    time_length = 1
-
-try:
-    field1 = f1.variables[args.variable]
-    field2 = f2.variables[args.variable]
-except:
-    print("ERROR: Field '%s' does not exist in both"%(args.variable))
-    print("           file1: %s"%(args.filename1))
-    print("       and file2: %s"%(args.filename2))
-    print("Exiting with a failed comparision, since no comparision can be done but a comparison was requested.")
-    sys.exit(1)
-
-if not field1.shape == field2.shape:
-    print("ERROR: Field sizes don't match in different files.")
-    sys.exit(1)
-
-linf_norm = -(sys.float_info.max)
-
 pass_val = True
 
-print("Beginning variable comparisons for all time levels of field '%s'. Note any time levels reported are 0-based."%(args.variable))
-if ( args.l2_norm or args.l1_norm or args.linf_norm ):
-    print("    Pass thresholds are:")
-    if ( args.l1_norm ):
-        print("       L1: %16.14e"%(float(args.l1_norm)))
-    if ( args.l2_norm ):
-        print("       L2: %16.14e"%(float(args.l2_norm)))
-    if ( args.linf_norm ):
-        print("       L_Infinity: %16.14e"%(float(args.linf_norm)))
-
-field_dims = field1.dimensions
-
-if "Time" in field_dims:
-    for t in range( 0, time_length):
-        pass_time = True
-        if len(field_dims) >= 2:
-            diff = np.absolute(field1[t][:] - field2[t][:])
-        else:
-            diff = np.absolute(field1[t] - field2[t])
-
-        l2_norm = np.sum(diff * diff)
-        l2_norm = np.sqrt(l2_norm)
-
-        l1_norm = np.sum(diff)
-        if len(field_dims) >= 2:
-            l1_norm = l1_norm / np.sum(field1[t][:].shape)
-        l1_norm = np.max(l1_norm)
-
-        if np.amax(diff) > linf_norm:
-            linf_norm = np.amax(diff)
-
-        diff_str = '%d: '%(t)
-        if args.l1_norm:
-            if float(args.l1_norm) < l1_norm:
-                pass_time = False
-        diff_str = '%s l1: %16.14e '%(diff_str, l1_norm)
-
-        if args.l2_norm:
-            if float(args.l2_norm) < l2_norm:
-                pass_time = False
-        diff_str = '%s l2: %16.14e '%(diff_str, l2_norm)
-
-        if args.linf_norm:
-            if float(args.linf_norm) < linf_norm:
-                pass_time = False
-        diff_str = '%s linf: %16.14e '%(diff_str, linf_norm)
-
-        if not args.quiet:
-            print(diff_str)
-        elif not pass_time:
-            print(diff_str)
-
-        if not pass_time:
-            pass_val = False
-
-        del diff
-else:
-    if len(field_dims) >= 2:
-        diff = np.absolute(field1[:] - field2[:])
-    else:
-        diff = np.absolute(field1[0] - field2[0])
-
-    l2_norm = np.sum(diff * diff)
-    l2_norm = np.sqrt(l2_norm)
-
-    l1_norm = np.sum(diff)
-    if len(field_dims) >= 2:
-        l1_norm = l1_norm / np.sum(field1[:].shape)
-    l1_norm = np.max(l1_norm)
-
-    if np.amax(diff) > linf_norm:
-        linf_norm = np.amax(diff)
-
-    diff_str = ''
-    if args.l1_norm:
-        if float(args.l1_norm) < l1_norm:
-            pass_val = False
-    diff_str = '%s l1: %16.14e '%(diff_str, l1_norm)
-
-    if args.l2_norm:
-        if float(args.l2_norm) < l2_norm:
-            pass_val = False
-    diff_str = '%s l2: %16.14e '%(diff_str, l2_norm)
+for variable, thresholds in fields:
+    field_passed = compare_field(f1, f2, variable, thresholds, args.quiet,
+                                 args.chunk_size)
 
-    if args.linf_norm:
-        if float(args.linf_norm) < linf_norm:
-            pass_val = False
-    diff_str = '%s linf: %16.14e '%(diff_str, linf_norm)
+    # Report the result of each field when several are compared at once
+    if args.fields:
+        if field_passed:
+            print(" ** PASS Comparison of %s between %s and\n    %s"%(variable, args.filename1, args.filename2))
+        else:
+            print(" ** FAIL Comparison of %s between %s and\n    %s"%(variable, args.filename1, args.filename2))
 
-    if not args.quiet:
-        print(diff_str)
-    elif not pass_val:
-        print(diff_str)
+    if not field_passed:
+        pass_val = False
 
-    del diff
+f1.close()
+f2.close()
 
 if pass_val:
     sys.exit(0)
@@ -1,79 +1,440 @@
 #!/usr/bin/env python
+"""
+Compares timers between a baseline and a comparison run directory.
+
+The timer tables of the MPAS logs (log.*.out) and GPTL output (timing.*) in
+each directory are parsed once into a timer database, indexed by timer name,
+with the total, calls, min and max of each timer in each file. The database is
+cached in timer_database.json next to the logs and is only re-read for files
+that changed since it was written.
+
+With -t, a single timer is compared. With -a, all timers found in both runs
+are compared at once.
+
+With --tolerance, the comparison becomes a performance-regression gate: the
+script exits with an error if a timer of the comparison run is slower than its
+reference by more than the given fraction. The reference is either the
+baseline run or, with --reference median, the median of the last --window
+results of the timer in the --history store. The history is an SQLite
+database to which the timers of the comparison run are added each time the
+script is run with --history; a run is only recorded once, however often it
+is compared.
+"""
 from __future__ import absolute_import, division, print_function, \
     unicode_literals
 
 import os
+import sys
 import fnmatch
 import argparse
 import re
+import json
+import sqlite3
+import time
+
+database_name = 'timer_database.json'
+database_version = 1
+
+history_schema = """
+CREATE TABLE IF NOT EXISTS timer_history (
+    key TEXT NOT NULL,
+    timer TEXT NOT NULL,
+    run TEXT NOT NULL,
+    value REAL NOT NULL,
+    recorded REAL NOT NULL,
+    UNIQUE (key, timer, run)
+);
+CREATE INDEX IF NOT EXISTS timer_history_lookup
+    ON timer_history (key, timer, recorded);
+"""
+
+# Column layout of the timer tables: (name, total, calls, min, max) indices
+timer_columns = {'mpas': (0, 1, 2, 3, 4),
+                 'gptl': (0, 3, 1, 5, 4)}
 
-def find_timer_value(timer_name, directory):#{{{
+
+def get_file_kind(file):#{{{
+    # Compare files written using built in MPAS timers
+    if fnmatch.fnmatch(file, "log.*.out"):
+        return 'mpas'
+    # Compare files written using GPTL timers
+    elif fnmatch.fnmatch(file, "timing.*"):
+        return 'gptl'
+    return None
+#}}}
+
+
+def parse_timer_file(filename, kind):#{{{
+    # Parse all rows of the timer tables in a file into
+    # [name, total, calls, min, max] lists. Multi-word names are joined with
+    # underscores.
     # Build a regular expression for any two characters with a space between them.
     regex = re.compile(r'(\S) (\S)')
+    timer_line_size = 6
+    name_index, total_index, calls_index, min_index, max_index = \
+        timer_columns[kind]
+
+    rows = []
+    stats_file = open(filename, "r")
+    for block in stats_file:
+        new_block_arr = regex.sub(r"\1_\2", block[2:]).split()
+        if len(new_block_arr) >= timer_line_size:
+            try:
+                total = float(new_block_arr[total_index])
+            except ValueError:
+                continue
+            row = [new_block_arr[name_index], total]
+            for index in [calls_index, min_index, max_index]:
+                try:
+                    row.append(float(new_block_arr[index]))
+                except ValueError:
+                    row.append(None)
+            rows.append(row)
+    stats_file.close()
+
+    return rows
+#}}}
+
+
+def load_timer_database(directory, use_cache=True):#{{{
+    # Build the timer database of a run directory, reusing the cached rows of
+    # any file whose modification time and size are unchanged.
+    cache_path = '%s/%s'%(directory, database_name)
+
+    cached_files = {}
+    if use_cache and os.path.exists(cache_path):
+        try:
+            cache_file = open(cache_path, 'r')
+            cache = json.load(cache_file)
+            cache_file.close()
+            if cache.get('version') == database_version:
+                cached_files = cache['files']
+        except (IOError, ValueError, KeyError):
+            cached_files = {}
+
+    files = {}
+    changed = False
+    for file in sorted(os.listdir(directory)):
+        kind = get_file_kind(file)
+        if kind is None:
+            continue
+
+        stat = os.stat('%s/%s'%(directory, file))
+        cached = cached_files.get(file)
+        if cached is not None and cached['mtime'] == stat.st_mtime and \
+                cached['size'] == stat.st_size:
+            files[file] = cached
+        else:
+            files[file] = {'kind': kind, 'mtime': stat.st_mtime,
+                           'size': stat.st_size,
+                           'timers': parse_timer_file(
+                               '%s/%s'%(directory, file), kind)}
+            changed = True
+
+    if set(files.keys()) != set(cached_files.keys()):
+        changed = True
+
+    database = {'version': database_version, 'files': files}
+
+    if use_cache and changed:
+        # Baseline directories may not be writable, so caching is optional
+        try:
+            cache_file = open(cache_path, 'w')
+            json.dump(database, cache_file)
+            cache_file.close()
+        except (IOError, OSError):
+            pass
+
+    index_timer_database(database)
 
+    return database
+#}}}
+
+
+def index_timer_database(database):#{{{
+    # Index the rows by timer name: name -> file -> list of
+    # {'total', 'calls', 'min', 'max'} entries
+    index = {}
+    for file in sorted(database['files'].keys()):
+        for name, total, calls, min_time, max_time in \
+                database['files'][file]['timers']:
+            entries = index.setdefault(name, {}).setdefault(file, [])
+            entries.append({'total': total, 'calls': calls, 'min': min_time,
+                            'max': max_time})
+    database['index'] = index
+#}}}
+
+
+def find_timer_value(timer_name, database):#{{{
+    # Sum the totals of all rows matching timer_name in the first file that
+    # has any, where a row matches if its name is part of timer_name.
     sub_timer_name = timer_name.replace(' ', '_')
 
-    timer = 0.0
-    timer_found = False
-    for file in os.listdir(directory):
-        if not timer_found:
-            process_file = False
-            # Compare files written using built in MPAS timers
-            if fnmatch.fnmatch(file, "log.*.out"):
-                timer_line_size = 6
-                name_index = 0
-                total_index = 1
-                process_file = True
-            # Compare files written using GPTL timers
-            elif fnmatch.fnmatch(file, "timing.*"):
-                timer_line_size = 6
-                name_index = 0
-                total_index = 3
-                process_file = True
-
-            if process_file:
-                stats_file = open('%s/%s'%(directory, file), "r")
-                for block in iter(lambda: stats_file.readline(), ""):
-                    new_block = regex.sub(r"\1_\2", block[2:])
-                    new_block_arr = new_block.split()
-                    if len(new_block_arr) >= timer_line_size:
-                        if sub_timer_name.find(new_block_arr[name_index]) >= 0:
-                            try:
-                                timer = timer + float(new_block_arr[total_index])
-                                timer_found = True
-                            except ValueError:
-                                timer = timer
-                        del new_block
-                    del new_block_arr
-
-    return timer_found, timer
-#}}}
-
-# Define and process input arguments
-parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
-parser.add_argument('-b', '--base_directory', dest="base_directory", help="Directory with the baseline timer information.", required=True)
-parser.add_argument('-c', '--comparison_directory', dest="comparison_directory", help="Directory with the comparison timer information.", required=True)
-parser.add_argument('-t', '--timer', dest="timer", help="Name of the timer to compare", required=True)
-parser.add_argument('-s', '--speedup', dest="speedup", help="If set, only speedup will be printed. This is useful when making speedup plots.", action="store_true")
-
-args = parser.parse_args()
-
-timer1_found, timer1 = find_timer_value(args.timer, args.base_directory)
-timer2_found, timer2 = find_timer_value(args.timer, args.comparison_directory)
-
-if timer1_found and timer2_found:
+    index = database['index']
+    names = [name for name in index if sub_timer_name.find(name) >= 0]
+
+    for file in sorted(database['files'].keys()):
+        timer = 0.0
+        timer_found = False
+        for name in names:
+            for entry in index[name].get(file, []):
+                timer = timer + entry['total']
+                timer_found = True
+        if timer_found:
+            return timer_found, timer
+
+    return False, 0.0
+#}}}
+
+
+def get_timer_totals(database):#{{{
+    # The total of every timer, taken from the first file containing it
+    totals = {}
+    for name, files in database['index'].items():
+        first_file = sorted(files.keys())[0]
+        totals[name] = sum([entry['total'] for entry in files[first_file]])
+    return totals
+#}}}
+
+
+def compare_all_timers(base_database, compare_database):#{{{
+    # Returns (name, base, compare, percent change, speedup) for every timer
+    # found in both databases.
+    base_totals = get_timer_totals(base_database)
+    compare_totals = get_timer_totals(compare_database)
+
+    results = []
+    for name in sorted(set(base_totals.keys()) & set(compare_totals.keys())):
+        timer1 = base_totals[name]
+        timer2 = compare_totals[name]
+        results.append((name, timer1, timer2, get_percent(timer1, timer2),
+                        get_speedup(timer1, timer2)))
+    return results
+#}}}
+
+
+def get_run_signature(database):#{{{
+    # Identify a run by the names, modification times and sizes of its timer
+    # files, so the same run is recorded in the history only once.
+    signature = ['%s:%r:%d'%(file, database['files'][file]['mtime'],
+                             database['files'][file]['size'])
+                 for file in sorted(database['files'].keys())]
+    return ';'.join(signature)
+#}}}
+
+
+def open_timer_history(filename):#{{{
+    # Open (creating if needed) the SQLite timer history. Several test cases
+    # may record timers at once, so wait on a locked database.
+    history = sqlite3.connect(filename, timeout=60.0)
+    history.executescript(history_schema)
+    return history
+#}}}
+
+
+def get_history_median(history, key, timer_name, window, run):#{{{
+    # The median of the last window values recorded for a timer by runs
+    # other than run, or None if none have been recorded.
+    cursor = history.execute(
+        'SELECT value FROM timer_history WHERE key = ? AND timer = ? AND '
+        'run != ? ORDER BY recorded DESC LIMIT ?',
+        (key, timer_name, run, window))
+    values = sorted([row[0] for row in cursor.fetchall()])
+    if len(values) == 0:
+        return None
+
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return 0.5 * (values[middle - 1] + values[middle])
+#}}}
+
+
+def record_timers(history, key, run, timers):#{{{
+    # Add the (timer name, value) pairs of a run to the history, ignoring
+    # timers already recorded for this run.
+    recorded = time.time()
+    with history:
+        history.executemany(
+            'INSERT OR IGNORE INTO timer_history '
+            '(key, timer, run, value, recorded) VALUES (?, ?, ?, ?, ?)',
+            [(key, name, run, value, recorded) for name, value in timers])
+#}}}
+
+
+def get_reference(timer_name, base_value, reference, history, key, window,
+                  run):#{{{
+    # The value a timer is gated against: the baseline value, or the median
+    # of its history (falling back to the baseline if there is no history).
+    if reference == 'median' and history is not None:
+        median = get_history_median(history, key, timer_name, window, run)
+        if median is not None:
+            return median, 'history median'
+    if base_value is None:
+        return None, None
+    return base_value, 'baseline'
+#}}}
+
+
+def is_regression(reference_value, value, tolerance):#{{{
+    # A timer regressed if it is slower than its reference by more than the
+    # tolerance, given as a fraction of the reference.
+    return value > reference_value * (1.0 + tolerance)
+#}}}
+
+
+def get_display_name(name):#{{{
+    # Strip the quotes of GPTL names and the level number of MPAS names
+    name = name.strip('"')
+    name = re.sub(r'^\d+_', '', name)
+    return name.replace('_', ' ')
+#}}}
+
+
+def get_speedup(timer1, timer2):#{{{
     try:
         speedup = timer1 / timer2
-    except:
+    except ZeroDivisionError:
         speedup = 1.0
+    return speedup
+#}}}
 
-    percent = (timer2 - timer1) / timer1
 
-    if not args.speedup:
-        print("Comparing timer %s:"%(args.timer))
-        print("             Base: %lf"%(timer1))
-        print("          Compare: %lf"%(timer2))
-        print("   Percent Change: %lf%%"%(percent*100))
-        print("          Speedup: %lf"%(speedup))
+def get_percent(timer1, timer2):#{{{
+    try:
+        percent = (timer2 - timer1) / timer1
+    except ZeroDivisionError:
+        percent = 0.0
+    return percent
+#}}}
+
+
+if __name__ == "__main__":
+    # Define and process input arguments
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-b', '--base_directory', dest="base_directory", help="Directory with the baseline timer information.", required=True)
+    parser.add_argument('-c', '--comparison_directory', dest="comparison_directory", help="Directory with the comparison timer information.", required=True)
+    parser.add_argument('-t', '--timer', dest="timer", help="Name of the timer to compare")
+    parser.add_argument('-a', '--all', dest="all_timers", help="If set, all timers found in both directories are compared.", action="store_true")
+    parser.add_argument('-s', '--speedup', dest="speedup", help="If set, only speedup will be printed. This is useful when making speedup plots.", action="store_true")
+    parser.add_argument('--no_cache', dest="no_cache", help="If set, the timer database is neither read from nor written to the run directories.", action="store_true")
+    parser.add_argument('--tolerance', dest="tolerance", type=float, help="If set, fail if a timer is slower than its reference by more than this fraction (e.g. 0.1 for 10%%).", metavar="FRAC")
+    parser.add_argument('--reference', dest="reference", choices=['baseline', 'median'], default='baseline', help="What timers are gated against: the baseline run, or the median of the timer history.")
+    parser.add_argument('--window', dest="window", type=int, default=5, help="Number of recent history entries used for the median reference.", metavar="NUM")
+    parser.add_argument('--history', dest="history", help="SQLite file in which the timers of the comparison run are recorded.", metavar="FILE")
+    parser.add_argument('--history_key', dest="history_key", help="Key the comparison run is recorded under in the history. Defaults to the absolute path of the comparison directory.", metavar="KEY")
+
+    args = parser.parse_args()
+
+    if not args.timer and not args.all_timers:
+        parser.error("Either a timer (-t) or all timers (-a) must be requested.")
+
+    if args.tolerance is not None and args.tolerance < 0.0:
+        parser.error("Tolerance must not be negative.")
+
+    if args.window < 1:
+        parser.error("Window must be positive.")
+
+    if args.reference == 'median' and not args.history:
+        parser.error("A history file (--history) is required for the median reference.")
+
+    # With a history reference, the gate works without a baseline run
+    if os.path.isdir(args.base_directory):
+        base_database = load_timer_database(args.base_directory,
+                                            not args.no_cache)
     else:
-        print("%lf"%(speedup))
+        base_database = None
+    compare_database = load_timer_database(args.comparison_directory,
+                                           not args.no_cache)
+
+    history = None
+    history_key = args.history_key
+    if args.history:
+        history = open_timer_history(args.history)
+        if history_key is None:
+            history_key = os.path.abspath(args.comparison_directory)
+
+    # (name, base value or None, comparison value) for each gated timer
+    gated = []
+
+    if args.timer:
+        if base_database is not None:
+            timer1_found, timer1 = find_timer_value(args.timer, base_database)
+        else:
+            timer1_found, timer1 = False, 0.0
+        timer2_found, timer2 = find_timer_value(args.timer, compare_database)
+
+        if timer1_found and timer2_found:
+            speedup = get_speedup(timer1, timer2)
+            percent = get_percent(timer1, timer2)
+
+            if not args.speedup:
+                print("Comparing timer %s:"%(args.timer))
+                print("             Base: %lf"%(timer1))
+                print("          Compare: %lf"%(timer2))
+                print("   Percent Change: %lf%%"%(percent*100))
+                print("          Speedup: %lf"%(speedup))
+            else:
+                print("%lf"%(speedup))
+
+        if timer2_found:
+            if timer1_found:
+                gated.append((args.timer, timer1, timer2))
+            else:
+                gated.append((args.timer, None, timer2))
+        elif args.tolerance is not None:
+            print("ERROR: Timer %s was not found in %s"%(
+                args.timer, args.comparison_directory))
+            sys.exit(1)
+
+    if args.all_timers:
+        if base_database is not None:
+            results = compare_all_timers(base_database, compare_database)
+        else:
+            results = []
+        if not args.speedup:
+            print("%-50s %14s %14s %10s %10s"%("Timer", "Base", "Compare",
+                                                "Change", "Speedup"))
+            for name, timer1, timer2, percent, speedup in results:
+                print("%-50s %14lf %14lf %9.2lf%% %10lf"%(
+                    get_display_name(name), timer1, timer2, percent*100,
+                    speedup))
+        else:
+            for name, timer1, timer2, percent, speedup in results:
+                print("%s %lf"%(get_display_name(name), speedup))
+
+        base_totals = {}
+        if base_database is not None:
+            base_totals = get_timer_totals(base_database)
+        compare_totals = get_timer_totals(compare_database)
+        for name in sorted(compare_totals.keys()):
+            gated.append((name, base_totals.get(name), compare_totals[name]))
+
+    run = get_run_signature(compare_database)
+
+    regressed = False
+    if args.tolerance is not None:
+        for name, base_value, value in gated:
+            reference_value, reference_name = get_reference(
+                name, base_value, args.reference, history, history_key,
+                args.window, run)
+            if reference_value is None:
+                print("WARNING: No reference for timer %s, it is not gated."%(
+                    get_display_name(name)))
+                continue
+
+            if is_regression(reference_value, value, args.tolerance):
+                regressed = True
+                print("REGRESSION: Timer %s took %lf, more than %.2lf%% over "
+                      "the %s of %lf"%(get_display_name(name), value,
+                                       args.tolerance*100, reference_name,
+                                       reference_value))
+
+    # Record the comparison run for the medians of later runs
+    if history is not None:
+        record_timers(history, history_key, run,
+                      [(name, value) for name, base_value, value in gated])
+        history.close()
+
+    if regressed:
+        sys.exit(1)
@@ -1,64 +1,137 @@
 #!/usr/bin/env python
+"""
+Builds the cell adjacency graph of an MPAS mesh and writes it to graph.info,
+the format read by gpmetis, optionally weighted by a field in the mesh file.
+
+With --binary, the graph is also written as a METIS CSR graph in native-endian
+32-bit integers (METIS' default idx_t), with 0-based vertex numbers:
+    nvtxs, nadj, weighted        (header, weighted is 0 or 1)
+    xadj[nvtxs+1]
+    adjncy[nadj]
+    vwgt[nvtxs]                  (only if weighted)
+so the arrays can be passed straight to METIS_PartGraphKway or ParMETIS.
+"""
 from __future__ import absolute_import, division, print_function, \
     unicode_literals
 
-import os
 import numpy as np
 
 import argparse
 
-from netCDF4 import *
 from netCDF4 import Dataset as NetCDFFile
 
-parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
-parser.add_argument("-f", "--file", dest="filename", help="Path to grid file", metavar="FILE", required=True)
-parser.add_argument("-w", "--weights", dest="weight_field", help="Field to weight block partition file on.", metavar="VAR")
-
-args = parser.parse_args()
-
-if not args.weight_field:
-    print("Weight field missing. Defaulting to unweighted graphs.")
-    weighted_parts = False
-else:
-    weighted_parts = True
-
-dev_null = open(os.devnull, 'w')
-grid = NetCDFFile(args.filename, 'r')
-
-nCells = len(grid.dimensions['nCells'])
-nEdges = len(grid.dimensions['nEdges'])
-
-nEdgesOnCell = grid.variables['nEdgesOnCell'][:]
-cellsOnCell = grid.variables['cellsOnCell'][:] - 1
-if weighted_parts:
-    try:
-        weights = grid.variables[args.weight_field][:]
-    except:
-        print(args.weight_field, ' not found in file. Defaulting to un-weighted partitions.')
-        weighted_parts = False
-grid.close()
-
-nEdges = 0
-for i in np.arange(0, nCells):
-    for j in np.arange(0,nEdgesOnCell[i]):
-        if cellsOnCell[i][j] != -1:
-            nEdges = nEdges + 1
-
-nEdges = nEdges/2
-
-graph = open('graph.info', 'w+')
-if weighted_parts:
-    graph.write('%s %s 010\n'%(nCells, nEdges))
-else:
-    graph.write('%s %s\n'%(nCells, nEdges))
-
-for i in np.arange(0, nCells):
-    if weighted_parts:
-        graph.write('%s '%int(weights[i]))
-
-    for j in np.arange(0,nEdgesOnCell[i]):
-        if(cellsOnCell[i][j] >= 0):
-            graph.write('%s '%(cellsOnCell[i][j]+1))
-    graph.write('\n')
-graph.close()
 
+def read_mesh_graph(filename, weight_field=None):#{{{
+    # Read the adjacency (and optionally the weights) of all cells from a
+    # mesh file. Returns the CSR arrays xadj and adjncy (0-based) and the
+    # integer weights, or None if no (valid) weight field was requested.
+    grid = NetCDFFile(filename, 'r')
+
+    nEdgesOnCell = grid.variables['nEdgesOnCell'][:]
+    cellsOnCell = grid.variables['cellsOnCell'][:] - 1
+
+    weights = None
+    if weight_field is not None:
+        try:
+            weights = grid.variables[weight_field][:]
+        except KeyError:
+            print(weight_field, ' not found in file. Defaulting to un-weighted partitions.')
+            weights = None
+    grid.close()
+
+    xadj, adjncy = build_adjacency(cellsOnCell, nEdgesOnCell)
+
+    if weights is not None:
+        weights = np.asarray(weights).astype(np.int64)
+
+    return xadj, adjncy, weights
+#}}}
+
+
+def build_adjacency(cellsOnCell, nEdgesOnCell):#{{{
+    # Build CSR arrays from the 0-based cellsOnCell array, keeping only the
+    # first nEdgesOnCell entries of each row that refer to a cell.
+    cellsOnCell = np.asarray(cellsOnCell)
+    maxEdges = cellsOnCell.shape[1]
+
+    valid = np.arange(maxEdges)[np.newaxis, :] < \
+        np.asarray(nEdgesOnCell)[:, np.newaxis]
+    valid = np.logical_and(valid, cellsOnCell >= 0)
+
+    # Boolean indexing is row-major, so neighbors keep their order per cell
+    adjncy = cellsOnCell[valid].astype(np.int64)
+    xadj = np.zeros(cellsOnCell.shape[0] + 1, dtype=np.int64)
+    xadj[1:] = np.cumsum(np.sum(valid, axis=1))
+
+    return xadj, adjncy
+#}}}
+
+
+def write_graph_file(filename, xadj, adjncy, weights=None,
+                     rows_per_write=100000):#{{{
+    # Write a graph.info file for gpmetis, one line per cell with its
+    # (1-based) neighbors, writing many rows per file write.
+    nCells = len(xadj) - 1
+    nEdges = len(adjncy) // 2
+
+    graph = open(filename, 'w+')
+    if weights is not None:
+        graph.write('%s %s 010\n'%(nCells, nEdges))
+    else:
+        graph.write('%s %s\n'%(nCells, nEdges))
+
+    # Only rows_per_write rows are formatted at a time, so memory use doesn't
+    # grow with the size of the mesh
+    for start in range(0, nCells, rows_per_write):
+        end = min(start + rows_per_write, nCells)
+        first = xadj[start]
+        tokens = ['%d '%(cell) for cell in
+                  (adjncy[first:xadj[end]] + 1).tolist()]
+        offsets = (xadj[start:end+1] - first).tolist()
+        if weights is not None:
+            prefixes = ['%d '%(weight) for weight in
+                        weights[start:end].tolist()]
+        else:
+            prefixes = [''] * (end - start)
+        lines = [prefixes[i] + ''.join(tokens[offsets[i]:offsets[i+1]])
+                 for i in range(end - start)]
+        graph.write('\n'.join(lines))
+        graph.write('\n')
+    graph.close()
+#}}}
+
+
+def write_binary_graph(filename, xadj, adjncy, weights=None):#{{{
+    # Write the graph as METIS CSR arrays of 32-bit integers.
+    nCells = len(xadj) - 1
+    header = np.array([nCells, len(adjncy), int(weights is not None)],
+                      dtype=np.int32)
+
+    out = open(filename, 'wb')
+    header.tofile(out)
+    xadj.astype(np.int32).tofile(out)
+    adjncy.astype(np.int32).tofile(out)
+    if weights is not None:
+        weights.astype(np.int32).tofile(out)
+    out.close()
+#}}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-f", "--file", dest="filename", help="Path to grid file", metavar="FILE", required=True)
+    parser.add_argument("-w", "--weights", dest="weight_field", help="Field to weight block partition file on.", metavar="VAR")
+    parser.add_argument("-o", "--output", dest="output", help="Name of the graph file to write.", metavar="FILE", default="graph.info")
+    parser.add_argument("--binary", dest="binary", help="Name of a METIS binary CSR graph file to write as well.", metavar="FILE")
+
+    args = parser.parse_args()
+
+    if not args.weight_field:
+        print("Weight field missing. Defaulting to unweighted graphs.")
+
+    xadj, adjncy, weights = read_mesh_graph(args.filename, args.weight_field)
+
+    write_graph_file(args.output, xadj, adjncy, weights)
+
+    if args.binary:
+        write_binary_graph(args.binary, xadj, adjncy, weights)
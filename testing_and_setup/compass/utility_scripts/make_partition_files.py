@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""
+Builds the cell adjacency graph of an MPAS mesh once and produces
+graph.info.part.N partition files for a list of task counts in parallel.
+
+The graph is partitioned in memory with pymetis if it is available, and
+otherwise by running gpmetis on a graph.info file that is written only once.
+For each partition file, a load-balance report graph.info.part.N.report is
+written, with the cells (and weight, for weighted graphs) on each rank and the
+edge cut of the partition.
+"""
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import os
+import sys
+import argparse
+import subprocess
+import multiprocessing
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from make_graph_file import read_mesh_graph, write_graph_file
+
+try:
+    import pymetis
+except ImportError:
+    pymetis = None
+
+# The graph shared with the worker processes
+graph = {}
+
+
+def init_worker(xadj, adjncy, weights):#{{{
+    graph['xadj'] = xadj
+    graph['adjncy'] = adjncy
+    graph['weights'] = weights
+#}}}
+
+
+def partition(task):#{{{
+    # Partition the graph into nParts parts, write the partition file and its
+    # load-balance report, and return a one-line summary.
+    nParts, graph_file, metis, use_pymetis = task
+    xadj = graph['xadj']
+    adjncy = graph['adjncy']
+    weights = graph['weights']
+    part_file = '%s.part.%d'%(graph_file, nParts)
+
+    if nParts == 1:
+        parts = np.zeros(len(xadj) - 1, dtype=np.int64)
+        np.savetxt(part_file, parts, fmt='%d')
+    elif use_pymetis:
+        if weights is not None:
+            vweights = weights.tolist()
+        else:
+            vweights = None
+        _, parts = pymetis.part_graph(nParts, xadj=xadj.tolist(),
+                                      adjncy=adjncy.tolist(),
+                                      vweights=vweights)
+        parts = np.asarray(parts, dtype=np.int64)
+        np.savetxt(part_file, parts, fmt='%d')
+    else:
+        dev_null = open(os.devnull, 'w')
+        subprocess.check_call([metis, graph_file, '%d'%(nParts)],
+                              stdout=dev_null, stderr=dev_null)
+        dev_null.close()
+        parts = np.loadtxt(part_file, dtype=np.int64, ndmin=1)
+
+    return write_report(part_file, nParts, parts, xadj, adjncy, weights)
+#}}}
+
+
+def write_report(part_file, nParts, parts, xadj, adjncy, weights):#{{{
+    # Cells (and weight) per rank and the number of graph edges cut.
+    cells = np.bincount(parts, minlength=nParts)
+
+    source = np.repeat(parts, np.diff(xadj))
+    edge_cut = np.count_nonzero(source != parts[adjncy]) // 2
+
+    if weights is not None:
+        load = np.bincount(parts, weights=weights, minlength=nParts)
+    else:
+        load = cells
+    imbalance = np.amax(load) / np.mean(load)
+
+    report = open('%s.report'%(part_file), 'w')
+    report.write('partitions: %d\n'%(nParts))
+    report.write('edge cut: %d\n'%(edge_cut))
+    report.write('load imbalance (max/mean): %f\n'%(imbalance))
+    if weights is not None:
+        report.write('rank cells weight\n')
+        for rank in range(nParts):
+            report.write('%d %d %d\n'%(rank, cells[rank], load[rank]))
+    else:
+        report.write('rank cells\n')
+        for rank in range(nParts):
+            report.write('%d %d\n'%(rank, cells[rank]))
+    report.close()
+
+    return '%s: edge cut %d, load imbalance %f'%(part_file, edge_cut,
+                                                  imbalance)
+#}}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-f", "--file", dest="filename", help="Path to grid file", metavar="FILE", required=True)
+    parser.add_argument("-w", "--weights", dest="weight_field", help="Field to weight block partition file on.", metavar="VAR")
+    parser.add_argument("-n", "--num_parts", dest="num_parts", help="Comma delimited list of partition counts to produce.", metavar="LIST", required=True)
+    parser.add_argument("-o", "--output", dest="output", help="Name of the graph file; partition files are named <output>.part.N", metavar="FILE", default="graph.info")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, help="Number of partitions to compute at once. Defaults to the number of processors.", metavar="NUM")
+    parser.add_argument("--metis", dest="metis", help="gpmetis executable, used when pymetis is not available.", metavar="EXE", default="gpmetis")
+    parser.add_argument("--no_pymetis", dest="no_pymetis", help="If set, always partition with gpmetis.", action="store_true")
+
+    args = parser.parse_args()
+
+    try:
+        num_parts = sorted(set(int(n) for n in args.num_parts.split(',')))
+    except ValueError:
+        parser.error("Partition counts must be a comma delimited list of integers.")
+    if num_parts[0] < 1:
+        parser.error("Partition counts must be positive.")
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be a positive number of partitions.")
+
+    if not args.weight_field:
+        print("Weight field missing. Defaulting to unweighted graphs.")
+
+    xadj, adjncy, weights = read_mesh_graph(args.filename, args.weight_field)
+
+    use_pymetis = pymetis is not None and not args.no_pymetis
+
+    # The graph file is always written, since it's the usual companion of the
+    # partition files, and gpmetis needs it.
+    write_graph_file(args.output, xadj, adjncy, weights)
+
+    tasks = [(nParts, args.output, args.metis, use_pymetis)
+             for nParts in num_parts]
+
+    pool = multiprocessing.Pool(processes=args.jobs, initializer=init_worker,
+                                initargs=(xadj, adjncy, weights))
+    try:
+        for summary in pool.imap_unordered(partition, tasks):
+            print(summary)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,75 @@
+"""
+A cache of parsed XML files shared by the compass scripts (setup, clean, list
+and suite management).
+
+Config, driver, template and test-suite XML files are parsed once per process
+and the parsed root is reused for as long as the file's modification time is
+unchanged. The returned elements are shared, so callers that modify the tree
+must make a copy first (see parse_xml_copy).
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import os
+import copy
+import time
+import xml.etree.ElementTree as ET
+
+# Parsed XML files, keyed by absolute path, with their modification times
+xml_cache = dict()
+
+# Cache statistics, see cache_info()
+cache_stats = {'hits': 0, 'misses': 0, 'parse_time': 0.}
+
+
+def parse_xml(xml_file):  # {{{
+    """
+    Return the root element of an XML file, parsing the file only if it is
+    not in the cache or has been modified since it was parsed.
+    """
+    path = os.path.abspath(xml_file)
+    mtime = os.path.getmtime(path)
+
+    if path in xml_cache:
+        cached_mtime, root = xml_cache[path]
+        if cached_mtime == mtime:
+            cache_stats['hits'] += 1
+            return root
+
+    start = time.time()
+    root = ET.parse(path).getroot()
+    cache_stats['parse_time'] += time.time() - start
+    cache_stats['misses'] += 1
+
+    xml_cache[path] = (mtime, root)
+    return root
+# }}}
+
+
+def parse_xml_copy(xml_file):  # {{{
+    """
+    Return a copy of the root element of an XML file that the caller is free
+    to modify.
+    """
+    return copy.deepcopy(parse_xml(xml_file))
+# }}}
+
+
+def cache_info():  # {{{
+    """
+    Return a dictionary with the number of cache hits and misses (parsed
+    files) and the total time in seconds spent parsing XML files.
+    """
+    return dict(cache_stats)
+# }}}
+
+
+def clear_cache():  # {{{
+    """
+    Remove all parsed files from the cache.
+    """
+    xml_cache.clear()
+# }}}
+
+# vim: foldmethod=marker ai ts=4 sts=4 et sw=4 ft=python
@@ -4,10 +4,73 @@ import argparse
 from netCDF4 import Dataset
 import numpy as np
 import os, sys
+import multiprocessing
+
+# files opened by each comparison process
+compareFiles = {}
+
+#------------------------------------------------------------------
+
+def open_compare_files(filename1, filename2):
+
+    # raw values are compared so that masked entries are checked too
+    compareFiles["file1"] = Dataset(filename1, "r")
+    compareFiles["file2"] = Dataset(filename2, "r")
+    compareFiles["file1"].set_auto_mask(False)
+    compareFiles["file2"].set_auto_mask(False)
+
+#------------------------------------------------------------------
+
+def close_compare_files():
+
+    compareFiles.pop("file1").close()
+    compareFiles.pop("file2").close()
 
 #------------------------------------------------------------------
 
-def compare_files(filename1, filename2, logfile, variableNamesIgnore=[]):
+def compare_variable(task):
+
+    # compare a variable chunk by chunk along its first dimension, stopping at
+    # the first chunk that differs. Returns the variable name and the index of
+    # the first difference, or None if the arrays are bit for bit identical
+    variableName, chunkSize = task
+
+    variable1 = compareFiles["file1"].variables[variableName]
+    variable2 = compareFiles["file2"].variables[variableName]
+
+    shape = variable1.shape
+
+    if (len(shape) == 0):
+        if (np.array_equal(variable1.getValue(), variable2.getValue())):
+            return variableName, None
+        return variableName, ()
+
+    rowSize = int(np.prod(shape[1:]))
+    nRows = max(1, chunkSize // max(rowSize, 1))
+
+    for iStart in range(0, shape[0], nRows):
+
+        iEnd = min(iStart + nRows, shape[0])
+
+        array1 = variable1[iStart:iEnd]
+        array2 = variable2[iStart:iEnd]
+
+        if (not np.array_equal(array1, array2)):
+
+            differences = np.nonzero(np.ravel(array1 != array2))[0]
+            if (len(differences) == 0):
+                # e.g. string arrays of different representation
+                return variableName, (iStart,)
+
+            index = np.unravel_index(differences[0], np.shape(array1))
+            index = (iStart + int(index[0]),) + tuple(int(i) for i in index[1:])
+            return variableName, index
+
+    return variableName, None
+
+#------------------------------------------------------------------
+
+def compare_files(filename1, filename2, logfile, variableNamesIgnore=[], nProcesses=None, chunkSize=4194304):
 
     # init error numbers
     nErrorsNonArray = 0
@@ -89,14 +152,12 @@ def compare_files(filename1, filename2, logfile, variableNamesIgnore=[]):
             logfile.write("Variable dimension found in file 2 and not file 1: %s %s\n" %(variableName,dimensionName))
             nErrorsNonArray = nErrorsNonArray + 1
 
-    # check variable contents
-    for variableName in variablesNameIntersection:
-
-        variableArray1 = file1.variables[variableName][:]
-        variableArray2 = file2.variables[variableName][:]
+    # check variable shapes
+    variableNamesCompare = []
+    for variableName in sorted(variablesNameIntersection):
 
-        shape1 = np.shape(variableArray1)
-        shape2 = np.shape(variableArray2)
+        shape1 = file1.variables[variableName].shape
+        shape2 = file2.variables[variableName].shape
 
         rank1 = len(shape1)
         rank2 = len(shape2)
@@ -120,18 +181,37 @@ def compare_files(filename1, filename2, logfile, variableNamesIgnore=[]):
                     nErrorsNonArray = nErrorsNonArray + 1
                     arrayOK = False
 
-            if (arrayOK):
+            if (arrayOK and variableName not in variableNamesIgnore):
+                variableNamesCompare.append(variableName)
 
-                # compare array values
-                if (not np.array_equal(variableArray1,variableArray2) and variableName not in variableNamesIgnore):
+    # close files, the contents are read again by each comparison
+    file1.close()
+    file2.close()
 
-                    logfile.write("Arrays %s differ!\n" %(variableName))
-                    nErrorsArray = nErrorsArray + 1
+    # check variable contents
+    if (nProcesses is None):
+        nProcesses = min(multiprocessing.cpu_count(), len(variableNamesCompare))
 
+    tasks = [(variableName, chunkSize) for variableName in variableNamesCompare]
 
-    # close files
-    file1.close()
-    file2.close()
+    if (nProcesses > 1):
+        pool = multiprocessing.Pool(nProcesses, open_compare_files, (filename1, filename2))
+        try:
+            results = pool.map(compare_variable, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        open_compare_files(filename1, filename2)
+        results = [compare_variable(task) for task in tasks]
+        close_compare_files()
+
+    for variableName, firstDifference in results:
+
+        if (firstDifference is not None):
+
+            logfile.write("Arrays %s differ! First difference at index %s\n" %(variableName, str(firstDifference)))
+            nErrorsArray = nErrorsArray + 1
 
     # return error numbers
     return nErrorsArray, nErrorsNonArray
@@ -148,6 +228,7 @@ if __name__ == "__main__":
     parser.add_argument('-f1', help='First filename to compare.',             dest="filename1", required=True)
     parser.add_argument('-f2', help='Second filename to compare.',            dest="filename2", required=True)
     parser.add_argument('-i',  help='Text file of variable names to ignore.', dest="ignoreFile", default=None)
+    parser.add_argument('-n',  help='Number of processes comparing variables.', dest="nProcesses", type=int, default=None)
 
     args = parser.parse_args()
 
@@ -158,9 +239,9 @@ if __name__ == "__main__":
         fileIgnoreList.close()
     variableNamesIgnore = [word.strip() for word in variableNamesIgnore]
 
-    logfile = open("log_test.txt")
+    logfile = open("log_test.txt","w")
 
-    nErrorsArray, nErrorsNonArray = compare_files(args.filename1, args.filename2, logfile, variableNamesIgnore)
+    nErrorsArray, nErrorsNonArray = compare_files(args.filename1, args.filename2, logfile, variableNamesIgnore, args.nProcesses)
     print "Number of array errors:     ", nErrorsArray
     print "Number of non-array errors: ", nErrorsNonArray
 
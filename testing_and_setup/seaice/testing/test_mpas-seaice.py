@@ -6,11 +6,40 @@ import sys
 import os
 import xml.etree.ElementTree as ET
 import imp
+import multiprocessing
+import time
 
 # tests defined
-tests = [{"name":"regression"     , "needsBase":True,  "description":"Tests whether development and base MPAS models are bit reproducible."},
-         {"name":"restartability" , "needsBase":False, "description":"Tests if restarting the model is bit reproducible."},
-         {"name":"parallelism"    , "needsBase":False, "description":"Tests whether different processor numbers is bit reproducible."}]
+# nProcs is the number of processors a test uses with its independent model
+# runs at the same time, nProcsSerial with its model runs one after the other
+tests = [{"name":"regression"     , "needsBase":True,  "nProcs":32, "nProcsSerial":16, "description":"Tests whether development and base MPAS models are bit reproducible."},
+         {"name":"restartability" , "needsBase":False, "nProcs":32, "nProcsSerial":32, "description":"Tests if restarting the model is bit reproducible."},
+         {"name":"parallelism"    , "needsBase":False, "nProcs":48, "nProcsSerial":32, "description":"Tests whether different processor numbers is bit reproducible."}]
+
+#-------------------------------------------------------------------------
+
+def run_test(job, nProcsAvailable):
+
+    # run a single test, returning 1 if it failed
+    testAvail = job["test"]
+
+    module = imp.load_source(testAvail["name"], os.path.dirname(os.path.abspath(__file__)) + "/tests/" + testAvail["name"]+".py")
+    test_function = getattr(module, testAvail["name"])
+    if (testAvail["needsBase"]):
+        failed = test_function(mpasDevelopmentDir, mpasBaseDir, domainsDir, job["domain"], job["configuration"], job["options"], args.check, nProcsAvailable)
+    else:
+        failed = test_function(mpasDevelopmentDir,              domainsDir, job["domain"], job["configuration"], job["options"], args.check, nProcsAvailable)
+
+    return failed
+
+#-------------------------------------------------------------------------
+
+def run_test_process(job, nProcsAvailable):
+
+    # run a test in its own process, with failure given by the exit code
+    sys.exit(run_test(job, nProcsAvailable))
+
+#-------------------------------------------------------------------------
 
 colour_init()
 
@@ -23,6 +52,7 @@ parser.add_argument("-t", "--testsuite",  required=False, dest="testSuite",
 parser.add_argument("-o", "--domainsdir", required=False, dest="domainsDir",                         help="Domains directory")
 parser.add_argument("-a", "--avail",      required=False, dest="avail",         action='store_true', help="Print available tests to stdout")
 parser.add_argument("-c", "--check",      required=False, dest="check",         action='store_true', help="Check that the testing system is working")
+parser.add_argument("-n", "--nprocs",     required=False, dest="nProcsMax",     type=int,            help="Total number of processors available; independent tests and model runs are run at the same time within this number")
 
 args = parser.parse_args()
 
@@ -94,14 +124,15 @@ print_colour("Testing MPAS-Seaice", "title")
 print "Test suite: ", testSuite
 print
 
+# gather tests
+jobs = []
+
 # loop over configurations
 for configuration in testsuite:
 
     # loop over domain
     for domain in configuration:
 
-        print "Using configuration " + configuration.get('name') + " and domain " + domain.get('name') + "..."
-
         # loop over tests
         for test in domain:
 
@@ -119,16 +150,7 @@ for configuration in testsuite:
                     for option in test:
                         options[option.get('name')] = option.get('value')
 
-                    # run test
-                    module = imp.load_source(testAvail["name"], os.path.dirname(os.path.abspath(__file__)) + "/tests/" + testAvail["name"]+".py")
-                    test_function = getattr(module, testAvail["name"])
-                    if (testAvail["needsBase"]):
-                        failed = test_function(mpasDevelopmentDir, mpasBaseDir, domainsDir, domain.get('name'), configuration.get('name'), options, args.check)
-                    else:
-                        failed = test_function(mpasDevelopmentDir,              domainsDir, domain.get('name'), configuration.get('name'), options, args.check)
-
-                    nTests = nTests + 1
-                    nFails = nFails + failed
+                    jobs.append({"test":testAvail, "configuration":configuration.get('name'), "domain":domain.get('name'), "options":options})
 
             # see if test wasnt available
             if (not foundTest):
@@ -136,6 +158,63 @@ for configuration in testsuite:
                 print "Requested test %s not available" %(test.get('name'))
                 sys.exit()
 
+if (args.nProcsMax == None):
+
+    # run tests one after the other
+    previousDomain = None
+    for job in jobs:
+
+        if ((job["configuration"], job["domain"]) != previousDomain):
+            print "Using configuration " + job["configuration"] + " and domain " + job["domain"] + "..."
+            previousDomain = (job["configuration"], job["domain"])
+
+        failed = run_test(job, None)
+
+        nTests = nTests + 1
+        nFails = nFails + failed
+
+else:
+
+    # run tests at the same time within the processor budget
+    nProcsFree = args.nProcsMax
+    jobsPending = list(jobs)
+    jobsRunning = []
+
+    while (len(jobsPending) > 0 or len(jobsRunning) > 0):
+
+        # start every pending test that fits
+        for job in list(jobsPending):
+
+            nProcs = job["test"]["nProcs"]
+            if (nProcs > args.nProcsMax):
+                nProcs = min(job["test"]["nProcsSerial"], args.nProcsMax)
+
+            if (nProcs <= nProcsFree):
+
+                print "Starting test " + job["test"]["name"] + " using configuration " + job["configuration"] + " and domain " + job["domain"] + "..."
+
+                process = multiprocessing.Process(target=run_test_process, args=(job, nProcs))
+                process.start()
+
+                jobsPending.remove(job)
+                jobsRunning.append((process, nProcs))
+                nProcsFree = nProcsFree - nProcs
+
+        time.sleep(1)
+
+        # gather finished tests
+        for process, nProcs in list(jobsRunning):
+
+            if (not process.is_alive()):
+
+                process.join()
+                jobsRunning.remove((process, nProcs))
+                nProcsFree = nProcsFree + nProcs
+
+                nTests = nTests + 1
+                if (process.exitcode != 0):
+                    nFails = nFails + 1
+
 
 # print final summary of tests
 print_colour("Summary","title")
@@ -196,6 +196,23 @@ def create_test_directory(directory):
 
 def run_model(runName, mpasDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs, logfile):
 
+    # create run directory
+    setup_model(runName, mpasDir, domainsDir, domain, configuration, nmlChanges, streamChanges)
+
+    os.chdir(runName)
+
+    # run the model
+    returnCode = execute_model(nProcs, logfile)
+
+    # up one level
+    os.chdir("..")
+
+    return returnCode
+
+#-------------------------------------------------------------------------
+
+def setup_model(runName, mpasDir, domainsDir, domain, configuration, nmlChanges, streamChanges):
+
     # create development directory
     os.mkdir(runName)
     os.chdir(runName)
@@ -212,13 +229,61 @@ def run_model(runName, mpasDir, domainsDir, domain, configuration, nmlChanges, s
     # create streams file
     create_new_streams(mpasDir+"/testing_and_setup/seaice/configurations/"+configuration+"/streams.seaice", "streams.seaice", streamChanges)
 
-    # run the model
-    returnCode = execute_model(nProcs, logfile)
-
     # up one level
     os.chdir("..")
 
-    return returnCode
+#-------------------------------------------------------------------------
+
+def run_models(runs, logfile, nProcsAvailable=None):
+
+    # runs is a list of independent runs, each a list of the run_model
+    # arguments before logfile. If their total number of processors fits in
+    # nProcsAvailable they are run at the same time, otherwise one after the
+    # other, stopping at the first failure. Returns the first non-zero return
+    # code, or zero if all runs succeeded.
+
+    nProcsTotal = sum([run[7] for run in runs])
+
+    if (nProcsAvailable is None or nProcsTotal > nProcsAvailable):
+
+        for run in runs:
+            returnCode = run_model(*(list(run) + [logfile]))
+            if (returnCode != 0):
+                return returnCode
+
+        return 0
+
+    # set up all runs and start them
+    processes = []
+    for run in runs:
+
+        runName = run[0]
+        nProcs = run[7]
+
+        setup_model(*run[0:7])
+
+        # each run writes to its own log so the outputs are not interleaved
+        runLogfile = open(runName + "/log_run.txt", "w")
+        process = start_model(nProcs, runLogfile, runName)
+        processes.append((runName, process, runLogfile))
+
+    # gather the runs
+    returnCodeFirstFail = 0
+    for runName, process, runLogfile in processes:
+
+        returnCode = process.wait()
+        runLogfile.close()
+
+        runLogfile = open(runName + "/log_run.txt", "r")
+        logfile.write(runLogfile.read())
+        runLogfile.close()
+        logfile.write("Return code: %i\n" %(returnCode))
+        logfile.flush()
+
+        if (returnCode != 0 and returnCodeFirstFail == 0):
+            returnCodeFirstFail = returnCode
+
+    return returnCodeFirstFail
 
 #-------------------------------------------------------------------------
 
@@ -280,12 +345,21 @@ def restart_model(runName, nmlChanges, streamChanges, nProcs, logfile):
 
 #-------------------------------------------------------------------------
 
-def execute_model(nProcs, logfile):
+def start_model(nProcs, logfile, runDir=None):
 
     import subprocess
 
+    # start mpirun -np np seaice_model
+    process = subprocess.Popen(["mpirun", "-np", "%i" %(nProcs), "seaice_model"], stdout=logfile, stderr=logfile, cwd=runDir)
+
+    return process
+
+#-------------------------------------------------------------------------
+
+def execute_model(nProcs, logfile):
+
     # execute mpirun -np np seaice_model
-    process = subprocess.Popen(["mpirun", "-np", "%i" %(nProcs), "seaice_model"], stdout=logfile, stderr=logfile)
+    process = start_model(nProcs, logfile)
     returnCode = process.wait()
     logfile.flush()
     logfile.write("Return code: %i\n" %(returnCode))
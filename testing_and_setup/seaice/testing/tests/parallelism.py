@@ -6,7 +6,7 @@ from testing_utils import *
 
 #-------------------------------------------------------------------------
 
-def parallelism(mpasDevelopmentDir, domainsDir, domain, configuration, options, check):
+def parallelism(mpasDevelopmentDir, domainsDir, domain, configuration, options, check, nProcsAvailable=None):
 
     # find available directory name
     iTest = 1
@@ -43,10 +43,7 @@ def parallelism(mpasDevelopmentDir, domainsDir, domain, configuration, options,
     streamChanges = [{"streamName":"restart", "attributeName":"output_interval", "newValue":"24:00:00"}, \
                      {"streamName":"output" , "attributeName":"output_interval", "newValue":"none"}]
 
-    if (run_model("development1", mpasDevelopmentDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs, logfile) != 0):
-        run_failed("parallelism")
-        os.chdir("..")
-        return 1
+    runs = [["development1", mpasDevelopmentDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs]]
 
     # base run
     nProcs = 32
@@ -66,7 +63,10 @@ def parallelism(mpasDevelopmentDir, domainsDir, domain, configuration, options,
     streamChanges = [{"streamName":"restart", "attributeName":"output_interval", "newValue":"24:00:00"}, \
                      {"streamName":"output" , "attributeName":"output_interval", "newValue":"none"}]
 
-    if (run_model("development2", mpasDevelopmentDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs, logfile) != 0):
+    runs.append(["development2", mpasDevelopmentDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs])
+
+    # the two runs are independent
+    if (run_models(runs, logfile, nProcsAvailable) != 0):
         run_failed("parallelism")
         os.chdir("..")
         return 1
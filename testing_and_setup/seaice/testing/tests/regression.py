@@ -6,7 +6,7 @@ from testing_utils import *
 
 #-------------------------------------------------------------------------
 
-def regression(mpasDevelopmentDir, mpasBaseDir, domainsDir, domain, configuration, options, check):
+def regression(mpasDevelopmentDir, mpasBaseDir, domainsDir, domain, configuration, options, check, nProcsAvailable=None):
 
     # find available directory name
     iTest = 1
@@ -36,10 +36,7 @@ def regression(mpasDevelopmentDir, mpasBaseDir, domainsDir, domain, configuratio
     streamChanges = [{"streamName":"restart", "attributeName":"output_interval", "newValue":"24:00:00"}, \
                      {"streamName":"output" , "attributeName":"output_interval", "newValue":"none"}]
 
-    if (run_model("development", mpasDevelopmentDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs, logfile) != 0):
-        run_failed("regression")
-        os.chdir("..")
-        return 1
+    runs = [["development", mpasDevelopmentDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs]]
 
     # base run
     nProcs = 16
@@ -51,7 +48,10 @@ def regression(mpasDevelopmentDir, mpasBaseDir, domainsDir, domain, configuratio
     streamChanges = [{"streamName":"restart", "attributeName":"output_interval", "newValue":"24:00:00"}, \
                      {"streamName":"output" , "attributeName":"output_interval", "newValue":"none"}]
 
-    if (run_model("base", mpasBaseDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs, logfile) != 0):
+    runs.append(["base", mpasBaseDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs])
+
+    # the two runs are independent
+    if (run_models(runs, logfile, nProcsAvailable) != 0):
         run_failed("regression")
         os.chdir("..")
         return 1
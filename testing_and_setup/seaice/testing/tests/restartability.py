@@ -6,7 +6,7 @@ from testing_utils import *
 
 #-------------------------------------------------------------------------
 
-def restartability(mpasDevelopmentDir, domainsDir, domain, configuration, options, check):
+def restartability(mpasDevelopmentDir, domainsDir, domain, configuration, options, check, nProcsAvailable=None):
 
     # find available directory name
     iTest = 1
@@ -36,10 +36,7 @@ def restartability(mpasDevelopmentDir, domainsDir, domain, configuration, option
     streamChanges = [{"streamName":"restart", "attributeName":"output_interval", "newValue":"24:00:00"}, \
                      {"streamName":"output" , "attributeName":"output_interval", "newValue":"none"}]
 
-    if (run_model("base", mpasDevelopmentDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs, logfile) != 0):
-        run_failed("restartability")
-        os.chdir("..")
-        return 1
+    runs = [["base", mpasDevelopmentDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs]]
 
     # first restart run
     nProcs = 16
@@ -51,7 +48,10 @@ def restartability(mpasDevelopmentDir, domainsDir, domain, configuration, option
     streamChanges = [{"streamName":"restart", "attributeName":"output_interval", "newValue":"12:00:00"}, \
                      {"streamName":"output" , "attributeName":"output_interval", "newValue":"none"}]
 
-    if (run_model("restart", mpasDevelopmentDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs, logfile) != 0):
+    runs.append(["restart", mpasDevelopmentDir, domainsDir, domain, configuration, nmlChanges, streamChanges, nProcs])
+
+    # the base run and the first half of the restart run are independent
+    if (run_models(runs, logfile, nProcsAvailable) != 0):
         run_failed("restartability")
         os.chdir("..")
         return 1